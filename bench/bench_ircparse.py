@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, bench/bench_ircparse.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# IRC line parser microbenchmark. Times modules.irc.parse() against the
+# word by word parser it replaced (kept below as oldparse) over a mix of
+# lines like a busy network sends: mostly PRIVMSGs, some with IRCv3 tags,
+# plus JOIN/PART/QUIT/MODE/NOTICE/PING and numerics. Both parsers are first
+# checked to agree on every untagged line.
+#
+# Usage: python bench/bench_ircparse.py [options]
+#
+# Must be run with the interpreter used for run.py.
+
+import sys, os, time, random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import modules.irc as irc
+
+# The parser from before modules.irc.parse(), as it was in irc.client
+def oldparse(line):
+	ret = {'source': {'full': "", 'name': "", 'ident': "", 'host': ""}, 'msg': "", 'params': []}
+
+	stat = 0
+
+	words = line.split(' ')
+	for word in words:
+		if ((stat < 3) and (len(word) == 0)):
+			continue
+
+		if (stat == 0):
+			stat += 1
+			if (word[0] == ":"):
+				 ret['source']['full'] = word[1:]
+			else:
+				ret['msg'] = word.upper()
+				stat += 1
+		elif (stat == 1):
+			ret['msg'] = word.upper()
+			stat += 1
+		elif (stat == 2):
+			if (word[0] == ":"):
+				ret['params'].append(word[1:])
+				stat += 1
+			else:
+				ret['params'].append(word)
+		else:
+			ret['params'][-1] = ret['params'][-1] + " " + word
+
+	if (len(ret['source']['full']) > 0):
+		src = ret['source']['full']
+		if (src.find("@") >= 0):
+			ret['source']['host'] = src[src.find("@")+1:]
+			src = src[:src.find("@")]
+		if (src.find("!") >= 0):
+			ret['source']['ident'] = src[src.find("!")+1:]
+			src = src[:src.find("!")]
+		ret['source']['name'] = src
+
+	return ret
+
+_words = ('the', 'creeper', 'blew', 'up', 'my', 'house', 'again', 'anyone', 'got', 'spare', 'diamonds', 'lol',
+		'brb', 'server', 'restart', 'in', '5', 'minutes', 'who', 'is', 'online', 'nether', 'portal', 'at', 'spawn')
+
+def corpus(n, tagged, seed):
+	rnd = random.Random(seed)
+	lines = []
+	for i in range(n):
+		nick = 'user' + str(rnd.randint(1, 300))
+		src = ':' + nick + '!~' + nick + '@host-' + str(rnd.randint(1, 9999)) + '.example.net'
+		text = ' '.join([rnd.choice(_words) for j in range(rnd.randint(1, 20))])
+		chan = rnd.choice(['#minecraft', '#other', '#chat'])
+		r = rnd.random()
+		if r < 0.75:
+			line = src + ' PRIVMSG ' + chan + ' :' + text
+		elif r < 0.80:
+			line = src + ' PRIVMSG ' + chan + ' :\x01ACTION ' + text + '\x01'
+		elif r < 0.85:
+			line = src + ' JOIN ' + chan
+		elif r < 0.88:
+			line = src + ' PART ' + chan + ' :' + text
+		elif r < 0.91:
+			line = src + ' QUIT :Quit: ' + text
+		elif r < 0.93:
+			line = src + ' MODE ' + chan + ' +o ' + nick
+		elif r < 0.95:
+			line = ':irc.example.net NOTICE * :*** ' + text
+		elif r < 0.97:
+			line = 'PING :irc.example.net'
+		else:
+			line = ':irc.example.net 353 RelayBot = ' + chan + ' :' + ' '.join(['@user' + str(j) for j in range(40)])
+		if rnd.random() < tagged:
+			line = '@time=2016-01-01T00:00:' + '%02d' % (i % 60) + '.000Z;account=' + nick + ';msgid=' + str(i) + ' ' + line
+		lines.append(line)
+	return lines
+
+def check(lines):
+	for line in lines:
+		old = oldparse(line)
+		new = irc.parse(line)
+		if (old['msg'], old['params'], old['source']['name'], old['source']['ident'], old['source']['host']) != \
+				(new.command, new.params, new.nick, new.ident, new.host):
+			print('Parsers disagree on: ' + line)
+			return False
+	return True
+
+def timeit(func, lines, rounds):
+	best = None
+	for r in range(rounds):
+		start = time.time()
+		for line in lines:
+			func(line)
+		took = time.time() - start
+		if best == None or took < best:
+			best = took
+	return best
+
+# Parse and then read what the bot reads for each line: the command, the
+# params and (for PRIVMSG/JOIN/PART/NICK) the source nick
+def oldread(line):
+	msg = oldparse(line)
+	if msg['msg'] in ('PRIVMSG', 'JOIN', 'PART', 'NICK'):
+		return msg['source']['name'], msg['params'][-1]
+	return msg['params']
+
+def newread(line):
+	msg = irc.parse(line)
+	if msg.command in ('PRIVMSG', 'JOIN', 'PART', 'NICK'):
+		return msg.nick, msg.params[-1]
+	return msg.params
+
+def main():
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('-n', '--lines', dest='lines', type='int', default=50000,
+			help='lines per round [default: %default]')
+	parser.add_option('-r', '--rounds', dest='rounds', type='int', default=5,
+			help='rounds, the best is reported [default: %default]')
+	parser.add_option('-t', '--tagged', dest='tagged', type='float', default=0.3,
+			help='fraction of lines with IRCv3 tags in the tagged run [default: %default]')
+	(options, args) = parser.parse_args()
+
+	plain = corpus(options.lines, 0.0, 1)
+	if not check(plain):
+		return 1
+	tagged = corpus(options.lines, options.tagged, 2)
+
+	print('%-24s %12s %12s %8s' % ('run', 'old lines/s', 'new lines/s', 'speedup'))
+	for name, lines, oldfunc, newfunc in [('parse', plain, oldparse, irc.parse), ('parse+read', plain, oldread, newread),
+			('parse+read (tagged)', tagged, oldread, newread)]:
+		old = timeit(oldfunc, lines, options.rounds)
+		new = timeit(newfunc, lines, options.rounds)
+		print('%-24s %12.0f %12.0f %7.2fx' % (name, len(lines) / old, len(lines) / new, old / new))
+		sys.stdout.flush()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, bench/bench_relay.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# End to end relay benchmark. Starts a fake IRC server, a fake RCON server
+# and a log4j style UDP sender on localhost, writes a config pointing the
+# bot at them and runs the real run.py. Messages are then pushed through
+# IRC->Minecraft and Minecraft->IRC at increasing rates and the throughput
+# and relay latency seen by the fakes is reported for each.
+#
+# Usage: python bench/bench_relay.py [options]
+#
+# The bot itself is started with the interpreter given by --python (the one
+# running this script by default), which must be able to run run.py.
+
+import sys, os, time, socket, struct, threading, subprocess, tempfile, shutil, re, signal, json
+from optparse import OptionParser
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CHANNEL = '#bench'
+PLAYER = 'Bencher'
+
+configtemplate = '''<?xml version="1.0" encoding="UTF-8"?>
+<config>
+	<module name="irc" />
+	<module name="minecraft" />
+	<logging>
+		<output type="file" path="%(log)s" level="%(level)s"/>
+	</logging>
+	<irc name="BenchIRC">
+		<server host="127.0.0.1" port="%(ircport)d" password="" />
+		<user nick="RelayBot" user="RelayBot" gecos="Relay benchmark" />
+		<channel name="%(channel)s">
+			<relay type="minecraft" name="BenchMC" channel="" prefix="[IRC]" />
+		</channel>
+	</irc>
+	<minecraft name="BenchMC">
+		<rcon host="127.0.0.1" port="%(rconport)d" password="bench" />
+		<udp host="127.0.0.1" port="%(udpport)d">
+			<relay type="irc" name="BenchIRC" channel="%(channel)s" prefix="[MC]">
+				<filter type="playerchat" />
+			</relay>
+		</udp>
+	</minecraft>
+</config>
+'''
+
+_idreg = re.compile(r'bench (\d+)')
+
+class tracker:
+	def __init__(self):
+		self.sent = {}
+		self.recv = {}
+		self.lock = threading.Lock()
+
+	def markrecv(self, text):
+		now = time.time()
+		with self.lock:
+			for m in _idreg.finditer(text):
+				id = int(m.group(1))
+				if not id in self.recv:
+					self.recv[id] = now
+
+class fakeirc:
+	def __init__(self, track):
+		self.track = track
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(5)
+		self.port = self.listener.getsockname()[1]
+		self.conn = None
+		self.nick = 'RelayBot'
+		self.joined = threading.Event()
+		self.wlock = threading.Lock()
+		t = threading.Thread(target=self._accept)
+		t.daemon = True
+		t.start()
+
+	def _accept(self):
+		while True:
+			c, addr = self.listener.accept()
+			self.conn = c
+			t = threading.Thread(target=self._client, args=(c,))
+			t.daemon = True
+			t.start()
+
+	def send(self, line, conn=None):
+		if conn == None:
+			conn = self.conn
+		with self.wlock:
+			conn.sendall((line + '\r\n').encode('utf-8'))
+
+	def _client(self, c):
+		f = c.makefile('rb')
+		while True:
+			raw = f.readline()
+			if not raw:
+				break
+			line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+			w = line.split(' ')
+			cmd = w[0].upper()
+			if cmd == 'PRIVMSG':
+				self.track.markrecv(line)
+			elif cmd == 'CAP' and len(w) > 1 and w[1] == 'LS':
+				self.send(':bench.srv CAP * LS :', c)
+			elif cmd == 'NICK':
+				self.nick = w[1]
+			elif cmd == 'USER':
+				self.send(':bench.srv 001 ' + self.nick + ' :Welcome to the benchmark', c)
+				self.send(':bench.srv 004 ' + self.nick + ' bench.srv bench-1 o o', c)
+				self.send(':bench.srv 005 ' + self.nick + ' CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 :are supported by this server', c)
+				self.send(':bench.srv 376 ' + self.nick + ' :End of MOTD', c)
+			elif cmd == 'PING':
+				self.send(':bench.srv PONG bench.srv :' + w[-1].lstrip(':'), c)
+			elif cmd == 'JOIN':
+				for chan in w[1].split(','):
+					self.send(':' + self.nick + '!bot@bench JOIN ' + chan, c)
+					if chan.lower() == CHANNEL:
+						self.joined.set()
+			elif cmd == 'QUIT':
+				break
+		c.close()
+
+	def sendone(self, id):
+		self.send(':user' + str(id % 100) + '!u@bench PRIVMSG ' + CHANNEL + ' :bench ' + str(id))
+
+class fakercon:
+	def __init__(self, track):
+		self.track = track
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(5)
+		self.port = self.listener.getsockname()[1]
+		self.authed = threading.Event()
+		t = threading.Thread(target=self._accept)
+		t.daemon = True
+		t.start()
+
+	def _accept(self):
+		while True:
+			c, addr = self.listener.accept()
+			t = threading.Thread(target=self._client, args=(c,))
+			t.daemon = True
+			t.start()
+
+	def _reply(self, c, id, type, payload=b''):
+		packet = struct.pack('<ii', id, type) + payload + b'\x00\x00'
+		c.sendall(struct.pack('<i', len(packet)) + packet)
+
+	def _client(self, c):
+		buf = b''
+		while True:
+			try:
+				data = c.recv(65536)
+			except socket.error:
+				break
+			if not data:
+				break
+			buf += data
+			while len(buf) >= 4:
+				size = struct.unpack('<i', buf[:4])[0]
+				if len(buf) < size + 4:
+					break
+				packet = buf[4:size + 4]
+				buf = buf[size + 4:]
+				id, type = struct.unpack('<ii', packet[:8])
+				payload = packet[8:-2]
+				if type == 3:
+					self._reply(c, id, 2)
+					self.authed.set()
+				else:
+					self.track.markrecv(payload.decode('utf-8', 'replace'))
+					self._reply(c, id, 0)
+		c.close()
+
+class udpsender:
+	def __init__(self):
+		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		s.bind(('127.0.0.1', 0))
+		self.port = s.getsockname()[1]
+		s.close()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def sendone(self, id):
+		msg = '<' + PLAYER + '> bench ' + str(id)
+		# Same layout as the log4j2 JsonLayout used by the minecraft server
+		line = '{"timeMillis":' + str(int(time.time() * 1000)) + ',"thread":"Server thread","level":"INFO",' + \
+			'"loggerName":"net.minecraft.server.MinecraftServer","message":' + json.dumps(msg) + '}'
+		self.sock.sendto(line.encode('utf-8'), ('127.0.0.1', self.port))
+
+def percentile(values, p):
+	if len(values) < 1:
+		return 0.0
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+def runphase(track, sendone, rate, duration, nextid, drain):
+	total = int(rate * duration)
+	ids = list(range(nextid, nextid + total))
+	start = time.time()
+	n = 0
+	while n < total:
+		due = start + n / float(rate)
+		now = time.time()
+		if due > now:
+			time.sleep(min(due - now, 0.01))
+			continue
+		with track.lock:
+			track.sent[ids[n]] = time.time()
+		sendone(ids[n])
+		n += 1
+
+	end = time.time() + drain
+	while time.time() < end:
+		with track.lock:
+			if len([id for id in ids if id in track.recv]) >= total:
+				break
+		time.sleep(0.05)
+
+	with track.lock:
+		got = [id for id in ids if id in track.recv]
+		lat = sorted([track.recv[id] - track.sent[id] for id in got])
+		last = max([track.recv[id] for id in got] + [start])
+	elapsed = max(last - start, 0.001)
+	return (total, len(got), len(got) / elapsed, percentile(lat, 0.5), percentile(lat, 0.99), nextid + total)
+
+def main():
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('-r', '--rates', dest='rates', default='50,200,500,1000,2000',
+			help='comma separated message rates per second [default: %default]')
+	parser.add_option('-d', '--duration', dest='duration', type='float', default=5,
+			help='seconds to send for at each rate [default: %default]')
+	parser.add_option('-p', '--python', dest='python', default=sys.executable,
+			help='interpreter used to run run.py [default: %default]')
+	parser.add_option('-w', '--workers', dest='workers', type='int', default=0,
+			help='pass -w N to run.py')
+	parser.add_option('-l', '--level', dest='level', default='INFO',
+			help='bot log level [default: %default]')
+	parser.add_option('-k', '--keep', dest='keep', action='store_true', default=False,
+			help='keep the generated config and bot log')
+	(options, args) = parser.parse_args()
+
+	rates = [float(r) for r in options.rates.split(',') if r != '']
+
+	track = tracker()
+	irc = fakeirc(track)
+	rcon = fakercon(track)
+	udp = udpsender()
+
+	tmpdir = tempfile.mkdtemp(prefix='relaybench-')
+	conffile = os.path.join(tmpdir, 'config.xml')
+	logfile = os.path.join(tmpdir, 'relaybot.log')
+	f = open(conffile, 'w')
+	f.write(configtemplate % {'log': logfile, 'level': options.level, 'ircport': irc.port,
+			'rconport': rcon.port, 'udpport': udp.port, 'channel': CHANNEL})
+	f.close()
+
+	cmd = [options.python, os.path.join(root, 'run.py'), '-c', conffile]
+	if options.workers > 0:
+		cmd += ['-w', str(options.workers)]
+	devnull = open(os.devnull, 'w')
+	bot = subprocess.Popen(cmd, cwd=root, stdout=devnull, stderr=subprocess.STDOUT)
+
+	try:
+		# The bot only relays once it has joined and rcon has logged in
+		irc.joined.wait(60)
+		rcon.authed.wait(10)
+		if not irc.joined.is_set() or not rcon.authed.is_set() or bot.poll() != None:
+			print('Bot did not come up, see ' + logfile)
+			options.keep = True
+			return 1
+		# Give the UDP socket bind a moment too
+		time.sleep(0.5)
+
+		print('%-10s %8s %8s %8s %10s %10s %10s' % ('direction', 'rate', 'sent', 'relayed', 'msg/s', 'p50 ms', 'p99 ms'))
+		nextid = 0
+		for rate in rates:
+			for name, sendone in [('irc->mc', irc.sendone), ('mc->irc', udp.sendone)]:
+				sent, got, mps, p50, p99, nextid = runphase(track, sendone, rate, options.duration, nextid, max(2.0, options.duration))
+				print('%-10s %8d %8d %8d %10.1f %10.2f %10.2f' % (name, rate, sent, got, mps, p50 * 1000, p99 * 1000))
+				sys.stdout.flush()
+	finally:
+		if bot.poll() == None:
+			# The worker supervisor shuts down on SIGTERM, a single bot on Ctrl+C
+			if options.workers > 0:
+				bot.send_signal(signal.SIGTERM)
+			else:
+				bot.send_signal(signal.SIGINT)
+			end = time.time() + 10
+			while bot.poll() == None and time.time() < end:
+				time.sleep(0.1)
+			if bot.poll() == None:
+				bot.kill()
+		devnull.close()
+		if options.keep:
+			print('Config and log kept in ' + tmpdir)
+		else:
+			shutil.rmtree(tmpdir, True)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, bench/bench_timers.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the cost of the ping timer reset done by irc.client._checkping
+# on every read, for sched.scheduler and core.scheduler, as the number of
+# clients (and so pending timers) grows.
+#
+# Usage: python bench/bench_timers.py [reads]
+
+import sys, os, time, sched, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import core.scheduler as scheduler
+
+def _noop():
+	return
+
+def _sched_checkping(s, ev):
+	# What _deltimer/_addtimer did with sched.scheduler
+	if ev in s.queue:
+		s.cancel(ev)
+	return s.enter(120, 100, _noop, ())
+
+def _core_checkping(s, ev):
+	s.cancel(ev)
+	return s.enter(120, 100, _noop, ())
+
+def run(clients, reads, sch, checkping):
+	# Every client holds a ping timer plus a couple of other long lived timers
+	evs = []
+	for i in range(clients):
+		evs.append(sch.enter(120, 100, _noop, ()))
+		sch.enter(30 + i, 100, _noop, ())
+		sch.enter(3600, 100, _noop, ())
+
+	rnd = random.Random(clients)
+	order = [rnd.randrange(clients) for i in range(reads)]
+
+	start = time.time()
+	for i in order:
+		evs[i] = checkping(sch, evs[i])
+	return (time.time() - start) / reads
+
+def main():
+	reads = 2000
+	if len(sys.argv) > 1:
+		reads = int(sys.argv[1])
+
+	print('%8s %18s %18s' % ('clients', 'sched us/read', 'core us/read'))
+	for clients in [10, 100, 500, 1000, 2500, 5000]:
+		# sched.scheduler gets slow quickly, keep its run time bounded
+		sreads = max(50, min(reads, int(reads * 100 / clients)))
+		told = run(clients, sreads, sched.scheduler(time.time, time.sleep), _sched_checkping)
+		tnew = run(clients, reads, scheduler.scheduler(), _core_checkping)
+		print('%8d %18.2f %18.2f' % (clients, told * 1e6, tnew * 1e6))
+
+if __name__ == '__main__':
+	main()
@@ -19,12 +19,23 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
+import signal
 from xml.etree.ElementTree import ElementTree
 
 import core.rblogging as rblogging
+import core.resolver as resolver
+import core.stats as stats
+import core.trace as trace
+import core.relay as relay
 import core.modules as modules
 
+configfile = 'config/config.xml'
+_reloadrequested = False
+
 def loadconfig(timers, file = 'config/config.xml'):
+	global configfile
+
+	configfile = file
 	try:
 		tree = ElementTree()
 		doc = tree.parse(file)
@@ -33,6 +44,14 @@ def loadconfig(timers, file = 'config/config.xml'):
 
 		rblogging.runconfig()
 
+		resolver.loadconfig(doc)
+
+		stats.loadconfig(doc)
+
+		trace.loadconfig(doc)
+
+		relay.loadconfig(doc)
+
 		modules.loadconfig(doc)
 	except Exception as e:
 		rblogging.log.error("Error parsing config: " + str(e))
@@ -41,3 +60,70 @@ def loadconfig(timers, file = 'config/config.xml'):
 		modules.runconfig(timers)
 	except Exception as e:
 		rblogging.log.error("Error loading config: " + str(e))
+
+# Re-reads the config file and applies only what changed, connections that
+# are not affected stay up
+def reloadconfig(timers, file = None):
+	global configfile
+
+	if file == None:
+		file = configfile
+	rblogging.log.info('Reloading config from ' + file)
+
+	try:
+		tree = ElementTree()
+		doc = tree.parse(file)
+	except Exception as e:
+		rblogging.log.error("Error parsing config, keeping current config: " + str(e))
+		return False
+
+	# Everything is parsed before anything is applied, so an error anywhere
+	# in the new config leaves the running one as it was
+	try:
+		logconf = rblogging.parseconfig(doc)
+
+		resconf = resolver.parseconfig(doc)
+
+		statconf = stats.parseconfig(doc)
+
+		traceconf = trace.parseconfig(doc)
+
+		loopconf = relay.parseconfig(doc)
+
+		modconfs = modules.parseconfig(doc)
+	except Exception as e:
+		rblogging.log.error("Error parsing config, keeping current config: " + str(e))
+		return False
+
+	try:
+		rblogging.applyconfig(logconf)
+
+		resolver.applyconfig(resconf)
+
+		stats.applyconfig(statconf)
+
+		trace.applyconfig(traceconf)
+
+		relay.applyconfig(loopconf)
+
+		modules.applyconfig(modconfs, timers)
+	except Exception as e:
+		rblogging.log.error("Error reloading config: " + str(e))
+		return False
+
+	return True
+
+def _dosighup(signum, frame):
+	global _reloadrequested
+	# Only flag it, the run loop reloads once the current callback is done
+	_reloadrequested = True
+
+def installreload():
+	signal.signal(signal.SIGHUP, _dosighup)
+
+def checkreload(timers):
+	global _reloadrequested
+
+	if _reloadrequested:
+		_reloadrequested = False
+		reloadconfig(timers)
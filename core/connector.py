@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/connector.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket, ssl, errno, time
+
+from core.rblogging import *
+import core.rbsocket as rbsocket
+import core.resolver as resolver
+
+# Connection setup phases, each has its own timeout
+CONN_IDLE = 0
+CONN_RESOLVING = 1
+CONN_CONNECTING = 2
+CONN_TLS = 3
+CONN_REGISTERING = 4
+CONN_READY = 5
+
+statenames = {CONN_IDLE: 'idle', CONN_RESOLVING: 'resolving', CONN_CONNECTING: 'connecting',
+		CONN_TLS: 'tls', CONN_REGISTERING: 'registering', CONN_READY: 'ready'}
+
+deftimeouts = {CONN_RESOLVING: 30, CONN_CONNECTING: 15, CONN_TLS: 15, CONN_REGISTERING: 60}
+
+# Drives a TCP connection from host name to a registered session without
+# blocking the run loop. Once the socket is connected (and TLS is done)
+# onconnect(sock) hands it to the owner, which binds its own socket
+# callbacks and calls ready() when its protocol level login has finished.
+# Any failure or phase timeout before then calls onfail(reason), sockets
+# the owner has not been given yet are closed first.
+class connector:
+	def __init__(self, obj, host, port, schedobj, usessl=False, onconnect=None, onfail=None,
+			timeouts=None, schedpri=100, logprefix=''):
+		self._obj = obj
+		self._host = host
+		self._port = port
+		self._sched = schedobj
+		self._ssl = usessl
+		self._onconnect = onconnect
+		self._onfail = onfail
+		self._schedpri = schedpri
+		self._logprefix = logprefix
+		self._timeouts = dict(deftimeouts)
+		if timeouts != None:
+			self._timeouts.update(timeouts)
+		self._state = CONN_IDLE
+		self._addrs = []
+		self._sock = None
+		self._timer = None
+		self._lasterr = None
+		self._attempt = 0
+		self._readytime = None
+		self.attempts = 0
+		self.connects = 0
+
+	def state(self):
+		return self._state
+
+	# Seconds since the session became ready, 0 when it isn't
+	def uptime(self):
+		if self._readytime == None:
+			return 0
+		return time.time() - self._readytime
+
+	def statename(self):
+		return statenames[self._state]
+
+	def _setstate(self, state):
+		self._state = state
+		if state != CONN_READY:
+			self._readytime = None
+		self._sched.cancel(self._timer)
+		self._timer = None
+		if state in self._timeouts:
+			self._timer = self._sched.enter(self._timeouts[state], self._schedpri, self._timeout, (state,))
+
+	def _timeout(self, state):
+		self._timer = None
+		if self._state != state:
+			return
+		if state == CONN_CONNECTING:
+			self._lasterr = 'Connection timed out'
+			self._closesock()
+			self._nextaddr()
+			return
+		self._fail('Timed out while ' + statenames[state])
+
+	def _closesock(self):
+		if self._sock == None:
+			return
+		rbsocket.unbindsockcallbacks(self._sock)
+		try:
+			self._sock.close()
+		except:
+			pass
+		self._sock = None
+
+	def _fail(self, reason):
+		self._closesock()
+		self._setstate(CONN_IDLE)
+		if self._onfail != None:
+			self._onfail(reason)
+
+	def start(self):
+		self.abort()
+		self._lasterr = None
+		self._attempt += 1
+		self.attempts += 1
+		self._setstate(CONN_RESOLVING)
+		resolver.resolve(self._host, self._port, 0, 0, socket.IPPROTO_TCP, self._resolved, (self._attempt,))
+
+	def _resolved(self, addrs, err, attempt):
+		# Ignore answers for an attempt that has since been aborted or restarted
+		if self._state != CONN_RESOLVING or attempt != self._attempt:
+			return
+		if err != None:
+			self._lasterr = err
+		if len(addrs) < 1:
+			reason = 'Unable to resolve ' + str(self._host)
+			if self._lasterr != None:
+				reason = reason + ': ' + str(self._lasterr)
+			self._fail(reason)
+			return
+		self._addrs = list(addrs)
+		self._nextaddr()
+
+	def _nextaddr(self):
+		while len(self._addrs) > 0:
+			af, socktype, proto, canonname, sa = self._addrs.pop(0)
+			try:
+				s = rbsocket.rbsocket(af, socktype, proto)
+				s.setblocking(0)
+				err = s.connect_ex(sa)
+			except socket.error as e:
+				self._lasterr = str(e)
+				continue
+			if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+				self._lasterr = errno.errorcode.get(err, str(err))
+				s.close()
+				continue
+
+			log.debug(self._logprefix + 'Connecting to ' + str(sa[0]) + ' port ' + str(sa[1]), self._obj)
+			self._sock = s
+			self._setstate(CONN_CONNECTING)
+			rbsocket.bindsockcallbacks(s, self._dodisconnect, None, self._doready, self._doready)
+			rbsocket.setwantwrite(s, True)
+			return
+
+		reason = 'Unable to connect to ' + str(self._host)
+		if self._lasterr != None:
+			reason = reason + ': ' + str(self._lasterr)
+		self._fail(reason)
+
+	def _doready(self, sock):
+		if sock != self._sock:
+			return
+		if self._state == CONN_CONNECTING:
+			err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if err != 0:
+				self._lasterr = errno.errorcode.get(err, str(err))
+				self._closesock()
+				self._nextaddr()
+				return
+			rbsocket.setwantwrite(sock, False)
+			if self._ssl:
+				self._starttls()
+			else:
+				self._connected()
+		elif self._state == CONN_TLS:
+			self._handshake()
+
+	def _starttls(self):
+		rbsocket.unbindsockcallbacks(self._sock)
+		try:
+			self._sock = ssl.wrap_socket(self._sock, do_handshake_on_connect=False)
+		except Exception as e:
+			self._fail('Error starting ssl: ' + str(e))
+			return
+		self._setstate(CONN_TLS)
+		rbsocket.bindsockcallbacks(self._sock, self._dodisconnect, None, self._doready, self._doready)
+		self._handshake()
+
+	def _handshake(self):
+		try:
+			self._sock.do_handshake()
+		except ssl.SSLError as e:
+			if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+				rbsocket.setwantwrite(self._sock, False)
+				return
+			if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+				rbsocket.setwantwrite(self._sock, True)
+				return
+			self._fail('Error connecting ssl: ' + str(e))
+			return
+		except Exception as e:
+			self._fail('Error connecting ssl: ' + str(e))
+			return
+		rbsocket.setwantwrite(self._sock, False)
+		self._connected()
+
+	def _connected(self):
+		sock = self._sock
+		# The owner binds its own callbacks, the socket stays registered
+		self._sock = None
+		self._setstate(CONN_REGISTERING)
+		if self._onconnect != None:
+			self._onconnect(sock)
+
+	def _dodisconnect(self, sock, msg):
+		self.abort()
+
+	def ready(self):
+		if self._state == CONN_REGISTERING:
+			self._setstate(CONN_READY)
+			self._readytime = time.time()
+			self.connects += 1
+
+	def abort(self):
+		self._closesock()
+		self._addrs = []
+		self._setstate(CONN_IDLE)
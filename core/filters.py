@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/filters.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from core.rblogging import *
+import core.relay as relay
+
+actions = ['match', 'block', 'rewrite']
+
+# Patterns using back references (their group numbers change) or inline
+# flags (they would apply to every rule) can't go in the combined pattern
+_nojoinreg = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+# Reads the <filter type="regex" match="..." action="..." replace="..." />
+# elements of a relay config element into a list of (match, action, replace)
+def parseconfig(elem):
+	rules = []
+	for filt in elem.findall('./filter'):
+		if not 'type' in filt.attrib or filt.attrib['type'].lower() != 'regex':
+			continue
+		if not 'match' in filt.attrib:
+			log.error('Regex filter missing match attribute')
+			raise Exception('Regex filter missing match attribute')
+		match = filt.attrib['match']
+		action = 'match'
+		if 'action' in filt.attrib:
+			action = filt.attrib['action'].lower()
+		if not action in actions:
+			log.error('Invalid regex filter action: ' + action)
+			raise Exception('Invalid regex filter action: ' + action)
+		replace = None
+		if 'replace' in filt.attrib:
+			replace = filt.attrib['replace']
+		if action == 'rewrite' and replace == None:
+			log.error('Regex filter with rewrite action missing replace attribute')
+			raise Exception('Regex filter with rewrite action missing replace attribute')
+		try:
+			re.compile(match)
+		except re.error as e:
+			log.error('Invalid regex filter match ' + match + ': ' + str(e))
+			raise Exception('Invalid regex filter match ' + match + ': ' + str(e))
+		rules.append((match, action, replace))
+	return rules
+
+# All the regex rules of one relay as a single filter. The rules are also
+# joined into one unanchored pattern, a single search with it tells whether
+# any rule matches at all. Most text matches none and is done with after
+# that one pass, only text that hits something is tested rule by rule to
+# find the first (in config order) that matches.
+#
+# The first matching rule decides: 'block' drops the message, 'match' lets
+# it through and 'rewrite' lets it through with the rule's matches replaced.
+# When no rule matches the message is let through unless there are 'match'
+# rules, which make the list a whitelist, then it is left to the relay's
+# other filters.
+class regexfilter:
+	def __init__(self, rules):
+		self.rules = list(rules)
+		self._regs = [re.compile(rule[0]) for rule in self.rules]
+		self._whitelist = False
+		for rule in self.rules:
+			if rule[1] == 'match':
+				self._whitelist = True
+		self._combined = None
+		if len(self.rules) > 1:
+			canjoin = True
+			for rule in self.rules:
+				if _nojoinreg.search(rule[0]) != None:
+					canjoin = False
+			if canjoin:
+				try:
+					self._combined = re.compile('|'.join(['(?:' + rule[0] + ')' for rule in self.rules]))
+				except re.error as e:
+					# Clashing group names or too many groups, test them one by one
+					log.debug('Unable to combine regex filters, testing separately: ' + str(e))
+					self._combined = None
+
+	def _find(self, text):
+		if self._combined != None and self._combined.search(text) == None:
+			return None
+		for i in range(len(self._regs)):
+			if self._regs[i].search(text) != None:
+				return i
+		return None
+
+	# Returns (result, rewritten text or None) for text
+	def _apply(self, text):
+		i = self._find(text)
+		if i == None:
+			if self._whitelist:
+				return relay.FILTER_NOMATCH, None
+			return relay.FILTER_MATCH, None
+		match, action, replace = self.rules[i]
+		if action == 'block':
+			return relay.FILTER_BLOCK, None
+		if action == 'rewrite':
+			return relay.FILTER_MATCH, self._regs[i].sub(replace, text)
+		return relay.FILTER_MATCH, None
+
+	def filter(self, data):
+		# Only text already made by the relay source or earlier filters is seen
+		if data.text == None:
+			return relay.FILTER_NOMATCH, None
+		# Targets of one event with the same prefix share the result
+		res, text = relay.cached((self, data.text), self._apply, data.text)
+		if res != relay.FILTER_MATCH:
+			return res, None
+		if text != None:
+			return res, data._replace(text=text)
+		return res, data
+
+	def __repr__(self):
+		return 'regexfilter(' + repr(self.rules) + ')'
+
+# Returns the filter list for a relay with just the regex rules, or None
+def chain(rules):
+	if rules == None or len(rules) < 1:
+		return None
+	return [regexfilter(rules)]
@@ -31,6 +31,14 @@ def load(name):
 	if name in mods:
 		log.warn('Unable to load module ' + name + ': already loaded')
 		return False
+	m = _import(name)
+	if m != None:
+		mods[name] = m
+		return True
+	return False
+
+# Imports a module without adding it to mods, None if it can't be
+def _import(name):
 	try:
 		m = __import__('modules.' + name)
 		if hasattr(m, name):
@@ -38,11 +46,7 @@ def load(name):
 	except Exception as e:
 		log.error('Error loading module ' + name + ': ' + str(e))
 		m = None
-
-	if m != None:
-		mods[name] = m
-		return True
-	return False
+	return m
 
 def getsockets():
 	global mods
@@ -76,3 +80,64 @@ def runconfig(timers):
 	for name in mods:
 		if hasattr(mods[name], 'runconfig'):
 			mods[name].runconfig(timers)
+
+# Re-reads the module config from doc without restarting anything that has
+# not changed. Modules that support it provide parseconfig(doc), returning
+# their parsed config, and reloadconfig(config, timers) to apply it.
+def reloadconfig(doc, timers):
+	applyconfig(parseconfig(doc), timers)
+
+# Parses the config of every module listed in doc, including ones not
+# loaded yet (which are imported but not started), and changes nothing. An
+# error in any of them raises before applyconfig() is reached.
+def parseconfig(doc):
+	names = []
+	for mod in doc.findall('./module'):
+		if not 'name' in mod.attrib:
+			log.error('Module config missing module name')
+			raise Exception('Module config missing module name')
+		names.append(mod.attrib['name'])
+
+	# name -> (module, parsed config or None if it has no parseconfig)
+	added = {}
+	for name in names:
+		if not name in mods and not name in added:
+			m = _import(name)
+			if m == None:
+				continue
+			conf = None
+			if hasattr(m, 'parseconfig'):
+				conf = m.parseconfig(doc)
+			added[name] = (m, conf)
+
+	confs = {}
+	for name in mods:
+		if not hasattr(mods[name], 'parseconfig'):
+			continue
+		if name in names:
+			confs[name] = mods[name].parseconfig(doc)
+		else:
+			# Module dropped from the config, stop all of its clients
+			confs[name] = {}
+
+	return (doc, added, confs)
+
+def applyconfig(parsed, timers):
+	global mods
+
+	doc, added, confs = parsed
+
+	for name in confs:
+		mods[name].reloadconfig(confs[name], timers)
+
+	for name in added:
+		m, conf = added[name]
+		mods[name] = m
+		if hasattr(m, 'parseconfig') and hasattr(m, 'reloadconfig'):
+			# Starts every client, the module has none yet
+			m.reloadconfig(conf, timers)
+			continue
+		if hasattr(m, 'loadconfig'):
+			m.loadconfig(doc)
+		if hasattr(m, 'runconfig'):
+			m.runconfig(timers)
@@ -103,14 +103,17 @@ class MyLogger(logging.Logger):
 
 def loadconfig(doc):
 	global configs
-	global levels
 
+	configs = parseconfig(doc)
+
+# The logging config from doc, nothing is changed until applyconfig()
+def parseconfig(doc):
 	configs = {'outputs': []}
 
 	logconfs = doc.findall('./logging')
 
 	if len(logconfs) < 1:
-		return
+		return configs
 
 	logconf = logconfs[0]
 
@@ -148,11 +151,28 @@ def loadconfig(doc):
 
 		configs['outputs'].append(outconf)
 
+	return configs
+
+def applyconfig(newconfigs):
+	global configs
+
+	configs = newconfigs
+	runconfig()
+
 def runconfig():
 	global configs
 	global log
 	global levels
 	global defloghandler
+	global loghandlers
+
+	# Drop outputs from an earlier config before adding the new ones
+	for loghandler in loghandlers:
+		log.removeHandler(loghandler)
+		loghandler.close()
+	loghandlers = []
+	if not defloghandler in log.handlers:
+		log.addHandler(defloghandler)
 
 	i = 0
 
@@ -173,6 +193,7 @@ def runconfig():
 
 		loghandler.setLevel(levels[outconf['level']])
 		log.addHandler(loghandler)
+		loghandlers.append(loghandler)
 		i += 1
 
 	if i > 0:
@@ -185,6 +206,8 @@ logging.setLoggerClass(MyLogger)
 log = logging.getLogger('relaybot')
 log.setLevel(logging.DEBUG)
 
+loghandlers = []
+
 defloghandler = logging.StreamHandler(sys.stderr)
 deflogformatter = UTCFormatter('[%(asctime)s] [%(modname)s/%(levelname)s] %(message)s', '%Y-%m-%d %H:%M:%S')
 defloghandler.setFormatter(deflogformatter)
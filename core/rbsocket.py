@@ -19,14 +19,200 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-import socket
+import socket, select, errno, ssl
+from struct import calcsize, unpack_from
 
 from core.rblogging import *
-from collections import namedtuple
+import core.stats as stats
+from collections import namedtuple, deque
 
-SockCallbacks = namedtuple('SockCallbacks', ['dodisconnect', 'doerr', 'doread'])
+SockCallbacks = namedtuple('SockCallbacks', ['dodisconnect', 'doerr', 'doread', 'dowrite'])
+
+# Readiness flags handed back by poll()
+EV_READ = 1
+EV_ERR = 2
+EV_WRITE = 4
 
 socks = {}
+fds = {}
+sockfds = {}
+poller = None
+
+class epollpoller:
+	def __init__(self):
+		self._ep = select.epoll()
+
+	def _mask(self, write):
+		mask = select.EPOLLIN | select.EPOLLPRI
+		if write:
+			mask |= select.EPOLLOUT
+		return mask
+
+	def register(self, fd, write=False):
+		self._ep.register(fd, self._mask(write))
+
+	def modify(self, fd, write=False):
+		self._ep.modify(fd, self._mask(write))
+
+	def unregister(self, fd):
+		try:
+			self._ep.unregister(fd)
+		except (IOError, OSError, ValueError):
+			# Already closed, the kernel drops closed fds from the set itself
+			pass
+
+	def poll(self, timeout):
+		if timeout == None:
+			timeout = -1
+		ret = []
+		for fd, ev in self._ep.poll(timeout):
+			flags = 0
+			if ev & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+				flags |= EV_READ
+			if ev & select.EPOLLPRI:
+				flags |= EV_ERR
+			if ev & select.EPOLLOUT:
+				flags |= EV_WRITE
+			ret.append((fd, flags))
+		return ret
+
+class pollpoller:
+	def __init__(self):
+		self._p = select.poll()
+
+	def _mask(self, write):
+		mask = select.POLLIN | select.POLLPRI
+		if write:
+			mask |= select.POLLOUT
+		return mask
+
+	def register(self, fd, write=False):
+		self._p.register(fd, self._mask(write))
+
+	def modify(self, fd, write=False):
+		self._p.modify(fd, self._mask(write))
+
+	def unregister(self, fd):
+		try:
+			self._p.unregister(fd)
+		except KeyError:
+			pass
+
+	def poll(self, timeout):
+		if timeout != None:
+			timeout = timeout * 1000
+		ret = []
+		for fd, ev in self._p.poll(timeout):
+			flags = 0
+			if ev & (select.POLLIN | select.POLLHUP | select.POLLERR | select.POLLNVAL):
+				flags |= EV_READ
+			if ev & select.POLLPRI:
+				flags |= EV_ERR
+			if ev & select.POLLOUT:
+				flags |= EV_WRITE
+			ret.append((fd, flags))
+		return ret
+
+class selectpoller:
+	def __init__(self):
+		self._fds = []
+		self._wfds = []
+
+	def register(self, fd, write=False):
+		if not fd in self._fds:
+			self._fds.append(fd)
+		self.modify(fd, write)
+
+	def modify(self, fd, write=False):
+		if write and not fd in self._wfds:
+			self._wfds.append(fd)
+		elif not write and fd in self._wfds:
+			self._wfds.remove(fd)
+
+	def unregister(self, fd):
+		if fd in self._fds:
+			self._fds.remove(fd)
+		if fd in self._wfds:
+			self._wfds.remove(fd)
+
+	def poll(self, timeout):
+		selread, selwrite, selerr = select.select(self._fds, self._wfds, self._fds, timeout)
+		ret = {}
+		for fd in selerr:
+			ret[fd] = EV_ERR
+		for fd in selread:
+			ret[fd] = ret.get(fd, 0) | EV_READ
+		for fd in selwrite:
+			ret[fd] = ret.get(fd, 0) | EV_WRITE
+		return ret.items()
+
+def _getpoller():
+	global poller
+
+	if poller == None:
+		if hasattr(select, 'epoll'):
+			poller = epollpoller()
+		elif hasattr(select, 'poll'):
+			poller = pollpoller()
+		else:
+			poller = selectpoller()
+	return poller
+
+def _register(sock):
+	global fds, sockfds
+
+	if sock in sockfds:
+		return
+	fd = sock.fileno()
+	if fd in fds:
+		_unregister(fds[fd])
+	fds[fd] = sock
+	sockfds[sock] = fd
+	_getpoller().register(fd)
+
+def _unregister(sock):
+	global fds, sockfds
+
+	if not sock in sockfds:
+		return
+	fd = sockfds.pop(sock)
+	if fds.get(fd) is sock:
+		del fds[fd]
+		_getpoller().unregister(fd)
+
+def setwantwrite(sock, want):
+	global sockfds
+
+	if sock in sockfds:
+		_getpoller().modify(sockfds[sock], want)
+
+def wouldblock(e):
+	if isinstance(e, ssl.SSLError):
+		return e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+	return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def poll(timeout):
+	global fds
+
+	try:
+		events = _getpoller().poll(timeout)
+	except (select.error, IOError, OSError) as e:
+		if e.args[0] == errno.EINTR:
+			return []
+		raise
+	return [(fds[fd], flags) for fd, flags in events if fd in fds]
+
+def dispatch(events):
+	global sockfds
+
+	for sock, flags in events:
+		# An earlier callback in this batch may have closed or replaced the socket
+		if flags & EV_ERR and sock in sockfds:
+			doerr(sock)
+		if flags & EV_WRITE and sock in sockfds:
+			dowrite(sock)
+		if flags & EV_READ and sock in sockfds:
+			doread(sock)
 
 def dodisconnect(sock, msg = None):
 	global socks
@@ -49,26 +235,44 @@ def doerr(sock):
 def doread(sock):
 	global socks
 
-	if hasattr(sock, 'doread'):
-		sock.doread()
+	if isinstance(sock, rbsocket):
+		func = sock._doread
+	elif sock in socks:
+		func = socks[sock].doread
+	else:
+		return
+	if func != None:
+		stats.timecall('doread', func, (sock,))
+
+def dowrite(sock):
+	global socks
+
+	if isinstance(sock, rbsocket):
+		func = sock._dowrite
 	elif sock in socks:
-		if socks[sock].doread != None:
-			socks[sock].doread(sock)
+		func = socks[sock].dowrite
+	else:
+		return
+	if func != None:
+		stats.timecall('dowrite', func, (sock,))
 
-def bindsockcallbacks(sock, dodisconnect=None, doerr=None, doread=None):
+def bindsockcallbacks(sock, dodisconnect=None, doerr=None, doread=None, dowrite=None):
 	global socks
 
 	if isinstance(sock, rbsocket):
 		sock.setdoread(doread)
 		sock.setdoerr(doerr)
 		sock.setdodisconnect(dodisconnect)
+		sock.setdowrite(dowrite)
 	else:
-		sockcalls = SockCallbacks(dodisconnect, doerr, doread)
+		sockcalls = SockCallbacks(dodisconnect, doerr, doread, dowrite)
 		socks[sock] = sockcalls
+	_register(sock)
 
 def unbindsockcallbacks(sock):
 	global socks
 
+	_unregister(sock)
 	if sock in socks:
 		socks.pop(sock)
 
@@ -77,6 +281,7 @@ class rbsocket(socket.socket):
 		self._doread = None
 		self._doerr = None
 		self._dodisconnect = None
+		self._dowrite = None
 		super( rbsocket, self ).__init__(*p, **d)
 
 	def doread(self):
@@ -91,6 +296,10 @@ class rbsocket(socket.socket):
 		if self._dodisconnect != None:
 			self._dodisconnect(self, msg)
 
+	def dowrite(self):
+		if self._dowrite != None:
+			self._dowrite(self)
+
 	def setdoread(self, func):
 		self._doread = func
 
@@ -99,3 +308,187 @@ class rbsocket(socket.socket):
 
 	def setdodisconnect(self, func):
 		self._dodisconnect = func
+
+	def setdowrite(self, func):
+		self._dowrite = func
+
+# Outbound byte queue for a non-blocking socket. write() sends as much as
+# the socket will take straight away and keeps the rest, asking the reactor
+# for writability until flush() has drained it. onhigh(queue) is called once
+# the queued byte count reaches highwater and onlow(queue) once it falls back
+# to lowwater. Socket errors other than EAGAIN are raised to the caller.
+class sendqueue:
+
+	# Small queued writes are joined into sends of up to this size
+	coalesce = 65536
+
+	def __init__(self, sock, highwater=262144, lowwater=65536, onhigh=None, onlow=None):
+		self.sock = sock
+		self.highwater = highwater
+		self.lowwater = lowwater
+		self._onhigh = onhigh
+		self._onlow = onlow
+		self._bufs = deque()
+		self._size = 0
+		self._high = False
+		self._wantwrite = False
+
+	def pending(self):
+		return self._size
+
+	def abovehigh(self):
+		return self._high
+
+	def write(self, data):
+		if data == None or len(data) == 0:
+			return
+		self._bufs.append(data)
+		self._size += len(data)
+		if not self._wantwrite:
+			self.flush()
+		if not self._high and self._size >= self.highwater:
+			self._high = True
+			if self._onhigh != None:
+				self._onhigh(self)
+
+	def flush(self):
+		bufs = self._bufs
+		while bufs:
+			data = bufs[0]
+			if len(bufs) > 1 and len(data) < self.coalesce:
+				parts = [bufs.popleft()]
+				n = len(data)
+				while bufs and n + len(bufs[0]) <= self.coalesce:
+					n += len(bufs[0])
+					parts.append(bufs.popleft())
+				data = ''.join(parts)
+				bufs.appendleft(data)
+			try:
+				sent = self.sock.send(data)
+			except socket.error as e:
+				if not wouldblock(e):
+					raise
+				sent = 0
+			if sent <= 0:
+				break
+			self._size -= sent
+			if sent < len(data):
+				bufs[0] = data[sent:]
+				break
+			bufs.popleft()
+
+		want = len(bufs) > 0
+		if want != self._wantwrite:
+			self._wantwrite = want
+			setwantwrite(self.sock, want)
+
+		if self._high and self._size <= self.lowwater:
+			self._high = False
+			if self._onlow != None:
+				self._onlow(self)
+
+# Inbound buffer for a non-blocking stream socket. fill() reads with
+# recv_into() straight into a bytearray that is kept between reads, lines()
+# and frames() then cut whole lines or length prefixed frames out of it.
+# What is left of a partial line or frame stays where it is, it is only
+# moved to the front (or the buffer grown) once there isn't room for
+# another readsize bytes behind it.
+class streamreader:
+	def __init__(self, sock, readsize=16384):
+		self.sock = sock
+		self.readsize = readsize
+		self._buf = bytearray(readsize * 2)
+		self._start = 0
+		self._end = 0
+
+	def pending(self):
+		return self._end - self._start
+
+	def _makeroom(self):
+		n = self._end - self._start
+		if n + self.readsize > len(self._buf):
+			buf = bytearray(max(len(self._buf) * 2, n + self.readsize))
+			buf[0:n] = self._buf[self._start:self._end]
+			self._buf = buf
+		elif self._start > 0:
+			self._buf[0:n] = self._buf[self._start:self._end]
+		self._start = 0
+		self._end = n
+
+	# Reads what has arrived. Returns the number of bytes read, 0 when the
+	# other end has closed the connection or None when there was nothing to
+	# read. Other socket errors are raised to the caller.
+	def fill(self):
+		total = 0
+		while True:
+			if len(self._buf) - self._end < self.readsize:
+				self._makeroom()
+			try:
+				n = self.sock.recv_into(memoryview(self._buf)[self._end:], self.readsize)
+			except socket.error as e:
+				if not wouldblock(e):
+					raise
+				if total > 0:
+					return total
+				return None
+			if n == 0:
+				return total
+			self._end += n
+			total += n
+			# SSL may have already decrypted more than was asked for, poll
+			# won't report it as readable
+			if not hasattr(self.sock, 'pending') or self.sock.pending() < 1:
+				return total
+
+	# Takes every complete line, without its line ending. A lone '\r' also
+	# ends a line.
+	def lines(self):
+		ret = []
+		buf = self._buf
+		start = self._start
+		end = self._end
+		view = memoryview(buf)
+		while start < end:
+			i = buf.find('\n', start, end)
+			if i < 0:
+				break
+			line = view[start:i].tobytes()
+			start = i + 1
+			if '\r' in line:
+				ret.extend(line.rstrip('\r').split('\r'))
+			else:
+				ret.append(line)
+		if start < end and buf.find('\r', start, end) >= 0:
+			# Only lone '\r's in what is left, those lines are complete too
+			i = buf.rfind('\r', start, end)
+			ret.extend(view[start:i].tobytes().split('\r'))
+			start = i + 1
+		if start >= end:
+			start = end = 0
+		self._start = start
+		self._end = end
+		return ret
+
+	# Takes every complete frame that starts with its length packed as
+	# header (not counting the header itself), without the header. Raises
+	# ValueError for a negative length.
+	def frames(self, header='<i'):
+		ret = []
+		hsize = calcsize(header)
+		buf = self._buf
+		start = self._start
+		end = self._end
+		view = memoryview(buf)
+		while end - start >= hsize:
+			size = unpack_from(header, buf, start)[0]
+			if size < 0:
+				raise ValueError('Invalid frame length ' + str(size))
+			if end - start < hsize + size:
+				break
+			ret.append(view[start + hsize:start + hsize + size].tobytes())
+			start += hsize + size
+		if start >= end:
+			start = end = 0
+		self._start = start
+		self._end = end
+		return ret
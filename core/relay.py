@@ -19,10 +19,14 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys
-from collections import namedtuple
+import sys, re, time
+from collections import namedtuple, deque
 
 from core.rblogging import *
+import core.shard as shard
+import core.stats as stats
+import core.trace as trace
+import core.spool as spool
 
 # Filter does not match message, message should only be relayed if another filter matches
 FILTER_NOMATCH = 0
@@ -31,17 +35,402 @@ FILTER_MATCH = 1
 # Filter matches message but message should not be relayed at all
 FILTER_BLOCK = 2
 
+# Defaults for the per target relay queues
+QUEUE_SIZE = 1000
+QUEUE_POLICY = 'drop-oldest'
+queuepolicies = ['drop-oldest', 'drop-newest', 'coalesce']
+# Queued relays are handed to the target this many at a time when flushing
+QUEUE_FLUSHBATCH = 100
+
+# Loop suppression, a message is dropped when the same text from the same
+# speaker was delivered to the same target channel less than 'window'
+# seconds ago (up to 'size' remembered) or it has been relayed on by more
+# than 'hops' relays in this bot. A window of 0 turns the duplicate check off.
+defloopconfigs = {'window': 5, 'size': 4096, 'hops': 4}
+loopconfigs = dict(defloopconfigs)
+
 relaybindings = []
-RelayBinding = namedtuple('RelayBinding', ['type', 'name', 'callback'])
+# (type, name) -> relayroute, its callbacks are rebuilt by bind() and unbind()
+# so a relay is delivered with a single lookup
+relayroutes = {}
+RelayBinding = namedtuple('RelayBinding', ['type', 'name', 'callback', 'batchcallback'])
 RelayTarget = namedtuple('RelayTarget', ['type', 'name', 'channel', 'extra', 'filters'])
 RelaySource = namedtuple('RelaySource', ['type', 'name', 'channel', 'extra'])
 RelayData = namedtuple('RelayData', ['text', 'source', 'target', 'extra'])
+# (type, name) -> relayqueue, for targets that said when they can take relays
+relayqueues = {}
+
+_relaysin = stats.metric('relaybot_relays_in_total', 'counter', 'Messages relayed from each source, counted once per target',
+		('module', 'client', 'channel'))
+_relaysout = stats.metric('relaybot_relays_out_total', 'counter', 'Messages handed to each target',
+		('module', 'client', 'channel'))
+_filtermetric = stats.metric('relaybot_filter_results_total', 'counter', 'Filter results by filter type',
+		('filter', 'result'))
+_filterresults = {FILTER_NOMATCH: 'nomatch', FILTER_MATCH: 'match', FILTER_BLOCK: 'block'}
+_filterseries = {}
+# fingerprint -> time last delivered, with (time, fingerprint) in delivery
+# order so the oldest can be expired from the front
+_seen = {}
+_seenorder = deque()
+
+# Results shared by every target of the event being relayed, see cached()
+_eventcache = None
+_eventdepth = 0
+
+# IRC and Minecraft formatting codes
+_fmtreg = re.compile(u'\x03(?:\\d{1,2}(?:,\\d{1,2})?)?|[\x02\x0f\x11\x16\x1d\x1e\x1f]|\xa7.')
+# Relay prefixes and <nick> tags at the start of a message
+_tagreg = re.compile(u'^\\s*(\\[[^\\]]*\\]|<[^>]*>)\\s*')
+
+def loadconfig(doc):
+	applyconfig(parseconfig(doc))
+
+# The <loops> config from doc, applied by applyconfig()
+def parseconfig(doc):
+	loopconfigs = dict(defloopconfigs)
+	loopconfs = doc.findall('./loops')
+
+	if len(loopconfs) < 1:
+		return loopconfigs
+
+	for key in ['window', 'size', 'hops']:
+		if not key in loopconfs[0].attrib:
+			continue
+		try:
+			loopconfigs[key] = int(loopconfs[0].attrib[key])
+		except ValueError:
+			loopconfigs[key] = -1
+		if loopconfigs[key] < 0:
+			log.error('Invalid loops ' + key + ' attribute: ' + loopconfs[0].attrib[key])
+			raise Exception('Invalid loops ' + key + ' attribute: ' + loopconfs[0].attrib[key])
+	return loopconfigs
+
+def applyconfig(newconfigs):
+	global loopconfigs
+
+	loopconfigs = newconfigs
+
+# Text as seen by a person, without formatting, case, extra spaces or the
+# prefixes added by relays along the way. Only the innermost <nick> is kept
+# so the same line relayed back through other bots looks the same.
+def _normalize(text):
+	if isinstance(text, str):
+		text = text.decode('UTF-8', 'replace')
+	text = _fmtreg.sub(u'', text).lower()
+	speaker = u''
+	m = _tagreg.match(text)
+	while m != None:
+		if m.group(1)[0] == u'<':
+			speaker = m.group(1)
+		text = text[m.end():]
+		m = _tagreg.match(text)
+	return speaker + u' ' + u' '.join(text.split())
+
+# True if data is a repeat of something recently delivered to its target
+def _isrepeat(data):
+	global _seen, _seenorder
+
+	window = loopconfigs['window']
+	# Replies to a relay are limited by their hop count instead, the same
+	# answer to the same question is fine
+	if window <= 0 or data.text == None or data.extra.get('hops', 0) > 0:
+		return False
+	now = time.time()
+	while len(_seenorder) > 0 and (_seenorder[0][0] <= now - window or len(_seenorder) > loopconfigs['size']):
+		ts, key = _seenorder.popleft()
+		if _seen.get(key) == ts:
+			del _seen[key]
+	target = data.target
+	channel = target.channel
+	if channel != None:
+		channel = channel.lower()
+	key = (target.type, target.name, channel, _normalize(data.text))
+	if key in _seen:
+		return True
+	_seen[key] = now
+	_seenorder.append((now, key))
+	return False
+
+# Sources call startevent() before relaying an event (or a batch of them) to
+# all of its targets and endevent() once done, so filters can use cached()
+# for work that comes out the same for every target
+def startevent():
+	global _eventcache, _eventdepth
+
+	if _eventdepth == 0:
+		_eventcache = {}
+	_eventdepth += 1
+
+def endevent():
+	global _eventcache, _eventdepth
+
+	_eventdepth -= 1
+	if _eventdepth <= 0:
+		_eventdepth = 0
+		_eventcache = None
+
+# Returns func(*args), only worked out once per key while an event is being
+# relayed. Keys are made of the event (such as its source object), the
+# filter and the variant of the result.
+def cached(key, func, *args):
+	if _eventcache == None:
+		return func(*args)
+	try:
+		return _eventcache[key]
+	except KeyError:
+		ret = _eventcache[key] = func(*args)
+		return ret
+
+# Extra for a relay sent in reply to data, carrying its hop count on
+def nexthop(data, extra={}):
+	ret = dict(extra)
+	ret['hops'] = data.extra.get('hops', 0) + 1
+	return ret
+
+# Bounded queue of relays for one target. While the target isn't ready (not
+# connected, or its send queue is above the high watermark) relays are held
+# here and flushed in order once it is. When the queue is full the policy
+# picks what goes: drop-oldest and drop-newest drop that message, coalesce
+# drops the oldest and relays a single count of the skipped messages to
+# their channel in their place.
+class relayqueue:
+	def __init__(self, type, name, size=QUEUE_SIZE, policy=QUEUE_POLICY):
+		self.type = type
+		self.name = name
+		self.size = size
+		self.policy = policy
+		self.ready = False
+		self.queue = deque()
+		self.skipped = {}
+		self.spool = None
+		self._full = False
+		self._flushing = False
+		tag = type + ':' + name
+		self._counters = ('relay queued ' + tag, 'relay dropped ' + tag, 'relay delivered ' + tag)
+
+	def put(self, data):
+		if 'trace' in data.extra:
+			data.extra['trace'].mark('queued')
+		# With a spool everything goes to disk, the size and policy only
+		# apply to what it can't take
+		if self.spool != None and self.spool.append(data):
+			stats.incr(self._counters[0])
+			return
+		if len(self.queue) >= self.size:
+			if not self._full:
+				self._full = True
+				log.warning('Relay queue for ' + self.type + ':' + self.name + ' full (' + str(self.size) + ' messages), dropping with policy ' + self.policy)
+			if self.policy == 'drop-newest':
+				self.drop(data)
+				return
+			self.drop(self.queue.popleft())
+		self.queue.append(data)
+		stats.incr(self._counters[0])
+
+	def drop(self, data):
+		stats.incr(self._counters[1])
+		if self.policy != 'coalesce' or data.text == None:
+			return
+		chan = data.target.channel
+		if chan in self.skipped:
+			self.skipped[chan][1] += 1
+		else:
+			self.skipped[chan] = [data.target, 1]
+
+	def trim(self):
+		while len(self.queue) > self.size:
+			if self.policy == 'drop-newest':
+				self.drop(self.queue.pop())
+			else:
+				self.drop(self.queue.popleft())
+
+	def clear(self):
+		stats.incr(self._counters[1], len(self.queue))
+		self.queue.clear()
+		self.skipped = {}
+
+	def delivered(self, n):
+		stats.incr(self._counters[2], n)
+
+	# Whether new relays have to wait behind ones already queued or spooled
+	def backlog(self):
+		return len(self.queue) > 0 or (self.spool != None and self.spool.pending > 0)
+
+	# Called by the spool's replay timer, returns whether to keep going
+	def _replay(self, n):
+		if not self.ready or self.spool == None:
+			return False
+		datas = self.spool.read(n)
+		if len(datas) > 0:
+			_dispatch((self.type, self.name), datas)
+		return self.ready and self.spool != None and self.spool.pending > 0
+
+	def flush(self):
+		if self._flushing:
+			return
+		self._flushing = True
+		try:
+			if len(self.skipped) > 0:
+				source = RelaySource('relay', self.type + ':' + self.name, None, {})
+				notices = []
+				for chan in self.skipped:
+					target, n = self.skipped[chan]
+					notices.append(RelayData('(' + str(n) + (' message' if n == 1 else ' messages') + ' not relayed)', source, target, {}))
+				self.skipped = {}
+				self.queue.extendleft(reversed(notices))
+			if len(self.queue) > 0:
+				log.debug('Flushing ' + str(len(self.queue)) + ' queued relays (type:' + self.type + ', name:' + self.name + ')')
+			while self.ready and len(self.queue) > 0:
+				datas = []
+				while len(self.queue) > 0 and len(datas) < QUEUE_FLUSHBATCH:
+					datas.append(self.queue.popleft())
+				_dispatch((self.type, self.name), datas)
+			if len(self.queue) < 1:
+				self._full = False
+			# The spool is replayed at its own pace rather than all at once
+			if self.ready and self.spool != None and self.spool.pending > 0:
+				self.spool.startreplay(self._replay)
+		finally:
+			self._flushing = False
+
+# Reads the optional <queue size="..." policy="..." /> element of a client
+# config element into a dict for setqueue()
+def parsequeueconfig(elem):
+	conf = {'size': QUEUE_SIZE, 'policy': QUEUE_POLICY}
+	queues = elem.findall('./queue')
+	if len(queues) > 1:
+		log.error('Too many relay queue elements')
+		raise Exception('Too many relay queue elements')
+	if len(queues) < 1:
+		return conf
+	if 'size' in queues[0].attrib:
+		try:
+			conf['size'] = int(queues[0].attrib['size'])
+		except ValueError:
+			conf['size'] = 0
+		if conf['size'] < 1:
+			log.error('Invalid relay queue size: ' + queues[0].attrib['size'])
+			raise Exception('Invalid relay queue size: ' + queues[0].attrib['size'])
+	if 'policy' in queues[0].attrib:
+		conf['policy'] = queues[0].attrib['policy'].lower()
+		if not conf['policy'] in queuepolicies:
+			log.error('Invalid relay queue policy: ' + queues[0].attrib['policy'])
+			raise Exception('Invalid relay queue policy: ' + queues[0].attrib['policy'])
+	return conf
+
+def _getqueue(type, name):
+	global relayqueues
+	q = relayqueues.get((type, name))
+	if q == None:
+		q = relayqueues[(type, name)] = relayqueue(type, name)
+	return q
 
-def bind(type, name, callback):
+# Gives a target a relay queue, or changes the size and policy of its queue
+def setqueue(type, name, size=QUEUE_SIZE, policy=QUEUE_POLICY):
+	q = _getqueue(type, name)
+	q.size = size
+	q.policy = policy
+	q.trim()
+
+# Gives a target an on-disk spool (see core.spool) for the relays it can't
+# take, conf is from spool.parseconfig(). A conf of None closes the spool,
+# leaving anything in it on disk for the next time it is opened.
+def setspool(type, name, conf, schedobj):
+	q = _getqueue(type, name)
+	if q.spool != None:
+		if q.spool.conf == conf:
+			return
+		q.spool.close()
+		q.spool = None
+	if conf == None:
+		return
+	s = spool.spool(type, name, conf, schedobj)
+	try:
+		s.open()
+	except (IOError, OSError) as e:
+		log.error('Error opening relay spool ' + s.dir + ', relays will only be queued in memory: ' + str(e))
+		return
+	q.spool = s
+	if q.ready:
+		q.flush()
+
+# Closes every spool so their read positions are saved, for shutting down
+def closespools():
+	for key in relayqueues:
+		q = relayqueues[key]
+		if q.spool != None:
+			q.spool.close()
+			q.spool = None
+
+# Drops a target's relay queue along with anything still in it, a spool is
+# closed with its contents left on disk
+def delqueue(type, name):
+	global relayqueues
+	q = relayqueues.pop((type, name), None)
+	if q == None:
+		return
+	if q.spool != None:
+		q.spool.close()
+		q.spool = None
+	if len(q.queue) > 0:
+		log.info('Dropping ' + str(len(q.queue)) + ' queued relays (type:' + type + ', name:' + name + ')')
+	q.clear()
+
+# Targets call this when they can (ready=True) or can't take relays. Relays
+# for a target that isn't ready are queued, they are flushed once it is.
+def setready(type, name, ready):
+	q = _getqueue(type, name)
+	if q.ready != ready:
+		log.debug('Relay target ' + ('ready' if ready else 'not ready') + ' (type:' + type + ', name:' + name + ')')
+	q.ready = ready
+	if ready:
+		q.flush()
+
+# The callbacks bound to a client and its relay counters, one per channel,
+# looked up once and kept so counting a relay is an attribute update
+class relayroute:
+	def __init__(self, type, name):
+		self.type = type
+		self.name = name
+		self.callbacks = ()
+		self.countsin = {}
+		self.countsout = {}
+
+	def countin(self, channel):
+		s = self.countsin.get(channel)
+		if s == None:
+			s = self.countsin[channel] = _relaysin.labels(self.type, self.name, channel)
+		return s
+
+	def countout(self, channel):
+		s = self.countsout.get(channel)
+		if s == None:
+			s = self.countsout[channel] = _relaysout.labels(self.type, self.name, channel)
+		return s
+
+def _getroute(type, name):
+	global relayroutes
+	r = relayroutes.get((type, name))
+	if r == None:
+		r = relayroutes[(type, name)] = relayroute(type, name)
+	return r
+
+def _compileroute(type, name):
+	global relaybindings
+	r = _getroute(type, name)
+	r.callbacks = tuple([(bind.callback, bind.batchcallback) for bind in relaybindings
+			if bind.type == type and bind.name == name and (bind.callback != None or bind.batchcallback != None)])
+
+# batchcallback, if given, is called with a list of RelayData for messages
+# passed to call_many() (or several relays arriving together from another
+# worker) so they can be sent on together, otherwise callback is called for
+# each one
+def bind(type, name, callback, batchcallback=None):
 	global relaybindings
-	targ = RelayBinding(type, name, callback)
+	targ = RelayBinding(type, name, callback, batchcallback)
 	if not targ in relaybindings:
 		relaybindings.append(targ)
+		_compileroute(type, name)
 		log.debug('Bound relay (type:' + type + ', name:' + name + ')')
 		return targ
 
@@ -55,13 +444,19 @@ def unbind(type, name, callback):
 		if bind.callback != callback:
 			continue
 		relaybindings.remove(bind)
+		_compileroute(type, name)
 		log.debug('Unbound relay (type:' + type + ', name:' + name + ')')
 		break
 
-def call(text, target, source, extra):
-	global relaybindings
-	data = RelayData(text, source, target, extra)
-	log.debug('Attempting to call relays (type:' + target.type + ', name:' + target.name + ', channel:' + target.channel + ')')
+def _countfilter(filt, res):
+	key = (filt.__class__, res)
+	s = _filterseries.get(key)
+	if s == None:
+		s = _filterseries[key] = _filtermetric.labels(filt.__class__.__name__, _filterresults.get(res, str(res)))
+	s.value += 1
+
+def _filter(data):
+	target = data.target
 	if target.filters != None and len(target.filters) > 0:
 		matched = False
 		for filt in target.filters:
@@ -70,19 +465,150 @@ def call(text, target, source, extra):
 					log.error('Filter without filter() method: ' + str(filt))
 					continue
 				res, datares = filt.filter(data)
+				_countfilter(filt, res)
 				if res == FILTER_BLOCK:
-					return
+					return None
 				elif res == FILTER_MATCH:
 					if datares != None:
 						matched = True
 						data = datares
 			except Exception as e:
 				log.error('Error testing filter ' + str(filt) + ' for relay data: ' + str(e))
-				return
+				return None
 		if not matched:
-			return
-	for bind in relaybindings:
-		if bind.type == target.type and bind.name == target.name:
-			if bind.callback != None:
-				log.debug('Calling relay (type:' + bind.type + ', name:' + bind.name + ')')
-				bind.callback(data)
+			return None
+	return data
+
+# Gives a traced relay its own copy of the trace, named after its route
+def _tracestart(extra, source, target):
+	tr = extra.get('trace')
+	if tr == None:
+		return
+	tr = extra['trace'] = tr.fork(source.type + ':' + str(source.name) + '->' + target.type + ':' + target.name)
+	tr.mark('relay')
+
+def call(text, target, source, extra):
+	log.debug('Attempting to call relays (type:' + target.type + ', name:' + target.name + ', channel:' + target.channel + ')')
+	if extra.get('hops', 0) > loopconfigs['hops']:
+		log.debug('Dropping relay after ' + str(extra['hops']) + ' hops (type:' + target.type + ', name:' + target.name + ')')
+		stats.incr('relay suppressed hops ' + target.type + ':' + target.name)
+		return
+	_getroute(source.type, source.name).countin(source.channel).value += 1
+	_tracestart(extra, source, target)
+	data = _filter(RelayData(text, source, target, extra))
+	if data == None:
+		return
+	if 'trace' in extra:
+		extra['trace'].mark('filter')
+	if not shard.islocal(target.type, target.name):
+		log.debug('Forwarding relay to worker ' + str(shard.owner(target.type, target.name)) + ' (type:' + target.type + ', name:' + target.name + ')')
+		shard.forward([data])
+		return
+	deliver(data)
+
+# Relays a list of (text, extra) messages to one target. Each message is
+# filtered on its own, those that pass are delivered together.
+def call_many(messages, target, source):
+	log.debug('Attempting to call relays for ' + str(len(messages)) + ' messages (type:' + target.type + ', name:' + target.name + ', channel:' + target.channel + ')')
+	datas = []
+	_getroute(source.type, source.name).countin(source.channel).value += len(messages)
+	for text, extra in messages:
+		if extra.get('hops', 0) > loopconfigs['hops']:
+			log.debug('Dropping relay after ' + str(extra['hops']) + ' hops (type:' + target.type + ', name:' + target.name + ')')
+			stats.incr('relay suppressed hops ' + target.type + ':' + target.name)
+			continue
+		_tracestart(extra, source, target)
+		data = _filter(RelayData(text, source, target, extra))
+		if data != None:
+			if 'trace' in extra:
+				extra['trace'].mark('filter')
+			datas.append(data)
+	if len(datas) < 1:
+		return
+	if not shard.islocal(target.type, target.name):
+		log.debug('Forwarding relay to worker ' + str(shard.owner(target.type, target.name)) + ' (type:' + target.type + ', name:' + target.name + ')')
+		shard.forward(datas)
+		return
+	deliver_many(datas)
+
+def _dispatch(key, datas):
+	global relayroutes, relayqueues
+	if trace.configs['enabled']:
+		for data in datas:
+			if 'trace' in data.extra:
+				data.extra['trace'].mark('deliver')
+	r = _getroute(key[0], key[1])
+	for data in datas:
+		r.countout(data.target.channel).value += 1
+	for callback, batchcallback in r.callbacks:
+		if len(datas) == 1:
+			log.debug('Calling relay (type:' + key[0] + ', name:' + key[1] + ')')
+		else:
+			log.debug('Calling relay with ' + str(len(datas)) + ' messages (type:' + key[0] + ', name:' + key[1] + ')')
+		if batchcallback != None and (len(datas) > 1 or callback == None):
+			batchcallback(datas)
+		else:
+			for data in datas:
+				callback(data)
+	q = relayqueues.get(key)
+	if q != None:
+		q.delivered(len(datas))
+
+def _suppress(data):
+	if not _isrepeat(data):
+		return False
+	log.debug('Dropping repeated relay (type:' + data.target.type + ', name:' + data.target.name + ')')
+	stats.incr('relay suppressed repeat ' + data.target.type + ':' + data.target.name)
+	return True
+
+def deliver(data):
+	global relayqueues
+	if _suppress(data):
+		return
+	key = (data.target.type, data.target.name)
+	q = relayqueues.get(key)
+	if q != None and (not q.ready or q.backlog()):
+		q.put(data)
+		return
+	_dispatch(key, [data])
+
+def deliver_many(datas):
+	global relayqueues
+
+	if len(datas) == 1:
+		deliver(datas[0])
+		return
+
+	# Keep each target's messages in order while grouping them
+	groups = {}
+	order = []
+	for data in datas:
+		if _suppress(data):
+			continue
+		key = (data.target.type, data.target.name)
+		if not key in groups:
+			groups[key] = []
+			order.append(key)
+		groups[key].append(data)
+
+	for key in order:
+		q = relayqueues.get(key)
+		if q != None and (not q.ready or q.backlog()):
+			for data in groups[key]:
+				q.put(data)
+			continue
+		_dispatch(key, groups[key])
+
+# Sets the queue depth gauge of each relay target for the metrics module
+def _collect():
+	fam = stats.metric('relaybot_relay_queue_messages', 'gauge', 'Messages waiting in each target\'s relay queue and spool',
+			('module', 'client'))
+	for values in list(fam.series.keys()):
+		if not values in relayqueues:
+			fam.remove(*values)
+	for key in relayqueues:
+		q = relayqueues[key]
+		fam.labels(*key).set(len(q.queue) + (q.spool.pending if q.spool != None else 0))
+
+shard.bindreceive(deliver_many)
+stats.addcollector(_collect)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/resolver.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket, threading, Queue, time
+
+from core.rblogging import *
+import core.rbsocket as rbsocket
+
+defconfigs = {'threads': 4, 'ttl': 300, 'negttl': 30, 'maxcache': 1024}
+configs = dict(defconfigs)
+
+cache = {}
+pending = {}
+_requests = Queue.Queue()
+_results = Queue.Queue()
+_workers = []
+_wakeup = None
+
+def loadconfig(doc):
+	applyconfig(parseconfig(doc))
+
+def parseconfig(doc):
+	configs = dict(defconfigs)
+
+	resconfs = doc.findall('./resolver')
+
+	if len(resconfs) < 1:
+		return configs
+
+	for key in ['threads', 'ttl', 'negttl', 'maxcache']:
+		if key in resconfs[0].attrib:
+			try:
+				configs[key] = int(resconfs[0].attrib[key])
+			except ValueError:
+				log.error('Invalid resolver ' + key + ' attribute: ' + resconfs[0].attrib[key])
+				raise Exception('Invalid resolver ' + key + ' attribute: ' + resconfs[0].attrib[key])
+	return configs
+
+# Extra threads are started with the next lookup, a lower thread count
+# only takes effect after a restart
+def applyconfig(newconfigs):
+	global configs
+
+	configs = newconfigs
+
+def _worker():
+	global _requests, _results, _wakeup
+
+	while True:
+		key = _requests.get()
+		host, port, family, socktype, proto = key
+		addrs = []
+		err = None
+		try:
+			addrs = socket.getaddrinfo(host, port, family, socktype, proto)
+		except socket.gaierror as e:
+			err = e.strerror
+		except Exception as e:
+			err = str(e)
+		_results.put((key, addrs, err))
+		try:
+			_wakeup[1].send('x')
+		except socket.error:
+			# Wakeup socket is full, the loop has a read pending anyway
+			pass
+
+def _start():
+	global _workers, _wakeup, configs
+
+	if _wakeup == None:
+		_wakeup = socket.socketpair()
+		_wakeup[0].setblocking(0)
+		_wakeup[1].setblocking(0)
+		rbsocket.bindsockcallbacks(_wakeup[0], None, None, _doread)
+
+	while len(_workers) < max(1, configs['threads']):
+		t = threading.Thread(target=_worker, name='resolver-' + str(len(_workers)))
+		t.daemon = True
+		t.start()
+		_workers.append(t)
+
+def _doread(sock):
+	global _results, cache, pending, configs
+
+	try:
+		while sock.recv(4096):
+			pass
+	except socket.error:
+		pass
+
+	now = time.time()
+	while True:
+		try:
+			key, addrs, err = _results.get_nowait()
+		except Queue.Empty:
+			break
+
+		if len(cache) >= configs['maxcache']:
+			_prune(now)
+		if err == None and len(addrs) > 0:
+			cache[key] = (now + configs['ttl'], addrs, None)
+		else:
+			cache[key] = (now + configs['negttl'], [], err)
+
+		for callback, args in pending.pop(key, []):
+			if callback == None:
+				continue
+			try:
+				callback(addrs, err, *args)
+			except Exception as e:
+				log.error('Error in resolver callback for ' + str(key[0]) + ': ' + str(e))
+
+def _prune(now):
+	global cache
+
+	for key in cache.keys():
+		if cache[key][0] <= now:
+			del cache[key]
+	if len(cache) >= configs['maxcache']:
+		cache.clear()
+
+# Looks up host/port as socket.getaddrinfo() would without blocking the run
+# loop. callback(addrs, err, *args) is called from the loop with the address
+# list, err is None on success or an error string. Cached answers (including
+# failures, for a shorter time) are delivered straight away.
+def resolve(host, port, family=0, socktype=0, proto=0, callback=None, args=()):
+	global cache, pending, _requests
+
+	key = (host, port, family, socktype, proto)
+
+	ent = cache.get(key)
+	if ent != None:
+		if ent[0] > time.time():
+			if callback != None:
+				callback(ent[1], ent[2], *args)
+			return
+		del cache[key]
+
+	if key in pending:
+		pending[key].append((callback, args))
+		return
+
+	pending[key] = [(callback, args)]
+	_start()
+	_requests.put(key)
+
+def flush():
+	global cache
+	cache.clear()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/scheduler.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq, time, itertools
+
+import core.stats as stats
+
+# Don't bother rebuilding the heap until at least this many cancelled
+# events are waiting in it
+COMPACT_MIN = 64
+
+class event(object):
+	__slots__ = ('time', 'priority', 'action', 'argument', 'cancelled')
+
+	def __init__(self, time, priority, action, argument):
+		self.time = time
+		self.priority = priority
+		self.action = action
+		self.argument = argument
+		self.cancelled = False
+
+	def __repr__(self):
+		return 'event(time=' + str(self.time) + ', priority=' + str(self.priority) + ', action=' + repr(self.action) + ')'
+
+class scheduler:
+	def __init__(self, timefunc=time.time):
+		self.timefunc = timefunc
+		self._queue = []
+		self._seq = itertools.count()
+		self._cancelled = 0
+
+	def enterabs(self, time, priority, action, argument=()):
+		ev = event(time, priority, action, argument)
+		heapq.heappush(self._queue, (time, priority, next(self._seq), ev))
+		return ev
+
+	def enter(self, delay, priority, action, argument=()):
+		return self.enterabs(self.timefunc() + delay, priority, action, argument)
+
+	def cancel(self, ev):
+		# Events are only flagged here and skipped when they reach the top
+		# of the heap, cancelling an event that has already run is harmless
+		if ev == None or ev.cancelled:
+			return
+		ev.cancelled = True
+		self._cancelled += 1
+		if self._cancelled >= COMPACT_MIN and self._cancelled * 2 > len(self._queue):
+			self._compact()
+
+	def _compact(self):
+		self._queue = [item for item in self._queue if not item[3].cancelled]
+		heapq.heapify(self._queue)
+		self._cancelled = 0
+
+	def _prune(self):
+		while self._queue and self._queue[0][3].cancelled:
+			heapq.heappop(self._queue)
+			self._cancelled -= 1
+
+	def empty(self):
+		return len(self._queue) - self._cancelled <= 0
+
+	def nexttime(self):
+		self._prune()
+		if not self._queue:
+			return None
+		return self._queue[0][0]
+
+	def timeout(self):
+		ts = self.nexttime()
+		if ts == None:
+			return None
+		return max(0, ts - self.timefunc())
+
+	def run(self):
+		now = self.timefunc()
+		queue = self._queue
+		while queue:
+			ts, pri, seq, ev = queue[0]
+			if ev.cancelled:
+				heapq.heappop(queue)
+				self._cancelled -= 1
+				continue
+			if ts > now:
+				break
+			heapq.heappop(queue)
+			# Mark as done so a later cancel() of this handle is a no-op
+			ev.cancelled = True
+			stats.timecall('timer', ev.action, ev.argument)
+			# A callback may have compacted the heap
+			queue = self._queue
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/shard.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, sys, socket, signal, errno, zlib
+import cPickle as pickle
+from struct import pack
+from xml.etree.ElementTree import ElementTree
+
+from core.rblogging import *
+import core.rbsocket as rbsocket
+
+# Config blocks that are spread across worker processes, clients of any other
+# type always run on worker 0
+shardtypes = ['irc', 'minecraft']
+
+workers = 0
+index = 0
+owners = {}
+peers = {}
+pids = {}
+stopping = False
+_receive = None
+
+class peer:
+	def __init__(self, idx, sock):
+		self.index = idx
+		self.sock = sock
+		self.sock.setblocking(0)
+		self.sendq = rbsocket.sendqueue(sock)
+		self.reader = rbsocket.streamreader(sock, 65536)
+		rbsocket.bindsockcallbacks(sock, None, None, self.doread, self.dowrite)
+
+	def close(self):
+		global peers
+
+		rbsocket.unbindsockcallbacks(self.sock)
+		try:
+			self.sock.close()
+		except:
+			pass
+		if peers.get(self.index) is self:
+			del peers[self.index]
+
+	def send(self, frame):
+		try:
+			self.sendq.write(pack('!I', len(frame)) + frame)
+		except Exception as e:
+			log.error('Error sending to worker ' + str(self.index) + ': ' + str(e))
+			self.close()
+
+	def dowrite(self, sock):
+		try:
+			self.sendq.flush()
+		except Exception as e:
+			log.error('Error sending to worker ' + str(self.index) + ': ' + str(e))
+			self.close()
+
+	def doread(self, sock):
+		try:
+			n = self.reader.fill()
+		except Exception as e:
+			n = 0
+
+		if n == None:
+			return
+		if n == 0:
+			log.error('Lost connection to worker ' + str(self.index))
+			self.close()
+			return
+
+		for frame in self.reader.frames('!I'):
+			try:
+				datas = pickle.loads(frame)
+			except Exception as e:
+				log.error('Error decoding relay data from worker ' + str(self.index) + ': ' + str(e))
+				continue
+			if _receive != None:
+				_receive(datas)
+
+def assign(doc, count):
+	ret = {}
+	n = 0
+	for type in shardtypes:
+		for conf in doc.findall('./' + type):
+			if not 'name' in conf.attrib:
+				continue
+			ret[(type, conf.attrib['name'])] = n % count
+			n += 1
+	return ret
+
+def owner(type, name):
+	if workers < 1 or not type in shardtypes:
+		return 0
+	key = (type, name)
+	if key in owners:
+		return owners[key]
+	# Clients added after start up (config reload) are placed by hash so
+	# every worker agrees without asking the supervisor
+	return (zlib.crc32(type + ':' + name) & 0xffffffff) % workers
+
+def islocal(type, name):
+	return workers < 1 or owner(type, name) == index
+
+def bindreceive(func):
+	global _receive
+	_receive = func
+
+def _picklable(data):
+	try:
+		pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+		return data
+	except Exception:
+		pass
+	# Drop anything in extra that can't cross a process boundary (callbacks)
+	extra = {}
+	for key in data.extra:
+		try:
+			pickle.dumps(data.extra[key], pickle.HIGHEST_PROTOCOL)
+		except Exception:
+			continue
+		extra[key] = data.extra[key]
+	return data._replace(extra=extra)
+
+# Sends a list of RelayData for one target to the worker that owns it
+def forward(datas):
+	global peers
+
+	target = datas[0].target
+	idx = owner(target.type, target.name)
+	if not idx in peers:
+		log.error('No connection to worker ' + str(idx) + ' for relay (type:' + target.type + ', name:' + target.name + ')')
+		return
+	# Filters have already been run here, the owner only delivers
+	try:
+		frame = pickle.dumps([_picklable(data._replace(target=data.target._replace(filters=None))) for data in datas], pickle.HIGHEST_PROTOCOL)
+	except Exception as e:
+		log.error('Error encoding relay data for worker ' + str(idx) + ': ' + str(e))
+		return
+	peers[idx].send(frame)
+
+def _startworker(i, pairs, func):
+	global index, peers
+
+	index = i
+	# Until the worker has loaded its config and installed its own handlers
+	# a reload or stats dump from the supervisor would kill it
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+	for (a, b) in pairs:
+		sa, sb = pairs[(a, b)]
+		if a == i:
+			sb.close()
+			peers[b] = peer(b, sa)
+		elif b == i:
+			sa.close()
+			peers[a] = peer(a, sb)
+		else:
+			sa.close()
+			sb.close()
+
+	ret = 0
+	try:
+		func()
+	except SystemExit as e:
+		if isinstance(e.code, int):
+			ret = e.code
+	except BaseException as e:
+		log.critical('Worker ' + str(i) + ' failed: ' + str(e))
+		ret = 1
+	os._exit(ret)
+
+def _signalall(sig):
+	global pids
+
+	for pid in pids:
+		try:
+			os.kill(pid, sig)
+		except OSError:
+			pass
+
+def _dosigterm(signum, frame):
+	global stopping
+
+	stopping = True
+	# Workers shut down cleanly (sending QUIT etc) on SIGINT
+	_signalall(signal.SIGINT)
+
+def _dosigusr1(signum, frame):
+	# Every worker dumps its own stats
+	_signalall(signal.SIGUSR1)
+
+def _dosighup(signum, frame):
+	# Workers each re-read the config and apply the changes for their clients
+	_signalall(signal.SIGHUP)
+
+def supervise(count, file, func):
+	global workers, owners, pids, stopping
+
+	tree = ElementTree()
+	doc = tree.parse(file)
+
+	workers = count
+	owners = assign(doc, count)
+
+	pairs = {}
+	for a in range(count):
+		for b in range(a + 1, count):
+			pairs[(a, b)] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+	for i in range(count):
+		pid = os.fork()
+		if pid == 0:
+			_startworker(i, pairs, func)
+		pids[pid] = i
+		log.info('Started worker ' + str(i) + ' (pid ' + str(pid) + ')')
+
+	for sa, sb in pairs.values():
+		sa.close()
+		sb.close()
+
+	signal.signal(signal.SIGTERM, _dosigterm)
+	signal.signal(signal.SIGUSR1, _dosigusr1)
+	signal.signal(signal.SIGHUP, _dosighup)
+
+	ret = 0
+	while len(pids) > 0:
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except KeyboardInterrupt:
+			# Ctrl+C reaches the workers directly, wait for them to exit
+			stopping = True
+			continue
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				continue
+			if e.errno == errno.ECHILD:
+				break
+			raise
+		if not pid in pids:
+			continue
+		i = pids.pop(pid)
+		if not stopping:
+			log.critical('Worker ' + str(i) + ' (pid ' + str(pid) + ') exited unexpectedly (status ' + str(status) + '), shutting down')
+			stopping = True
+			ret = 1
+			_signalall(signal.SIGINT)
+	return ret
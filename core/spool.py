@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/spool.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, time
+import cPickle as pickle
+from struct import pack, unpack
+
+from core.rblogging import *
+import core.stats as stats
+
+# Each record is its payload length and the time it was spooled followed by
+# the pickled RelayData
+_header = '<Id'
+_headersize = 8 + 4
+
+SPOOL_MAXAGE = 86400
+SPOOL_MAXSIZE = 10485760
+SPOOL_RATE = 5.0
+SPOOL_SYNC = 1.0
+# Segments are rotated at this size (or a quarter of maxsize when smaller)
+SPOOL_SEGSIZE = 1048576
+# Replay runs on a timer ticking at most every SPOOL_TICK seconds, a rate
+# of 0 replays SPOOL_REPLAYBATCH messages a tick as fast as the loop allows
+SPOOL_TICK = 0.2
+SPOOL_REPLAYBATCH = 100
+
+# Reads the optional <spool path="..." maxage="..." maxsize="..." rate="..."
+# sync="..." /> element of a client config element into a dict for
+# core.relay.setspool(), None when there isn't one
+def parseconfig(elem):
+	spools = elem.findall('./spool')
+	if len(spools) > 1:
+		log.error('Too many relay spool elements')
+		raise Exception('Too many relay spool elements')
+	if len(spools) < 1:
+		return None
+	attrs = spools[0].attrib
+	if not 'path' in attrs or attrs['path'] == '':
+		log.error('Relay spool missing path attribute')
+		raise Exception('Relay spool missing path attribute')
+	conf = {'path': attrs['path'], 'maxage': SPOOL_MAXAGE, 'maxsize': SPOOL_MAXSIZE, 'rate': SPOOL_RATE, 'sync': SPOOL_SYNC}
+	for attr, conv in [('maxage', int), ('maxsize', int), ('rate', float), ('sync', float)]:
+		if not attr in attrs:
+			continue
+		try:
+			conf[attr] = conv(attrs[attr])
+		except ValueError:
+			conf[attr] = -1
+		if conf[attr] < 0:
+			log.error('Invalid relay spool ' + attr + ': ' + attrs[attr])
+			raise Exception('Invalid relay spool ' + attr + ': ' + attrs[attr])
+	if conf['maxsize'] < 4096:
+		log.error('Invalid relay spool maxsize: ' + attrs['maxsize'])
+		raise Exception('Invalid relay spool maxsize: ' + attrs['maxsize'])
+	return conf
+
+# Append only on-disk spool of the relays for one target. Records go into
+# numbered segment files under <path>/<type>-<name>/, the read position is
+# kept in an offset file so a restart carries on where replay left off.
+# Writes are fsynced on a timer every 'sync' seconds (0 syncs every write).
+# When the spool grows past maxsize whole segments are dropped from the
+# front, records older than maxage are skipped on replay.
+class spool:
+	def __init__(self, type, name, conf, schedobj, schedpri=100):
+		self.type = type
+		self.name = name
+		self.conf = conf
+		self.dir = os.path.join(conf['path'], type + '-' + name.replace(os.sep, '_'))
+		self.pending = 0
+		self._sched = schedobj
+		self._schedpri = schedpri
+		self._schedevs = {'sync': None, 'replay': None}
+		self._segsize = max(4096, min(SPOOL_SEGSIZE, conf['maxsize'] // 4))
+		self._segs = []
+		self._counts = {}
+		self._sizes = {}
+		self._nextseg = 1
+		self._wfile = None
+		self._rfile = None
+		self._rseg = None
+		self._roff = 0
+		self._replayfunc = None
+		tag = type + ':' + name
+		self._counters = ('relay spooled ' + tag, 'relay spool dropped ' + tag)
+
+	def __repr__(self):
+		return 'spool(' + self.type + ':' + self.name + ', ' + self.dir + ')'
+
+	def _segpath(self, seg):
+		return os.path.join(self.dir, '%08d.spool' % seg)
+
+	def _offsetpath(self):
+		return os.path.join(self.dir, 'offset')
+
+	# Opens the spool directory and counts what is left to replay in it
+	def open(self):
+		if not os.path.isdir(self.dir):
+			os.makedirs(self.dir)
+		for fname in os.listdir(self.dir):
+			if fname.endswith('.spool'):
+				try:
+					self._segs.append(int(fname[:-6]))
+				except ValueError:
+					continue
+		self._segs.sort()
+		rseg, roff = None, 0
+		try:
+			f = open(self._offsetpath(), 'r')
+			try:
+				rseg, roff = [int(x) for x in f.read().split()]
+			finally:
+				f.close()
+		except (IOError, ValueError):
+			rseg, roff = None, 0
+		for seg in list(self._segs):
+			if rseg != None and seg < rseg:
+				os.remove(self._segpath(seg))
+				self._segs.remove(seg)
+		for seg in self._segs:
+			start = 0
+			if seg == rseg:
+				start = roff
+			self._counts[seg], self._sizes[seg] = self._scan(seg, start, seg == self._segs[-1])
+			self.pending += self._counts[seg]
+		if len(self._segs) > 0:
+			self._rseg = self._segs[0]
+			self._roff = roff if self._rseg == rseg else 0
+			self._nextseg = self._segs[-1] + 1
+		if self.pending > 0:
+			log.info('Relay spool for ' + self.type + ':' + self.name + ' has ' + str(self.pending) + ' messages to replay')
+		else:
+			self._reset()
+
+	# Counts the records in a segment from start, cutting off a record left
+	# half written by a crash at the end of the last one
+	def _scan(self, seg, start, last):
+		path = self._segpath(seg)
+		size = os.path.getsize(path)
+		n = 0
+		good = start
+		f = open(path, 'rb')
+		try:
+			f.seek(start)
+			while True:
+				hdr = f.read(_headersize)
+				if len(hdr) < _headersize:
+					break
+				length, ts = unpack(_header, hdr)
+				if good + _headersize + length > size:
+					break
+				f.seek(length, 1)
+				good += _headersize + length
+				n += 1
+		finally:
+			f.close()
+		if good < size and last:
+			log.warning('Truncating partial record at the end of ' + path)
+			f = open(path, 'r+b')
+			try:
+				f.truncate(good)
+			finally:
+				f.close()
+			size = good
+		return n, size
+
+	def _addtimer(self, delay, callback):
+		if self._sched:
+			return self._sched.enter(delay, self._schedpri, callback, ())
+
+	def _deltimer(self, event):
+		if self._sched and event != None:
+			self._sched.cancel(event)
+
+	# Pickles data without what can't (or shouldn't) outlive this process:
+	# the target's filters have already run, traces and callbacks are dropped
+	def _encode(self, data):
+		extra = data.extra
+		if 'trace' in extra:
+			extra = dict(extra)
+			del extra['trace']
+		data = data._replace(target=data.target._replace(filters=None), extra=extra)
+		try:
+			return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+		except Exception:
+			pass
+		extra = {}
+		for key in data.extra:
+			try:
+				pickle.dumps(data.extra[key], pickle.HIGHEST_PROTOCOL)
+			except Exception:
+				continue
+			extra[key] = data.extra[key]
+		try:
+			return pickle.dumps(data._replace(extra=extra), pickle.HIGHEST_PROTOCOL)
+		except Exception:
+			return None
+
+	# Adds data to the end of the spool, returns False when it can't be
+	# written so the caller can keep it in memory instead
+	def append(self, data):
+		payload = self._encode(data)
+		if payload == None:
+			return False
+		try:
+			if self._wfile == None:
+				self._newsegment()
+			self._wfile.write(pack(_header, len(payload), time.time()) + payload)
+		except (IOError, OSError) as e:
+			log.error('Error writing relay spool ' + self.dir + ': ' + str(e))
+			return False
+		seg = self._segs[-1]
+		self._counts[seg] += 1
+		self._sizes[seg] += _headersize + len(payload)
+		self.pending += 1
+		stats.incr(self._counters[0])
+		if self._sizes[seg] >= self._segsize:
+			self._closesegment()
+		self._trim()
+		if self.conf['sync'] <= 0:
+			self.sync()
+		elif self._schedevs['sync'] == None:
+			self._schedevs['sync'] = self._addtimer(self.conf['sync'], self._dosync)
+		return True
+
+	def _newsegment(self):
+		seg = self._nextseg
+		self._nextseg += 1
+		self._wfile = open(self._segpath(seg), 'ab')
+		self._segs.append(seg)
+		self._counts[seg] = 0
+		self._sizes[seg] = 0
+		if self._rseg == None:
+			self._rseg = seg
+			self._roff = 0
+
+	def _closesegment(self):
+		if self._wfile == None:
+			return
+		self._wfile.flush()
+		os.fsync(self._wfile.fileno())
+		self._wfile.close()
+		self._wfile = None
+
+	def _dropsegment(self, seg):
+		if seg == self._rseg:
+			if self._rfile != None:
+				self._rfile.close()
+				self._rfile = None
+			self._roff = 0
+			idx = self._segs.index(seg)
+			self._rseg = self._segs[idx + 1] if idx + 1 < len(self._segs) else None
+		self._segs.remove(seg)
+		self.pending -= self._counts.pop(seg)
+		self._sizes.pop(seg)
+		try:
+			os.remove(self._segpath(seg))
+		except OSError as e:
+			log.warning('Error removing relay spool segment ' + self._segpath(seg) + ': ' + str(e))
+
+	# Keeps the spool under maxsize by dropping its oldest segments, the one
+	# being written to is always kept
+	def _trim(self):
+		total = sum(self._sizes.values())
+		while total > self.conf['maxsize'] and len(self._segs) > 1:
+			seg = self._segs[0]
+			n = self._counts[seg]
+			total -= self._sizes[seg]
+			self._dropsegment(seg)
+			stats.incr(self._counters[1], n)
+			log.warning('Relay spool for ' + self.type + ':' + self.name + ' over ' + str(self.conf['maxsize']) + ' bytes, dropped ' + str(n) + ' messages')
+
+	# Removes every segment once everything has been replayed
+	def _reset(self):
+		if self._rfile != None:
+			self._rfile.close()
+			self._rfile = None
+		if self._wfile != None:
+			self._wfile.close()
+			self._wfile = None
+		for seg in self._segs:
+			try:
+				os.remove(self._segpath(seg))
+			except OSError:
+				pass
+		try:
+			os.remove(self._offsetpath())
+		except OSError:
+			pass
+		self._segs = []
+		self._counts = {}
+		self._sizes = {}
+		self._rseg = None
+		self._roff = 0
+		self.pending = 0
+
+	# Takes up to n messages from the front of the spool
+	def read(self, n):
+		ret = []
+		if self.pending < 1:
+			return ret
+		if self._wfile != None:
+			self._wfile.flush()
+		oldest = 0
+		if self.conf['maxage'] > 0:
+			oldest = time.time() - self.conf['maxage']
+		aged = 0
+		while len(ret) < n and self.pending > 0 and self._rseg != None:
+			if self._rfile == None:
+				self._rfile = open(self._segpath(self._rseg), 'rb')
+				self._rfile.seek(self._roff)
+			hdr = self._rfile.read(_headersize)
+			if len(hdr) < _headersize:
+				if self._rseg == self._segs[-1]:
+					break
+				self._dropsegment(self._rseg)
+				continue
+			length, ts = unpack(_header, hdr)
+			payload = self._rfile.read(length)
+			self._roff += _headersize + length
+			self._counts[self._rseg] -= 1
+			self.pending -= 1
+			if ts < oldest:
+				aged += 1
+				continue
+			try:
+				ret.append(pickle.loads(payload))
+			except Exception as e:
+				log.error('Error decoding relay spool record in ' + self._segpath(self._rseg) + ': ' + str(e))
+		if aged > 0:
+			stats.incr(self._counters[1], aged)
+			log.info('Skipped ' + str(aged) + ' spooled messages older than ' + str(self.conf['maxage']) + ' seconds for ' + self.type + ':' + self.name)
+		if self.pending < 1:
+			self._reset()
+		elif self._schedevs['sync'] == None:
+			self._schedevs['sync'] = self._addtimer(max(self.conf['sync'], SPOOL_TICK), self._dosync)
+		return ret
+
+	def _dosync(self):
+		self._schedevs['sync'] = None
+		self.sync()
+
+	# Flushes written records to disk and saves the read position
+	def sync(self):
+		try:
+			if self._wfile != None:
+				self._wfile.flush()
+				os.fsync(self._wfile.fileno())
+			if self._rseg == None:
+				return
+			tmp = self._offsetpath() + '.tmp'
+			f = open(tmp, 'w')
+			try:
+				f.write(str(self._rseg) + ' ' + str(self._roff) + '\n')
+				f.flush()
+				os.fsync(f.fileno())
+			finally:
+				f.close()
+			os.rename(tmp, self._offsetpath())
+		except (IOError, OSError) as e:
+			log.error('Error syncing relay spool ' + self.dir + ': ' + str(e))
+
+	# Replays the spool on a timer. func(n) is called each tick to send up
+	# to n messages and returns whether to carry on.
+	def startreplay(self, func):
+		self._replayfunc = func
+		if self._schedevs['replay'] == None:
+			log.info('Replaying ' + str(self.pending) + ' spooled messages for ' + self.type + ':' + self.name)
+			self._schedevs['replay'] = self._addtimer(0, self._replaytick)
+
+	def _replaytick(self):
+		self._schedevs['replay'] = None
+		if self._replayfunc == None:
+			return
+		rate = self.conf['rate']
+		if rate <= 0:
+			n, delay = SPOOL_REPLAYBATCH, 0
+		else:
+			delay = max(SPOOL_TICK, 1.0 / rate)
+			n = max(1, int(round(rate * delay)))
+		if self._replayfunc(n):
+			self._schedevs['replay'] = self._addtimer(delay, self._replaytick)
+
+	def close(self):
+		self._replayfunc = None
+		for name in self._schedevs:
+			self._deltimer(self._schedevs[name])
+			self._schedevs[name] = None
+		self.sync()
+		if self._rfile != None:
+			self._rfile.close()
+			self._rfile = None
+		if self._wfile != None:
+			self._wfile.close()
+			self._wfile = None
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/stats.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import time, signal
+
+from core.rblogging import *
+
+# Bucket i counts durations of less than 2**i microseconds (and at least
+# half that), the last bucket also takes anything longer
+BUCKETS = 32
+
+defconfigs = {'slowcallback': 100}
+configs = dict(defconfigs)
+
+histograms = {}
+counters = {}
+_dumprequested = False
+
+class histogram:
+	def __init__(self):
+		self.buckets = [0] * BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, secs):
+		if secs < 0:
+			secs = 0.0
+		i = int(secs * 1000000).bit_length()
+		if i >= BUCKETS:
+			i = BUCKETS - 1
+		self.buckets[i] += 1
+		self.count += 1
+		self.total += secs
+		if secs > self.max:
+			self.max = secs
+
+	def percentile(self, p):
+		# Upper bound of the bucket holding the p'th value, so never more
+		# than twice the real figure
+		want = self.count * p
+		n = 0
+		for i in range(BUCKETS):
+			n += self.buckets[i]
+			if n >= want and n > 0:
+				return min((1 << i) / 1000000.0, self.max)
+		return self.max
+
+	def mean(self):
+		if self.count < 1:
+			return 0.0
+		return self.total / self.count
+
+def loadconfig(doc):
+	applyconfig(parseconfig(doc))
+
+def parseconfig(doc):
+	configs = dict(defconfigs)
+
+	statconfs = doc.findall('./stats')
+
+	if len(statconfs) < 1:
+		return configs
+
+	if 'slowcallback' in statconfs[0].attrib:
+		try:
+			configs['slowcallback'] = int(statconfs[0].attrib['slowcallback'])
+		except ValueError:
+			log.error('Invalid stats slowcallback attribute: ' + statconfs[0].attrib['slowcallback'])
+			raise Exception('Invalid stats slowcallback attribute: ' + statconfs[0].attrib['slowcallback'])
+	return configs
+
+def applyconfig(newconfigs):
+	global configs
+
+	configs = newconfigs
+
+def record(name, secs):
+	global histograms
+
+	h = histograms.get(name)
+	if h == None:
+		h = histograms[name] = histogram()
+	h.add(secs)
+
+def incr(name, n=1):
+	global counters
+
+	counters[name] = counters.get(name, 0) + n
+
+# Labelled metrics, exported by the metrics module. A family has fixed label
+# names and one series per set of label values. Hot paths look their series
+# up once with labels() and keep it, counting is then an attribute update
+# with no names to build. Histogram families hold histogram series.
+metrics = {}
+collectors = []
+
+class series:
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def set(self, value):
+		self.value = value
+
+class family:
+	def __init__(self, name, kind, help, labelnames):
+		self.name = name
+		self.kind = kind
+		self.help = help
+		self.labelnames = labelnames
+		self.series = {}
+
+	def labels(self, *values):
+		s = self.series.get(values)
+		if s == None:
+			if self.kind == 'histogram':
+				s = histogram()
+			else:
+				s = series()
+			self.series[values] = s
+		return s
+
+	def remove(self, *values):
+		self.series.pop(values, None)
+
+	# Drops the series of a module's clients (the first two labels) that
+	# aren't in names, for gauges of clients that have gone away
+	def retain(self, module, names):
+		for values in list(self.series.keys()):
+			if values[0] == module and not values[1] in names:
+				del self.series[values]
+
+# kind is 'counter', 'gauge' or 'histogram'
+def metric(name, kind, help, labelnames=()):
+	global metrics
+
+	f = metrics.get(name)
+	if f == None:
+		f = metrics[name] = family(name, kind, help, tuple(labelnames))
+	return f
+
+# func() is called before metrics are read so it can set its gauges
+def addcollector(func):
+	global collectors
+
+	if not func in collectors:
+		collectors.append(func)
+
+# Sets the connection gauges of a module's clients (a dict of name to
+# client), which provide connector() and sendqueue()
+def collectclients(module, clients):
+	sendq = metric('relaybot_sendq_bytes', 'gauge', 'Bytes waiting in each client\'s socket send queue', ('module', 'client'))
+	uptime = metric('relaybot_connection_uptime_seconds', 'gauge', 'Seconds since each client\'s session was established, 0 when down',
+			('module', 'client'))
+	attempts = metric('relaybot_connect_attempts_total', 'counter', 'Connection attempts made by each client', ('module', 'client'))
+	connects = metric('relaybot_connects_total', 'counter', 'Sessions established by each client, more than one means it reconnected',
+			('module', 'client'))
+	for fam in [sendq, uptime, attempts, connects]:
+		fam.retain(module, clients)
+	for name in clients:
+		cli = clients[name]
+		sq = cli.sendqueue()
+		sendq.labels(module, name).set(sq.pending() if sq != None else 0)
+		conn = cli.connector()
+		uptime.labels(module, name).set(conn.uptime())
+		attempts.labels(module, name).set(conn.attempts)
+		connects.labels(module, name).set(conn.connects)
+
+def collect():
+	for func in collectors:
+		try:
+			func()
+		except Exception as e:
+			log.error('Error collecting metrics from ' + getattr(func, '__module__', '?') + ': ' + str(e))
+
+def _owner(func):
+	# Returns (tag, object) for a callback, tag is the module plus the client
+	# name when the callback is a method of something with a name
+	obj = getattr(func, '__self__', None)
+	mod = getattr(func, '__module__', None) or '?'
+	mod = mod.rsplit('.', 1)[-1]
+	name = getattr(obj, 'name', None)
+	if isinstance(name, basestring):
+		return (mod + ':' + name, obj)
+	return (mod, obj)
+
+# (kind, id of the object, function) of a callback to (object, histogram),
+# so timing a call costs a lookup rather than working out its name. The
+# object is keyed by id() as hashing old-style instances is slow, keeping it
+# in the entry stops the id being reused while the entry exists. Cleared
+# when it gets big, callbacks of short-lived objects (such as metrics
+# requests) would otherwise be kept alive.
+_timecallhists = {}
+TIMECALL_CACHE = 4096
+
+# Calls func(*args), recording how long it took under kind and the owner of
+# func. Calls slower than the slowcallback threshold are logged.
+def timecall(kind, func, args=()):
+	global _timecallhists
+
+	start = time.time()
+	try:
+		return func(*args)
+	finally:
+		took = time.time() - start
+		obj = getattr(func, '__self__', None)
+		key = (kind, id(obj), getattr(func, '__func__', func))
+		entry = _timecallhists.get(key)
+		if entry != None:
+			h = entry[1]
+		else:
+			if len(_timecallhists) >= TIMECALL_CACHE:
+				_timecallhists = {}
+			name = kind + ' ' + _owner(func)[0]
+			h = histograms.get(name)
+			if h == None:
+				h = histograms[name] = histogram()
+			_timecallhists[key] = (obj, h)
+		h.add(took)
+		if configs['slowcallback'] > 0 and took * 1000 >= configs['slowcallback']:
+			tag, obj = _owner(func)
+			log.warning('Slow ' + kind + ' callback ' + tag + '.' + getattr(func, '__name__', '?') + ' took ' + '%.1f' % (took * 1000) + 'ms', obj)
+
+def _dosigusr1(signum, frame):
+	global _dumprequested
+	# Only flag it, the run loop dumps once the current callback is done
+	_dumprequested = True
+
+def install():
+	signal.signal(signal.SIGUSR1, _dosigusr1)
+
+def checkdump():
+	global _dumprequested
+
+	if _dumprequested:
+		_dumprequested = False
+		dump()
+
+def dump():
+	global histograms
+
+	log.info('Latency histograms (ms): count mean p50 p90 p99 max')
+	for name in sorted(histograms.keys()):
+		h = histograms[name]
+		log.info('  ' + name + ': ' + str(h.count) + ' ' + ' '.join(['%.3f' % (v * 1000) for v in
+				[h.mean(), h.percentile(0.5), h.percentile(0.9), h.percentile(0.99), h.max]]))
+	if len(counters) > 0:
+		log.info('Counters:')
+		for name in sorted(counters.keys()):
+			log.info('  ' + name + ': ' + str(counters[name]))
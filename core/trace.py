@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, core/trace.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, time
+
+from core.rblogging import *
+import core.stats as stats
+
+# Python 2 has no monotonic clock, fall back to the wall clock there
+_now = getattr(time, 'monotonic', time.time)
+
+# 'sample' logs every sample'th trace in full, 0 logs none. Tracing is only
+# on when there is a <trace> element.
+defconfigs = {'enabled': False, 'sample': 100}
+configs = dict(defconfigs)
+
+_current = None
+_count = 0
+
+# Timeline of one inbound event. Each relay of the event gets its own copy
+# from fork() so the targets' timelines don't mix, they keep the same id.
+class span:
+	def __init__(self, id, kind, origin, sampled):
+		self.id = id
+		self.kind = kind
+		self.origin = origin
+		self.sampled = sampled
+		self.route = None
+		self.marks = [('ingress', _now())]
+
+	def mark(self, name):
+		self.marks.append((name, _now()))
+
+	def fork(self, route):
+		ret = span(self.id, self.kind, self.origin, self.sampled)
+		ret.route = route
+		ret.marks = list(self.marks)
+		return ret
+
+	def __repr__(self):
+		return 'span(' + self.id + ', ' + self.origin + ')'
+
+def loadconfig(doc):
+	applyconfig(parseconfig(doc))
+
+def parseconfig(doc):
+	configs = dict(defconfigs)
+
+	traceconfs = doc.findall('./trace')
+
+	configs['enabled'] = len(traceconfs) > 0
+	if len(traceconfs) < 1:
+		return configs
+
+	if 'sample' in traceconfs[0].attrib:
+		try:
+			configs['sample'] = int(traceconfs[0].attrib['sample'])
+		except ValueError:
+			log.error('Invalid trace sample attribute: ' + traceconfs[0].attrib['sample'])
+			raise Exception('Invalid trace sample attribute: ' + traceconfs[0].attrib['sample'])
+	return configs
+
+def applyconfig(newconfigs):
+	global configs
+
+	configs = newconfigs
+
+# Starts a trace for an inbound event from kind (such as 'irc') on owner and
+# makes it the current one, returns None when tracing is off
+def begin(kind, owner=None):
+	global _current, _count
+
+	if not configs['enabled']:
+		_current = None
+		return None
+	_count += 1
+	origin = kind
+	name = getattr(owner, 'name', None)
+	if isinstance(name, basestring):
+		origin = kind + ':' + name
+	sampled = configs['sample'] > 0 and _count % configs['sample'] == 0
+	_current = span(str(os.getpid()) + '.' + str(_count), kind, origin, sampled)
+	return _current
+
+def end():
+	global _current
+
+	_current = None
+
+def current():
+	return _current
+
+# Adds the current trace to a relay's extra, for sources that call the
+# relay after their event has been handled
+def tag(extra):
+	if _current != None:
+		extra['trace'] = _current
+	return extra
+
+# Called once a relay has been written out (or handed to the socket's send
+# queue). Records the time between each step under the relay's route and
+# logs sampled traces in full.
+def finish(tr):
+	if tr == None:
+		return
+	tr.mark('write')
+	route = tr.route
+	if route == None:
+		route = tr.origin
+	steps = []
+	prev = tr.marks[0][1]
+	for name, ts in tr.marks[1:]:
+		stats.record('trace ' + route + ' ' + name, ts - prev)
+		steps.append(name + ' +' + '%.3f' % ((ts - prev) * 1000))
+		prev = ts
+	total = tr.marks[-1][1] - tr.marks[0][1]
+	stats.record('trace ' + route + ' total', total)
+	if tr.sampled:
+		log.info('Trace ' + tr.id + ' ' + route + ': ' + ' '.join(steps) + ' total ' + '%.3f' % (total * 1000) + 'ms')
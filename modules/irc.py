@@ -19,18 +19,47 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-import socket, sched, time, sys, ssl
+import time, sys, string, re
+from collections import deque
 
 from core.rblogging import *
 import core.rbsocket as rbsocket
+import core.scheduler as scheduler
+import core.connector as connector
 import core.relay as relay
+import core.filters as filters
+import core.shard as shard
+import core.trace as trace
+import core.stats as stats
+import core.spool as spool
 
 configs = {}
 clients = {}
 
+# Flood control send lanes, lines in a lower lane are sent first
+LANE_CONTROL = 0
+LANE_RELAY = 1
+
+# What's assumed of a server until its ISUPPORT (005) says otherwise
+DEFAULT_CASEMAPPING = 'rfc1459'
+DEFAULT_LINELEN = 512
+DEFAULT_HOSTLEN = 63
+DEFAULT_PREFIX = '(ov)@+'
+DEFAULT_CHANMODES = 'beI,k,l,imnpst'
+
+# A Minecraft player asking who is on IRC
+_ircwhoreg = re.compile('^<[^>]+> \\?irc\\s*$')
+# Answers to ?irc list names up to about this many bytes
+IRCWHO_MAX = 400
+
 def loadconfig(doc):
 	global configs
 
+	configs = parseconfig(doc)
+
+def parseconfig(doc):
+	configs = {}
+
 	cliconfs = doc.findall('./irc')
 
 	for irccli in cliconfs:
@@ -89,6 +118,35 @@ def loadconfig(doc):
 			log.error('IRC client user missing gecos attribute')
 			raise Exception('IRC client user missing gecos attribute')
 
+		configs[name]['queue'] = relay.parsequeueconfig(irccli)
+		configs[name]['spool'] = spool.parseconfig(irccli)
+
+		configs[name]['flood'] = {'rate': 0.0, 'burst': 5, 'merge': False}
+		floods = irccli.findall('./flood')
+		if len(floods) > 1:
+			log.error('Too many IRC client flood elements')
+			raise Exception('Too many IRC client flood elements')
+		if len(floods) > 0:
+			flood = floods[0]
+			if 'rate' in flood.attrib:
+				try:
+					configs[name]['flood']['rate'] = float(flood.attrib['rate'])
+				except ValueError:
+					configs[name]['flood']['rate'] = -1
+				if configs[name]['flood']['rate'] < 0:
+					log.error('Invalid IRC client flood rate: ' + flood.attrib['rate'])
+					raise Exception('Invalid IRC client flood rate: ' + flood.attrib['rate'])
+			if 'burst' in flood.attrib:
+				try:
+					configs[name]['flood']['burst'] = int(flood.attrib['burst'])
+				except ValueError:
+					configs[name]['flood']['burst'] = 0
+				if configs[name]['flood']['burst'] < 1:
+					log.error('Invalid IRC client flood burst: ' + flood.attrib['burst'])
+					raise Exception('Invalid IRC client flood burst: ' + flood.attrib['burst'])
+			if 'merge' in flood.attrib:
+				configs[name]['flood']['merge'] = flood.attrib['merge'].lower() in ['1', 'yes', 'true', 'on']
+
 		chans = irccli.findall('./channel')
 		configs[name]['relays'] = {}
 		for chan in chans:
@@ -117,43 +175,352 @@ def loadconfig(doc):
 				relnew = rel.attrib
 				if not 'prefix' in relnew:
 					relnew['prefix'] = '[' + name + ']'
+				relnew['regex'] = filters.parseconfig(rel)
 				configs[name]['relays'][cname.lower()].append(relnew)
 
+	return configs
+
 def runconfig(timers):
 	global configs
-	global clients
 
 	for key in configs:
-		user = configs[key]['user']
-		server = configs[key]['server']
-		cmds = []
+		if not shard.islocal('irc', key):
+			continue
+		_startclient(key, timers)
+
+def _startclient(key, timers):
+	global configs
+	global clients
 
-		cli = client(name=key, nick=user['nick'], user=user['user'], gecos=user['gecos'],
-			server=server['host'], port=server['port'], serverpassword=server['password'],
-			schedobj=timers, performs=cmds)
+	user = configs[key]['user']
+	server = configs[key]['server']
+	cmds = []
 
-		for chan in configs[key]['channels']:
-			cli.channel_add(chan)
+	cli = client(name=key, nick=user['nick'], user=user['user'], gecos=user['gecos'],
+		server=server['host'], port=server['port'], serverpassword=server['password'],
+		schedobj=timers, performs=cmds,
+		queuesize=configs[key]['queue']['size'], queuepolicy=configs[key]['queue']['policy'],
+		spoolconf=configs[key]['spool'],
+		floodrate=configs[key]['flood']['rate'], floodburst=configs[key]['flood']['burst'],
+		floodmerge=configs[key]['flood']['merge'])
 
-		for chan in configs[key]['relays']:
-			rels = configs[key]['relays'][chan]
-			for rel in rels:
-				cli.relay_add(chan, rel['type'], rel['name'], rel['channel'], rel['prefix'], None)
+	for chan in configs[key]['channels']:
+		cli.channel_add(chan)
+
+	for chan in configs[key]['relays']:
+		rels = configs[key]['relays'][chan]
+		for rel in rels:
+			cli.relay_add(chan, rel['type'], rel['name'], rel['channel'], rel['prefix'], None, filters.chain(rel['regex']))
+
+	cli.connect()
+	clients[key] = cli
+
+def _stopclient(key, reason):
+	global clients
+
+	if not key in clients:
+		return
+	cli = clients.pop(key)
+	log.info('Stopping client: ' + reason, cli)
+	cli.stop(reason)
+
+# Applies a config returned by parseconfig() to the running clients. Clients
+# whose server or user settings changed are reconnected, channel and relay
+# changes are made on the live connection.
+def reloadconfig(newconfigs, timers):
+	global configs
+	global clients
+
+	oldconfigs = configs
+	configs = newconfigs
+
+	for key in oldconfigs:
+		if not key in configs:
+			_stopclient(key, 'Removed from config')
+			relay.delqueue('irc', key)
+		elif configs[key]['server'] != oldconfigs[key]['server'] or configs[key]['user'] != oldconfigs[key]['user']:
+			_stopclient(key, 'Reconnecting for config change')
+
+	for key in configs:
+		if not shard.islocal('irc', key):
+			continue
+		if not key in clients:
+			_startclient(key, timers)
+			continue
+
+		cli = clients[key]
+		old = oldconfigs[key]
+		new = configs[key]
+
+		if new['queue'] != old['queue']:
+			relay.setqueue('irc', key, new['queue']['size'], new['queue']['policy'])
+		if new['spool'] != old['spool']:
+			relay.setspool('irc', key, new['spool'], timers)
+		if new['flood'] != old['flood']:
+			cli.setflood(new['flood']['rate'], new['flood']['burst'], new['flood']['merge'])
+
+		oldchans = [chan.lower() for chan in old['channels']]
+		newchans = [chan.lower() for chan in new['channels']]
+		for chan in old['channels']:
+			if not chan.lower() in newchans:
+				cli.channel_del(chan)
+		for chan in new['channels']:
+			if not chan.lower() in oldchans:
+				cli.channel_add(chan)
+
+		for chan in old['relays']:
+			for rel in old['relays'][chan]:
+				if not rel in new['relays'].get(chan, []):
+					cli.relay_del(chan, rel['type'], rel['name'], rel['channel'], rel['prefix'])
+		for chan in new['relays']:
+			for rel in new['relays'][chan]:
+				if not rel in old['relays'].get(chan, []):
+					cli.relay_add(chan, rel['type'], rel['name'], rel['channel'], rel['prefix'], None, filters.chain(rel['regex']))
+
+def _collect():
+	stats.collectclients('irc', clients)
+	members = stats.metric('relaybot_irc_channel_members', 'gauge', 'Nicks in each IRC channel the bot is in',
+			('module', 'client', 'channel'))
+	members.retain('irc', clients)
+	for name in clients:
+		cli = clients[name]
+		chans = cli.channels()
+		for values in list(members.series.keys()):
+			if values[1] == name and not values[2] in chans:
+				members.remove(*values)
+		for chan in chans:
+			members.labels('irc', name, chan).set(chans[chan])
 
-		cli.connect()
-		clients[key] = cli
+stats.addcollector(_collect)
 
 def sockets():
 	return client.sockets
 
+_tagescapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+# Unescapes an IRCv3 tag value, unknown escapes lose their backslash and a
+# trailing lone backslash is dropped
+def _unescapetag(value):
+	if value.find('\\') < 0:
+		return value
+	parts = []
+	i = 0
+	while i < len(value):
+		c = value[i]
+		if c == '\\':
+			i += 1
+			if i < len(value):
+				parts.append(_tagescapes.get(value[i], value[i]))
+		else:
+			parts.append(c)
+		i += 1
+	return ''.join(parts)
+
+# One parsed IRC line. The IRCv3 tags and the parts of the source prefix
+# are only split out when something asks for them, most lines never need
+# either.
+class message(object):
+	__slots__ = ('command', 'params', 'prefix', 'rawtags', '_tags', '_source')
+
+	def __init__(self, command, params, prefix=None, rawtags=None):
+		self.command = command
+		self.params = params
+		self.prefix = prefix
+		self.rawtags = rawtags
+		self._tags = None
+		self._source = None
+
+	def _splitprefix(self):
+		src = self.prefix
+		if src == None:
+			self._source = ('', '', '')
+			return self._source
+		host = ''
+		ident = ''
+		i = src.find('@')
+		if i >= 0:
+			host = src[i + 1:]
+			src = src[:i]
+		i = src.find('!')
+		if i >= 0:
+			ident = src[i + 1:]
+			src = src[:i]
+		self._source = (src, ident, host)
+		return self._source
+
+	@property
+	def nick(self):
+		return (self._source or self._splitprefix())[0]
+
+	@property
+	def ident(self):
+		return (self._source or self._splitprefix())[1]
+
+	@property
+	def host(self):
+		return (self._source or self._splitprefix())[2]
+
+	# Dict of tag name to value, tags without a value have ''
+	@property
+	def tags(self):
+		if self._tags == None:
+			self._tags = {}
+			if self.rawtags != None:
+				for tag in self.rawtags.split(';'):
+					if tag == '':
+						continue
+					i = tag.find('=')
+					if i < 0:
+						self._tags[tag] = ''
+					else:
+						self._tags[tag[:i]] = _unescapetag(tag[i + 1:])
+		return self._tags
+
+	def __repr__(self):
+		ret = 'message(' + self.command + ', ' + repr(self.params)
+		if self.prefix != None:
+			ret = ret + ', prefix=' + self.prefix
+		if self.rawtags != None:
+			ret = ret + ', tags=' + self.rawtags
+		return ret + ')'
+
+# Parses a line from the server (without its line ending) into a message,
+# None for a line with no command
+def parse(line):
+	rawtags = None
+	prefix = None
+	if line[0:1] == '@':
+		i = line.find(' ')
+		if i < 0:
+			return None
+		rawtags = line[1:i]
+		line = line[i + 1:].lstrip(' ')
+	if line[0:1] == ':':
+		i = line.find(' ')
+		if i < 0:
+			return None
+		prefix = line[1:i]
+		line = line[i + 1:]
+	i = line.find(' :')
+	if i >= 0:
+		params = line[:i].split()
+		params.append(line[i + 2:])
+	else:
+		params = line.split()
+	if len(params) < 1 or (i >= 0 and len(params) < 2):
+		return None
+	return message(params.pop(0).upper(), params, prefix, rawtags)
+
+# A nick seen on a connection, one object however many of our channels it is
+# in. channels has the key of each of those channels with the nick's
+# prefixes there ('@', '@+' with multi-prefix, '' for none).
+class ircuser(object):
+	__slots__ = ('nick', 'ident', 'host', 'account', 'gecos', 'away', 'channels')
+
+	def __init__(self, nick):
+		self.nick = nick
+		self.ident = None
+		self.host = None
+		self.account = None
+		self.gecos = None
+		self.away = False
+		self.channels = {}
+
+	def __repr__(self):
+		return 'ircuser(' + self.nick + ', ' + repr(self.channels) + ')'
+
+def _utf8(text):
+	if isinstance(text, unicode):
+		return text.encode('utf-8')
+	return text
+
+# Splits text into UTF-8 pieces of at most size bytes, only ever between
+# characters and at a space when there is one in the second half
+def splitutf8(text, size):
+	text = _utf8(text)
+	if len(text) <= size:
+		return [text]
+	size = max(size, 4)
+	ret = []
+	while len(text) > size:
+		i = size
+		while i > 0 and (ord(text[i]) & 0xc0) == 0x80:
+			i -= 1
+		if i == 0:
+			i = size
+		j = text.rfind(' ', size // 2, i)
+		if j > 0:
+			ret.append(text[:j])
+			text = text[j + 1:]
+		else:
+			ret.append(text[:i])
+			text = text[i:]
+	if len(text) > 0:
+		ret.append(text)
+	return ret
+
+def _unescapeisupport(value):
+	if value.find('\\x') < 0:
+		return value
+	parts = value.split('\\x')
+	ret = parts[0]
+	for part in parts[1:]:
+		try:
+			if len(part) < 2:
+				raise ValueError()
+			ret = ret + chr(int(part[0:2], 16)) + part[2:]
+		except ValueError:
+			ret = ret + '\\x' + part
+	return ret
+
+# Adds the tokens of an ISUPPORT (005) reply to table, a dict of token name
+# to value ('' for tokens without one). A -NAME token removes NAME.
+def parseisupport(tokens, table):
+	for token in tokens:
+		if token == '':
+			continue
+		if token[0] == '-':
+			table.pop(token[1:].upper(), None)
+			continue
+		i = token.find('=')
+		if i < 0:
+			table[token.upper()] = ''
+		else:
+			table[token[:i].upper()] = _unescapeisupport(token[i + 1:])
+
+def _intparam(value, default):
+	try:
+		n = int(value)
+	except (TypeError, ValueError):
+		return default
+	if n < 0:
+		return default
+	return n
+
+def _casemap(upper, lower):
+	return (string.maketrans(upper, lower), dict(zip([ord(c) for c in upper], [ord(c) for c in lower])))
+
+# CASEMAPPING values as translate() tables for str and unicode, two names
+# map to the same key when the server counts them as the same
+casemappings = {
+	'ascii': _casemap(string.ascii_uppercase, string.ascii_lowercase),
+	'rfc1459': _casemap(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+	'strict-rfc1459': _casemap(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+}
+
 class client:
 	sockets = []
 
-	def __init__(self, name, connfreq=30, pingfreq=120, capdelay=3, schedobj=None, schedpri=100,
+	def __init__(self, name, connfreq=30, pingfreq=120, capdelay=3, regtimeout=60, schedobj=None, schedpri=100,
 				nick='IRCBot', user='IRCBot', gecos='IRCBot',
-				server='localhost', port=6667, serverpassword=None, performs=[]):
+				server='localhost', port=6667, serverpassword=None, performs=[],
+				sendqhigh=262144, sendqlow=65536, queuesize=relay.QUEUE_SIZE, queuepolicy=relay.QUEUE_POLICY,
+				floodrate=0, floodburst=5, floodmerge=False, spoolconf=None, readsize=16384):
 		self.name = name
 		self._sock = None
+		self._sendq = None
+		self._sendqhigh = sendqhigh
+		self._sendqlow = sendqlow
 		self._connected = False
 		self._disconnecting = False
 		self._connfreq = connfreq
@@ -161,12 +528,17 @@ class client:
 		self._nexterrconnfreq = 10
 		self._pingfreq = pingfreq
 		self._pingrcvd = True
+		# CAP END is sent once the capabilities asked for are answered, or
+		# after capdelay seconds if the server doesn't get that far
 		self._capdelay = capdelay
 		self._iscap = False
+		self._capreqs = 0
+		self._capended = False
+		self._iscapls = True
 		self._caps = {} # key == cap, true == ack
 		self._sched = schedobj
 		self._schedpri = schedpri
-		self._schedevs = {'cap': None, 'conn': None, 'ping': None, 'perform': None, 'nick': None}
+		self._schedevs = {'cap': None, 'conn': None, 'ping': None, 'perform': None, 'nick': None, 'flood': None, 'outbox': None}
 		self._myid = {'nick': nick, 'user': user, 'gecos': gecos, 'curnick': nick, 'curnicknum': -1}
 		p = port
 		s = False
@@ -178,26 +550,84 @@ class client:
 				p = int(p)
 		self._server = {'server': server, 'curserver': server, 'port': p, 'password': serverpassword, 'ssl': s}
 		self._msgbinds = {}
-		self._ircbuf = ''
+		self._reader = None
+		self._readsize = readsize
 		self._performdone = False
+		# The performs and JOINs go out at the end of the MOTD, or this many
+		# seconds after 001 for a server that never sends one
+		self._performdelay = 10
 		self._nickdelay = 60
 		self._performs = performs
 		self._channels = {}
 		self._relays = {}
+		self._routes = {}
+		# Channel names as given to channel_add() and relay_add() by their
+		# key, so the keys can be remade if the case mapping changes
+		self._channames = {}
+		self._relaynames = {}
+		self._chankeys = {}
+		# The server's ISUPPORT tokens and the settings taken from them
+		self._isupport = {}
+		self._casemapping = DEFAULT_CASEMAPPING
+		self._casemap = casemappings[DEFAULT_CASEMAPPING]
+		self._linelen = DEFAULT_LINELEN
+		self._hostlen = DEFAULT_HOSTLEN
+		self._targmax = {}
+		self._prefixmodes = 'ov'
+		self._prefixes = '@+'
+		self._parammodes = ('beIk', 'l')
+		# Who is in each channel we're in: channel key to a dict of nick key
+		# to ircuser, _users has every ircuser by nick key. _names collects
+		# NAMES replies until their 366.
+		self._members = {}
+		self._users = {}
+		self._names = {}
+		# Relayed PRIVMSGs waiting for the end of this run of the loop, see
+		# _outboxadd()
+		self._outbox = None
+		self._outboxtexts = {}
+		self._outboxlast = {}
+		self._relaybatch = None
+		self._relaybatchorder = []
+		self._relayready = False
+		# Token bucket of lines, a rate of 0 sends everything straight away
+		self._floodrate = floodrate
+		self._floodburst = floodburst
+		self._floodmerge = floodmerge
+		self._floodtokens = floodburst
+		self._floodtime = time.time()
+		self._floodlanes = [deque(), deque()]
+		self._floodmerges = {}
+		# Relays wait in core.relay's queue while this many lines are in the relay lane
+		self._floodhigh = 64
 		if self._sched == None:
-			self._sched = sched.scheduler(time.time, time.sleep)
+			self._sched = scheduler.scheduler()
+		self._connector = connector.connector(self, server, p, self._sched, usessl=s,
+			onconnect=self._onconnect, onfail=self._onconnectfail,
+			timeouts={connector.CONN_REGISTERING: regtimeout}, schedpri=schedpri)
 		self.bindmsg('ping', self._m_ping)
+		self.bindmsg('001', self._m_001)
 		self.bindmsg('004', self._m_004)
 		self.bindmsg('005', self._m_005)
+		self.bindmsg('376', self._m_376)
+		self.bindmsg('422', self._m_376)
+		self.bindmsg('353', self._m_353)
+		self.bindmsg('366', self._m_366)
 		self.bindmsg('433', self._m_433)
 		self.bindmsg('privmsg', self._m_privmsg)
 		self.bindmsg('nick', self._m_nick)
 		self.bindmsg('join', self._m_join)
 		self.bindmsg('kick', self._m_kick)
 		self.bindmsg('part', self._m_part)
+		self.bindmsg('quit', self._m_quit)
+		self.bindmsg('mode', self._m_mode)
+		self.bindmsg('account', self._m_account)
+		self.bindmsg('away', self._m_away)
 		self.bindmsg('cap', self._m_cap)
 		self.bindmsg('error', self._m_error)
-		relay.bind('irc', self.name, self._relaycallback)
+		relay.setqueue('irc', self.name, queuesize, queuepolicy)
+		relay.setspool('irc', self.name, spoolconf, self._sched)
+		relay.bind('irc', self.name, self._relaycallback, self._relaybatchcallback)
 
 	def __del__(self):
 		try:
@@ -223,19 +653,19 @@ class client:
 
 	def _deltimer(self, event):
 		if self._sched:
-			if event in self._sched.queue:
-				self._sched.cancel(event)
+			self._sched.cancel(event)
 
 	def _execmsg(self, msgobj):
-		if msgobj['msg'].lower() in self._msgbinds:
-			for callback in self._msgbinds[msgobj['msg'].lower()]:
+		binds = self._msgbinds.get(msgobj.command.lower())
+		if binds != None:
+			for callback in binds:
 				callback(msgobj)
 
 	def _addsock(self):
 		if self._sock == None:
 			return
 		if not self._sock in self.sockets:
-			rbsocket.bindsockcallbacks(self._sock, self.dodisconnect, self.doerr, self.doread)
+			rbsocket.bindsockcallbacks(self._sock, self.dodisconnect, self.doerr, self.doread, self.dowrite)
 			self.sockets.append(self._sock)
 
 	def _delsock(self):
@@ -266,7 +696,54 @@ class client:
 		self._schedevs['ping'] = self._addtimer(delay=self._pingfreq, callback=self._doping)
 		self._pingrcvd = True
 
+	def _sendqfull(self, sendq):
+		log.warning('Send queue to ' + self._server['server'] + ' above high watermark (' + str(sendq.pending()) + ' bytes queued)', self)
+		self._updateready()
+
+	def _sendqdrained(self, sendq):
+		log.info('Send queue to ' + self._server['server'] + ' drained below low watermark', self)
+		self._updateready()
+
+	# Tells core.relay whether relays can be sent to us right now
+	def _updateready(self):
+		ready = self._connected and self._performdone and self._sendq != None and not self._sendq.abovehigh() \
+				and len(self._floodlanes[LANE_RELAY]) < self._floodhigh
+		if ready != self._relayready:
+			self._relayready = ready
+			relay.setready('irc', self.name, ready)
+
+	def _onconnect(self, s):
+		self._connected = True
+		self._sock = s
+		self._sendq = rbsocket.sendqueue(s, self._sendqhigh, self._sendqlow, self._sendqfull, self._sendqdrained)
+		self._reader = rbsocket.streamreader(s, self._readsize)
+		self._floodtokens = self._floodburst
+		self._floodtime = time.time()
+		self._addsock()
+		self._myid['curnick'] = self._myid['nick']
+
+		log.info('Connected to ' + self._server['server'] + ' on port ' + str(self._server['port']), self)
+
+		self._startping()
+
+		self.send('CAP LS')
+		if (self._server['password'] != None):
+			self.send('PASS :' + self._server['password'])
+		self.send('NICK ' + self._myid['nick'])
+		self.send('USER ' + self._myid['user'] + ' 0 * :' + self._myid['gecos'])
+
+	def _onconnectfail(self, reason):
+		log.error('Error connecting to ' + self._server['server'] + ': ' + reason, self)
+		if self._connected:
+			self.disconnect('', False)
+		self._schedconnect()
+
 	def _docapend(self):
+		self._deltimer(self._schedevs['cap'])
+		self._schedevs['cap'] = None
+		if self._capended:
+			return
+		self._capended = True
 		self.send('CAP END')
 
 	def _schedconnect(self, freq=None):
@@ -280,76 +757,164 @@ class client:
 	def _doline(self, line):
 		if ((line == None) or (line == '')):
 			return
-		log.protocol('<-- ' + line, self)
-		msg = self._parse_raw(line)
-		log.debug('Parsed message: ' + str(msg), self)
-		self._execmsg(msg)
-
-	def _parse_raw(self, line):
-		ret = {'source': {'full': "", 'name': "", 'ident': "", 'host': ""}, 'msg': "", 'params': []}
-
-		stat = 0
-
-		words = line.split(' ')
-		for word in words:
-			if ((stat < 3) and (len(word) == 0)):
-				continue
-
-			if (stat == 0):
-				stat += 1
-				if (word[0] == ":"):
-					 ret['source']['full'] = word[1:]
-				else:
-					ret['msg'] = word.upper()
-					stat += 1
-			elif (stat == 1):
-				ret['msg'] = word.upper()
-				stat += 1
-			elif (stat == 2):
-				if (word[0] == ":"):
-					ret['params'].append(word[1:])
-					stat += 1
-				else:
-					ret['params'].append(word)
-			else:
-				ret['params'][-1] = ret['params'][-1] + " " + word
-
-		if (len(ret['source']['full']) > 0):
-			src = ret['source']['full']
-			if (src.find("@") >= 0):
-				ret['source']['host'] = src[src.find("@")+1:]
-				src = src[:src.find("@")]
-			if (src.find("!") >= 0):
-				ret['source']['ident'] = src[src.find("!")+1:]
-				src = src[:src.find("!")]
-			ret['source']['name'] = src
-
-		return ret
+		trace.begin('irc', self)
+		try:
+			log.protocol('<-- ' + line, self)
+			msg = parse(line)
+			if msg == None:
+				return
+			log.debug('Parsed message: ' + str(msg), self)
+			self._execmsg(msg)
+		finally:
+			trace.end()
 
 	def _perform(self):
 		if self._performdone:
 			return
 		self._performdone = True
+		self._deltimer(self._schedevs['perform'])
+		self._schedevs['perform'] = None
 		for cmd in self._performs:
 			self.send(cmd)
-		for chan in self._channels:
-			if not self._channels[chan]:
-				self.send('JOIN ' + chan)
+		chans = [self._channames[chan] for chan in self._channels if not self._channels[chan]]
+		self.sendmany(self._joinlines(chans))
 		self._nexterrconnfreq = self._errconnfreq
-		self._schedevs['perform'] = None
+		# Relays queued while we were away go out after the JOINs
+		self._updateready()
 
 	def _m_ping(self, msg):
-		self.send('PONG :' + msg['params'][0])
+		self.send('PONG :' + msg.params[0])
+
+	# As few JOIN lines for chans as the server's line length and TARGMAX
+	# allow
+	def _joinlines(self, chans):
+		limit = self._maxtargets('JOIN', 0)
+		room = self._linelen - 2 - len('JOIN ')
+		lines = []
+		line = None
+		n = 0
+		for chan in chans:
+			chan = _utf8(chan)
+			if line != None and (len(line) + 1 + len(chan) <= room and (limit == 0 or n < limit)):
+				line = line + ',' + chan
+				n += 1
+				continue
+			if line != None:
+				lines.append('JOIN ' + line)
+			line = chan
+			n = 1
+		if line != None:
+			lines.append('JOIN ' + line)
+		return lines
+
+	def _m_001(self, msg):
+		self._connector.ready()
+		# Registered, any CAP END still to come would be too late
+		self._deltimer(self._schedevs['cap'])
+		self._schedevs['cap'] = None
+		self._capended = True
+		if self._schedevs['perform'] == None and not self._performdone:
+			self._schedevs['perform'] = self._addtimer(delay=self._performdelay, callback=self._perform)
 
 	def _m_004(self, msg):
-		self._server['curserver'] = msg['params'][1]
+		self._server['curserver'] = msg.params[1]
 
 	def _m_005(self, msg):
-		if self._schedevs['perform'] == None and not self._performdone:
-			self._schedevs['perform'] = self._addtimer(delay=3, callback=self._perform)
+		parseisupport(msg.params[1:-1], self._isupport)
+		self._applyisupport()
+
+	# End of MOTD, or no MOTD
+	def _m_376(self, msg):
+		self._perform()
+
+	def _applyisupport(self):
+		table = self._isupport
+		self._setcasemapping(table.get('CASEMAPPING', DEFAULT_CASEMAPPING).lower())
+		self._linelen = _intparam(table.get('LINELEN'), DEFAULT_LINELEN) or DEFAULT_LINELEN
+		self._hostlen = _intparam(table.get('HOSTLEN'), DEFAULT_HOSTLEN)
+		prefix = table.get('PREFIX', DEFAULT_PREFIX)
+		i = prefix.find(')')
+		if prefix[0:1] == '(' and i * 2 == len(prefix):
+			self._prefixmodes = prefix[1:i]
+			self._prefixes = prefix[i + 1:]
+		else:
+			self._prefixmodes = ''
+			self._prefixes = ''
+		# Modes that always take a parameter and those that only do when set
+		chanmodes = (table.get('CHANMODES', DEFAULT_CHANMODES).split(',') + ['', '', ''])[0:3]
+		self._parammodes = (chanmodes[0] + chanmodes[1], chanmodes[2])
+		# Command to the most targets it takes, 0 for no limit
+		self._targmax = {}
+		if 'TARGMAX' in table:
+			for item in table['TARGMAX'].split(','):
+				cmd, sep, n = item.partition(':')
+				self._targmax[cmd.upper()] = _intparam(n, 0)
+		elif 'MAXTARGETS' in table:
+			n = _intparam(table['MAXTARGETS'], 0)
+			self._targmax['PRIVMSG'] = n
+			self._targmax['NOTICE'] = n
+
+	def _maxtargets(self, cmd, default=1):
+		return self._targmax.get(cmd, default)
+
+	def _setcasemapping(self, name):
+		if name == self._casemapping:
+			return
+		self._casemapping = name
+		if not name in casemappings:
+			log.warning('Unknown CASEMAPPING ' + name + ' from ' + self._server['curserver'] + ', using ' + DEFAULT_CASEMAPPING, self)
+			name = DEFAULT_CASEMAPPING
+		if casemappings[name] is self._casemap:
+			return
+		self._casemap = casemappings[name]
+		self._chankeys = {}
+		# Only changes before we've joined anything, NAMES fills these again
+		self._members = {}
+		self._users = {}
+		self._names = {}
+		# Remake the keys from the names they were made from
+		channels = {}
+		names = {}
+		for key in self._channels:
+			orig = self._channames[key]
+			newkey = self._casefold(orig)
+			channels[newkey] = channels.get(newkey, False) or self._channels[key]
+			names[newkey] = orig
+		self._channels = channels
+		self._channames = names
+		relays = {}
+		names = {}
+		for key in self._relays:
+			orig = self._relaynames[key]
+			newkey = self._casefold(orig)
+			relays.setdefault(newkey, []).extend(self._relays[key])
+			names[newkey] = orig
+		self._relays = relays
+		self._relaynames = names
+		self._routes = {}
+		for key in self._relays:
+			self._compileroutes(key)
+
+	# The key a channel name or nick is kept under, equal for two names
+	# when the server treats them as the same
+	def _casefold(self, name):
+		if isinstance(name, unicode):
+			return name.translate(self._casemap[1])
+		return name.translate(self._casemap[0])
+
+	# _casefold() for relay target channels, which are the same few names
+	# over and over
+	def _chankey(self, name):
+		key = self._chankeys.get(name)
+		if key == None:
+			key = self._casefold(name)
+			if len(self._chankeys) >= 1024:
+				self._chankeys = {}
+			self._chankeys[name] = key
+		return key
 
 	def _m_433(self, msg):
-		if msg['params'][0].lower() != self._myid['curnick'].lower():
+		if self._casefold(msg.params[0]) != self._casefold(self._myid['curnick']):
 			self._myid['curnicknum'] = self._myid['curnicknum'] + 1
 			self._myid['curnick'] = self._myid['nick'] + str(self._myid['curnicknum'])
 			self.send('NICK ' + self._myid['curnick'])
@@ -357,61 +922,299 @@ class client:
 				self._schedevs['nick'] = self._addtimer(delay=self._nickdelay, callback=self._renick)
 
 	def _m_privmsg(self, msg):
-		if msg['params'][0].lower() in self._channels:
-			if msg['params'][0].lower() in self._relays:
-				for rel in self._relays[msg['params'][0].lower()]:
-					text = msg['params'][-1].decode('utf-8','ignore').encode("utf-8")
-					prefix = ''
-					if rel.extra['prefix'] != '':
-						prefix = rel.extra['prefix']
-					if text[0:7].lower() == '\x01action':
-						if text[-1] == '\x01':
-							text = text[:-1]
-						text = prefix + ' * ' + msg['source']['name'] + ' ' + text[8:]
-					else:
-						if prefix != '':
-							prefix = rel.extra['prefix'] + ' '
-						text = prefix + '<' + msg['source']['name'] + '> ' + text
-					relay.call(text, rel, relay.RelaySource('irc', self.name, msg['params'][0].lower(), {}), {'msg': msg})
+		chan = self._casefold(msg.params[0])
+		if not chan in self._channels:
+			return
+		routes = self._routes.get(chan)
+		if routes == None:
+			return
+		text = msg.params[-1].decode('utf-8','ignore').encode("utf-8")
+		if text[0:7].lower() == '\x01action':
+			if text[-1] == '\x01':
+				text = text[:-1]
+			text = ' * ' + msg.nick + ' ' + text[8:]
+			action = True
+		else:
+			text = '<' + msg.nick + '> ' + text
+			action = False
+		source, rels = routes
+		relay.startevent()
+		try:
+			for rel, msgprefix, actprefix in rels:
+				if action:
+					self._relay(actprefix + text, rel, source, trace.tag({'msg': msg}))
+				else:
+					self._relay(msgprefix + text, rel, source, trace.tag({'msg': msg}))
+		finally:
+			relay.endevent()
+
+	def _relay(self, text, rel, source, extra):
+		if self._relaybatch == None:
+			relay.call(text, rel, source, extra)
+			return
+		# Inside doread(), collect per target and relay them all at the end
+		key = (id(rel), id(source))
+		if not key in self._relaybatch:
+			self._relaybatch[key] = (rel, source, [])
+			self._relaybatchorder.append(key)
+		self._relaybatch[key][2].append((text, extra))
+
+	def _flushrelays(self):
+		batch = self._relaybatch
+		order = self._relaybatchorder
+		self._relaybatch = None
+		self._relaybatchorder = []
+		if batch == None:
+			return
+		relay.startevent()
+		try:
+			for key in order:
+				rel, source, messages = batch[key]
+				if len(messages) == 1:
+					relay.call(messages[0][0], rel, source, messages[0][1])
+				else:
+					relay.call_many(messages, rel, source)
+		finally:
+			relay.endevent()
+
+	# The ircuser for nick, made if it's new
+	def _getuser(self, nick, ident=None, host=None):
+		key = self._casefold(nick)
+		u = self._users.get(key)
+		if u == None:
+			if isinstance(key, str):
+				key = intern(key)
+			u = self._users[key] = ircuser(nick)
+		if ident:
+			u.ident = ident
+		if host:
+			u.host = host
+		return key, u
+
+	def _addmember(self, chan, nick, prefixes='', ident=None, host=None):
+		members = self._members.get(chan)
+		if members == None:
+			return None
+		key, u = self._getuser(nick, ident, host)
+		members[key] = u
+		u.channels[chan] = prefixes
+		return u
+
+	def _delmember(self, chan, key):
+		members = self._members.get(chan)
+		if members == None:
+			return
+		u = members.pop(key, None)
+		if u == None:
+			return
+		u.channels.pop(chan, None)
+		if len(u.channels) < 1 and self._users.get(key) is u:
+			del self._users[key]
+
+	def _clearmembers(self, chan):
+		self._dropnames(self._names.pop(chan, None))
+		members = self._members.pop(chan, None)
+		if members == None:
+			return
+		for key in members:
+			u = members[key]
+			u.channels.pop(chan, None)
+			if len(u.channels) < 1 and self._users.get(key) is u:
+				del self._users[key]
+
+	# Forgets nicks only seen in NAMES replies that won't be used
+	def _dropnames(self, names):
+		if names == None:
+			return
+		for key in names:
+			u = names[key][0]
+			if len(u.channels) < 1 and self._users.get(key) is u:
+				del self._users[key]
+
+	# A NAMES entry, '@+nick' or with userhost-in-names '@+nick!ident@host',
+	# as (prefixes, nick, ident, host)
+	def _splitname(self, name):
+		i = 0
+		while i < len(name) and name[i] in self._prefixes:
+			i += 1
+		prefixes = name[0:i]
+		name = name[i:]
+		ident = None
+		host = None
+		i = name.find('@')
+		if i >= 0:
+			host = name[i + 1:]
+			name = name[0:i]
+		i = name.find('!')
+		if i >= 0:
+			ident = name[i + 1:]
+			name = name[0:i]
+		return prefixes, name, ident, host
+
+	def _m_353(self, msg):
+		if len(msg.params) < 4:
+			return
+		chan = self._casefold(msg.params[2])
+		if not chan in self._members:
+			return
+		names = self._names.get(chan)
+		if names == None:
+			names = self._names[chan] = {}
+		for name in msg.params[3].split(' '):
+			if name == '':
+				continue
+			prefixes, nick, ident, host = self._splitname(name)
+			key, u = self._getuser(nick, ident, host)
+			names[key] = (u, prefixes)
+
+	# End of NAMES, the list replaces whatever we had for the channel
+	def _m_366(self, msg):
+		if len(msg.params) < 2:
+			return
+		chan = self._casefold(msg.params[1])
+		names = self._names.pop(chan, None)
+		members = self._members.get(chan)
+		if names == None:
+			return
+		if members == None:
+			self._dropnames(names)
+			return
+		for key in [key for key in members if not key in names]:
+			self._delmember(chan, key)
+		for key in names:
+			u, prefixes = names[key]
+			members[key] = u
+			u.channels[chan] = prefixes
 
 	def _m_join(self, msg):
-		chan = msg['params'][0]
-		if msg['source']['name'].lower() == self._myid['curnick'].lower():
-			if chan.lower() in self._channels:
-				self._channels[chan.lower()] = True
+		chan = self._casefold(msg.params[0])
+		if self._casefold(msg.nick) == self._casefold(self._myid['curnick']):
+			if chan in self._channels:
+				self._channels[chan] = True
+				self._clearmembers(chan)
+				self._members[chan] = {}
+		u = self._addmember(chan, msg.nick, '', msg.ident, msg.host)
+		# extended-join adds the account ('*' for none) and gecos
+		if u != None and len(msg.params) >= 3:
+			u.account = msg.params[1] if msg.params[1] != '*' else None
+			u.gecos = msg.params[2]
 
 	def _m_kick(self, msg):
-		if msg['params'][1].lower() == self._myid['curnick'].lower():
-			if msg['params'][0].lower() in self._channels:
-				self._channels[msg['params'][0].lower()] = False
-				self.send('JOIN ' + msg['params'][0])
+		chan = self._casefold(msg.params[0])
+		if self._casefold(msg.params[1]) == self._casefold(self._myid['curnick']):
+			self._clearmembers(chan)
+			if chan in self._channels:
+				self._channels[chan] = False
+				self.send('JOIN ' + msg.params[0])
+		else:
+			self._delmember(chan, self._casefold(msg.params[1]))
 
 	def _m_part(self, msg):
-		if msg['source']['name'].lower() == self._myid['curnick'].lower():
-			if msg['params'][0].lower() in self._channels:
-				self._channels[msg['params'][0].lower()] = False
-				self.send('JOIN ' + msg['params'][0])
+		chan = self._casefold(msg.params[0])
+		if self._casefold(msg.nick) == self._casefold(self._myid['curnick']):
+			self._clearmembers(chan)
+			if chan in self._channels:
+				self._channels[chan] = False
+				self.send('JOIN ' + msg.params[0])
+		else:
+			self._delmember(chan, self._casefold(msg.nick))
+
+	def _m_quit(self, msg):
+		key = self._casefold(msg.nick)
+		u = self._users.get(key)
+		if u == None:
+			return
+		# Or a 366 still to come would put them back
+		for chan in self._names:
+			self._names[chan].pop(key, None)
+		for chan in list(u.channels.keys()):
+			self._delmember(chan, key)
+		if len(u.channels) < 1 and self._users.get(key) is u:
+			del self._users[key]
+
+	# Only the prefix modes (op, voice, ...) matter here. Without
+	# multi-prefix a nick losing its highest prefix shows none until the
+	# next NAMES.
+	def _m_mode(self, msg):
+		if len(msg.params) < 2:
+			return
+		chan = self._casefold(msg.params[0])
+		members = self._members.get(chan)
+		if members == None:
+			return
+		args = msg.params[2:]
+		n = 0
+		adding = True
+		for c in msg.params[1]:
+			if c == '+':
+				adding = True
+			elif c == '-':
+				adding = False
+			elif c in self._prefixmodes:
+				if n >= len(args):
+					break
+				u = members.get(self._casefold(args[n]))
+				n += 1
+				if u == None:
+					continue
+				symbol = self._prefixes[self._prefixmodes.index(c)]
+				prefixes = u.channels[chan].replace(symbol, '')
+				if adding:
+					prefixes = ''.join(sorted(prefixes + symbol, key=self._prefixes.find))
+				u.channels[chan] = prefixes
+			elif c in self._parammodes[0] or (adding and c in self._parammodes[1]):
+				n += 1
+
+	# account-notify, '*' is logged out
+	def _m_account(self, msg):
+		u = self._users.get(self._casefold(msg.nick))
+		if u != None and len(msg.params) > 0:
+			u.account = msg.params[0] if msg.params[0] != '*' else None
+
+	# away-notify, no message is back
+	def _m_away(self, msg):
+		u = self._users.get(self._casefold(msg.nick))
+		if u != None:
+			u.away = len(msg.params) > 0 and msg.params[-1] != ''
 
 	def _m_nick(self, msg):
-		if msg['source']['name'].lower() == self._myid['curnick'].lower():
-			self._myid['curnick'] = msg['params'][0]
-			if self._myid['curnick'].lower() == self._myid['nick'].lower():
+		key = self._casefold(msg.nick)
+		u = self._users.pop(key, None)
+		if u != None:
+			newkey = self._casefold(msg.params[0])
+			if isinstance(newkey, str):
+				newkey = intern(newkey)
+			u.nick = msg.params[0]
+			self._users[newkey] = u
+			for chan in u.channels:
+				members = self._members[chan]
+				members.pop(key, None)
+				members[newkey] = u
+			# NAMES replies still waiting for their 366
+			for chan in self._names:
+				names = self._names[chan]
+				if key in names:
+					names[newkey] = names.pop(key)
+		if self._casefold(msg.nick) == self._casefold(self._myid['curnick']):
+			self._myid['curnick'] = msg.params[0]
+			if self._casefold(self._myid['curnick']) == self._casefold(self._myid['nick']):
 				self._myid['curnicknum'] = -1
 			log.info('Current nick changed to: ' + self._myid['curnick'], self)
 			if self._schedevs['nick'] != None:
 				self._deltimer(self._schedevs['nick'])
 				self._schedevs['nick'] = None
-			if self._myid['nick'].lower() != self._myid['curnick'].lower():
+			if self._casefold(self._myid['nick']) != self._casefold(self._myid['curnick']):
 				self._renick()
 
 	def _m_cap(self, msg):
 		if not self._iscap:
 			self._caps = {}
-			self._schedevs['cap'] = self._addtimer(delay=self._capdelay, callback=self._docapend)
+			if not self._capended:
+				self._schedevs['cap'] = self._addtimer(delay=self._capdelay, callback=self._docapend)
 		self._iscap = True
-		if (msg['params'][1] == 'LS' or msg['params'][1] == 'NEW'):
+		if (msg.params[1] == 'LS' or msg.params[1] == 'NEW'):
 			reqcaps = []
-			capsls = msg['params'][-1].split(' ')
+			capsls = msg.params[-1].split(' ')
 			knowncaps = ['account-notify', 'away-notify', 'extended-join', 'multi-prefix', 'userhost-in-names', 'cap-notify']
 			for cap in capsls:
 				if cap in knowncaps:
@@ -419,11 +1222,21 @@ class client:
 					self._caps[cap] = False
 			if len(reqcaps) > 0:
 				self.send('CAP REQ :' + ' '.join(reqcaps))
-		elif (msg['params'][1] == 'ACK'):
-			capsack = msg['params'][-1].split(' ')
-			for cap in capsack:
-				if cap in self._caps:
-					self._caps[cap] = True
+				self._capreqs += 1
+			# A '*' before the list means more LS lines follow
+			if msg.params[1] == 'LS' and not (len(msg.params) > 3 and msg.params[2] == '*'):
+				self._iscapls = False
+				if self._capreqs < 1:
+					self._docapend()
+		elif (msg.params[1] == 'ACK' or msg.params[1] == 'NAK'):
+			if (msg.params[1] == 'ACK'):
+				capsack = msg.params[-1].split(' ')
+				for cap in capsack:
+					if cap in self._caps:
+						self._caps[cap] = True
+			self._capreqs -= 1
+			if self._capreqs < 1 and not self._iscapls:
+				self._docapend()
 
 	def _m_error(self, msg):
 		log.info('Disconnected from ' + self._server['server'] + ', attemoting to reconnect', self)
@@ -436,11 +1249,141 @@ class client:
 		self._schedevs['nick'] = self._addtimer(delay=self._nickdelay, callback=self._renick)
 
 	def _relaycallback(self, data):
+		if self._ircwho(data):
+			return
 		if data.text == None:
 			return
 		if self._connected and self._performdone:
-			if data.target.channel.lower() in self._channels:
-				self.send('PRIVMSG ' + data.target.channel + ' :' + data.text)
+			if self._chankey(data.target.channel) in self._channels:
+				if self._maxtargets('PRIVMSG') != 1:
+					self._outboxadd(data.target.channel, data.text, data.extra.get('trace'))
+					return
+				lines = self._privmsglines([data.target.channel], data.text)
+				self.sendmany(lines, LANE_RELAY, [None] * (len(lines) - 1) + [data.extra.get('trace')])
+
+	def _relaybatchcallback(self, datas):
+		if not self._connected or not self._performdone:
+			return
+		merge = self._maxtargets('PRIVMSG') != 1
+		lines = []
+		traces = []
+		for data in datas:
+			if self._ircwho(data):
+				continue
+			if data.text == None:
+				continue
+			if self._chankey(data.target.channel) in self._channels:
+				if merge:
+					self._outboxadd(data.target.channel, data.text, data.extra.get('trace'))
+					continue
+				more = self._privmsglines([data.target.channel], data.text)
+				lines.extend(more)
+				traces.extend([None] * (len(more) - 1))
+				traces.append(data.extra.get('trace'))
+		self.sendmany(lines, LANE_RELAY, traces)
+
+	# A Minecraft player's ?irc is answered with who is in the channel their
+	# chat was relayed to, from the membership kept here rather than a NAMES
+	def _ircwho(self, data):
+		if data.source.type != 'minecraft':
+			return False
+		text = getattr(data.extra.get('obj'), 'message', None)
+		if not isinstance(text, basestring) or _ircwhoreg.match(text) == None:
+			return False
+		chan = data.target.channel
+		key = self._chankey(chan)
+		members = self.members(chan)
+		if members == None or not self._connected:
+			text = 'Not in ' + chan + ' right now'
+		else:
+			me = self._casefold(self._myid['curnick'])
+			names = [prefixes[0:1] + nick for prefixes, nick in members if self._casefold(nick) != me]
+			text = chan + ' (' + str(len(names)) + ')'
+			size = len(text)
+			for i in range(len(names)):
+				if size + len(names[i]) > IRCWHO_MAX:
+					text = text + ' and ' + str(len(names) - i) + ' more'
+					break
+				text = text + (': ' if i == 0 else ', ') + names[i]
+				size += len(names[i]) + 2
+		# Back along this channel's relay to the player's client if there is
+		# one, so its prefix and filters apply
+		routes = self._routes.get(key)
+		if routes != None:
+			source = routes[0]
+			rels = [(rel, msgprefix) for rel, msgprefix, actprefix in routes[1]
+					if rel.type == data.source.type and rel.name == data.source.name]
+		else:
+			source = relay.RelaySource('irc', self.name, key, {})
+			rels = []
+		if len(rels) < 1:
+			rels = [(relay.RelayTarget(data.source.type, data.source.name, data.source.channel, {}, None), '[' + self.name + '] ')]
+		for rel, prefix in rels:
+			relay.call(prefix + text, rel, source, relay.nexthop(data))
+		trace.finish(data.extra.get('trace'))
+		return True
+
+	# Bytes of text a PRIVMSG to targets can carry. Both the line we send and
+	# the copy the server sends on to each target, with our nick!user@host in
+	# front, have to fit in LINELEN with their CRLF.
+	def _privmsgroom(self, targets):
+		targets = [_utf8(t) for t in targets]
+		ours = len(','.join(targets))
+		theirs = len(self._myid['curnick']) + len(self._myid['user']) + self._hostlen + 5 + max([len(t) for t in targets])
+		return max(self._linelen - 12 - max(ours, theirs), 16)
+
+	# PRIVMSG lines sending text to targets, split where it doesn't fit
+	def _privmsglines(self, targets, text):
+		head = 'PRIVMSG ' + ','.join([_utf8(t) for t in targets]) + ' :'
+		return [head + part for part in splitutf8(text, self._privmsgroom(targets))]
+
+	# With TARGMAX allowing more than one target, relayed PRIVMSGs wait here
+	# until the end of this run of the loop so a text relayed to several
+	# channels goes out as one PRIVMSG #a,#b line. A channel is only added to
+	# an earlier line when it has nothing waiting after that line, so every
+	# channel still gets its messages in order.
+	def _outboxadd(self, chan, text, tr):
+		chan = _utf8(chan)
+		text = _utf8(text)
+		key = self._chankey(chan)
+		if self._outbox == None:
+			self._outbox = []
+			self._outboxtexts = {}
+			self._outboxlast = {}
+			self._schedevs['outbox'] = self._addtimer(delay=0, callback=self._outboxflush)
+		i = self._outboxtexts.get(text)
+		if i != None and self._outboxlast.get(key, -1) < i:
+			entry = self._outbox[i]
+			limit = self._maxtargets('PRIVMSG')
+			if (limit == 0 or len(entry[0]) < limit) and len(text) <= self._privmsgroom(entry[0] + [chan]):
+				entry[0].append(chan)
+				if tr != None:
+					entry[1].append(tr)
+				self._outboxlast[key] = i
+				return
+		entry = [[chan], [], text]
+		if tr != None:
+			entry[1].append(tr)
+		self._outbox.append(entry)
+		self._outboxtexts[text] = len(self._outbox) - 1
+		self._outboxlast[key] = len(self._outbox) - 1
+
+	def _outboxflush(self):
+		self._schedevs['outbox'] = None
+		outbox = self._outbox
+		self._outbox = None
+		self._outboxtexts = {}
+		self._outboxlast = {}
+		if outbox == None or not self._connected:
+			return
+		lines = []
+		traces = []
+		for targets, trs, text in outbox:
+			more = self._privmsglines(targets, text)
+			lines.extend(more)
+			traces.extend([None] * (len(more) - 1))
+			traces.append(trs)
+		self.sendmany(lines, LANE_RELAY, traces)
 
 	def bindmsg(self, msg, callback):
 		if not msg.lower() in self._msgbinds:
@@ -456,7 +1399,7 @@ class client:
 				del self._msgbinds[msg.lower()]
 
 	def connect(self):
-		self._ircbuf = ''
+		self._reader = None
 		self._performdone = False
 		if self._schedevs['conn'] != None:
 			self._deltimer(self._schedevs['conn'])
@@ -467,62 +1410,7 @@ class client:
 		self._schedevs['perform'] = None
 		log.info('Attempting to connect to ' + self._server['server'] + ' on port ' + str(self._server['port']), self)
 
-		addrs = []
-
-		try:
-			addrs = socket.getaddrinfo(self._server['server'], self._server['port'], 0, 0, socket.IPPROTO_TCP)
-		except socket.gaierror as e:
-			log.error('Error connecting to ' + self._server['server'] + ': ' + e.strerror, self)
-		except:
-			log.error('Unknown error looking up host name ' + self._server['server'], self)
-
-		if (len(addrs) < 1):
-			self._schedconnect()
-			return
-
-		s = None
-		for addr in addrs:
-			af, socktype, proto, canonname, sa = addr
-			try:
-				s = rbsocket.rbsocket(af, socktype, proto)
-			except socket.error as e:
-				s = None
-				continue
-			try:
-				s.connect(sa)
-			except socket.error as e:
-				s.close()
-				s = None
-				continue
-			break
-
-		if s == None:
-			log.error('Error connecting to ' + self._server['server'], self)
-			self._schedconnect()
-			return
-
-		if self._server['ssl']:
-			try:
-				s = ssl.wrap_socket(s)
-			except Exception as e:
-				log.error('Error connectng ssl to ' + self._server['server'] + ': ' + str(e), self)
-				self._schedconnect()
-				return
-
-		self._connected = True
-		self._sock = s
-		self._addsock()
-		self._myid['curnick'] = self._myid['nick']
-
-		log.info('Connected to ' + self._server['server'] + ' on port ' + str(self._server['port']), self)
-
-		self._startping()
-
-		self.send('CAP LS')
-		if (self._server['password'] != None):
-			self.send('PASS :' + self._server['password'])
-		self.send('NICK ' + self._myid['nick'])
-		self.send('USER ' + self._myid['user'] + ' 0 * :' + self._myid['gecos'])
+		self._connector.start()
 
 		return
 
@@ -535,89 +1423,295 @@ class client:
 		if (sendexit):
 			self.send('QUIT :Disconnecting' + reason)
 		self._cancelping()
+		self._connector.abort()
 		self._delsock()
 		try:
 			self._sock.close()
 		except:
 			self._sock = None
 		self._sock = None
+		self._sendq = None
+		self._reader = None
 		self._connected = False
 		self._performdone = False
 		self._iscap = False
+		self._capreqs = 0
+		self._capended = False
+		self._iscapls = True
 		self._disconnecting = False
+		self._floodlanes = [deque(), deque()]
+		self._floodmerges = {}
+		self._updateready()
 		self._server['curserver'] = self._server['server']
 		for ev in self._schedevs:
 			self._deltimer(self._schedevs[ev])
+		self._schedevs['flood'] = None
+		self._schedevs['outbox'] = None
+		self._outbox = None
 		for chan in self._channels:
 			self._channels[chan] = False
+		self._members = {}
+		self._users = {}
+		self._names = {}
+		self._isupport = {}
+		self._applyisupport()
 		return
 
-	def send(self, line):
-		sent = 0
-		try:
+	# Lines are written straight away unless flood control is on, then they
+	# wait in their lane until the token bucket allows them. QUIT never waits.
+	# tr is the trace of the relay being sent, finished once it is written.
+	def send(self, line, lane=LANE_CONTROL, tr=None):
+		if self._floodrate > 0 and self._sendq != None and line[0:5].upper() != 'QUIT ':
+			self._floodqueue(line, lane, tr)
+			self._floodrun()
+			return
+		self._writelines([line])
+		trace.finish(tr)
+
+	# Like send() for several lines, queued with a single write. traces, if
+	# given, has the trace (or None, or a list of traces) of each line.
+	def sendmany(self, lines, lane=LANE_CONTROL, traces=None):
+		if self._floodrate > 0 and self._sendq != None:
+			for i in range(len(lines)):
+				if traces != None:
+					self._floodqueue(lines[i], lane, traces[i])
+				else:
+					self._floodqueue(lines[i], lane)
+			self._floodrun()
+			return
+		self._writelines(lines)
+		if traces != None:
+			for tr in traces:
+				if isinstance(tr, list):
+					for t in tr:
+						trace.finish(t)
+				else:
+					trace.finish(tr)
+
+	def _writelines(self, lines):
+		if len(lines) < 1:
+			return
+		texts = []
+		for line in lines:
 			if isinstance(line, unicode):
-				text = line.encode('UTF-8')
+				texts.append(line.encode('UTF-8'))
 			elif isinstance(line, str):
-				 text = line
-			else:
-				text = ''
-			sent = self._sock.send(text + '\r\n')
+				texts.append(line)
+		try:
+			self._sendq.write('\r\n'.join(texts) + '\r\n')
 		except Exception as e:
-			sent = 0
-		if (sent == 0):
 			log.info('Disconnected from ' + self._server['server'] + ', attemoting to reconnect', self)
 			self.disconnect('', False)
 			self._schedconnect()
 			return
-		log.protocol('--> ' + line, self)
+		for line in lines:
+			log.protocol('--> ' + line, self)
+
+	def _floodqueue(self, line, lane, tr=None):
+		if tr == None:
+			trs = []
+		elif isinstance(tr, list):
+			trs = list(tr)
+		else:
+			trs = [tr]
+		# With merging on a relayed PRIVMSG is added to the last one still
+		# waiting for the same channel if the result isn't too long
+		if lane == LANE_RELAY and self._floodmerge and line[0:8].upper() == 'PRIVMSG ':
+			i = line.find(' :')
+			if i > 0:
+				key = self._casefold(line[0:i + 2])
+				entry = self._floodmerges.get(key)
+				if entry != None and len(entry[0]) - i - 2 + 3 + len(line) - i - 2 <= self._privmsgroom(line[8:i].split(',')):
+					try:
+						entry[0] = entry[0] + ' | ' + line[i + 2:]
+						entry[2].extend(trs)
+						return
+					except UnicodeDecodeError:
+						pass
+				entry = [line, key, trs]
+				self._floodmerges[key] = entry
+				self._floodlanes[lane].append(entry)
+				return
+		self._floodlanes[lane].append([line, None, trs])
+
+	def _floodtimer(self):
+		self._schedevs['flood'] = None
+		self._floodrun()
+
+	def _floodrun(self):
+		now = time.time()
+		if self._floodrate > 0:
+			self._floodtokens = min(self._floodburst, self._floodtokens + (now - self._floodtime) * self._floodrate)
+		self._floodtime = now
+		lines = []
+		traces = []
+		for lane in self._floodlanes:
+			while len(lane) > 0 and (self._floodtokens >= 1 or self._floodrate <= 0):
+				entry = lane.popleft()
+				if entry[1] != None and self._floodmerges.get(entry[1]) is entry:
+					del self._floodmerges[entry[1]]
+				lines.append(entry[0])
+				traces.extend(entry[2])
+				self._floodtokens -= 1
+		if self._floodtokens < 0:
+			self._floodtokens = 0
+		self._writelines(lines)
+		for tr in traces:
+			trace.finish(tr)
+		waiting = len(self._floodlanes[LANE_CONTROL]) + len(self._floodlanes[LANE_RELAY])
+		if waiting > 0 and self._schedevs['flood'] == None and self._connected:
+			self._schedevs['flood'] = self._addtimer(delay=(1 - self._floodtokens) / self._floodrate, callback=self._floodtimer)
+		self._updateready()
+
+	def setflood(self, rate, burst, merge):
+		self._floodrate = rate
+		self._floodburst = burst
+		self._floodmerge = merge
+		self._floodtokens = min(self._floodtokens, burst)
+		if not merge:
+			self._floodmerges = {}
+		self._floodrun()
+
+	def sendqueue(self):
+		return self._sendq
+
+	def connector(self):
+		return self._connector
+
+	# Who is in channel as a list of (prefixes, nick) by rank and then nick,
+	# None if we aren't in it
+	def members(self, channel):
+		chan = self._casefold(channel)
+		members = self._members.get(chan)
+		if members == None:
+			return None
+		ret = []
+		for key in members:
+			u = members[key]
+			prefixes = u.channels.get(chan, '')
+			rank = self._prefixes.find(prefixes[0:1]) if prefixes != '' else len(self._prefixes)
+			ret.append((rank, key, prefixes, u.nick))
+		ret.sort()
+		return [(prefixes, nick) for rank, key, prefixes, nick in ret]
+
+	# Channel name to its number of nicks for every channel we're in
+	def channels(self):
+		ret = {}
+		for chan in self._members:
+			ret[self._channames.get(chan, chan)] = len(self._members[chan])
+		return ret
 
 	def channel_add(self, channel):
 		if channel == None or channel == '':
 			return
-		if not channel.lower() in self._channels:
-			self._channels[channel.lower()] = False
+		key = self._casefold(channel)
+		if not key in self._channels:
+			self._channels[key] = False
+			self._channames[key] = channel
 		if self._connected and self._performdone:
 			self.send('JOIN ' + channel)
 
+	def channel_del(self, channel):
+		if channel == None or channel == '':
+			return
+		key = self._casefold(channel)
+		if not key in self._channels:
+			return
+		joined = self._channels.pop(key)
+		del self._channames[key]
+		self._clearmembers(key)
+		if joined and self._connected:
+			self.send('PART ' + channel)
+
 	def relay_add(self, relchan, type, name, channel, prefix, what=None, filters=None):
 		rel = relay.RelayTarget(type, name, channel, {'prefix': prefix}, filters)
-		if relchan.lower() in self._relays:
-			if not rel in self._relays[relchan.lower()]:
-				self._relays[relchan.lower()].append(rel)
+		key = self._casefold(relchan)
+		if key in self._relays:
+			if not rel in self._relays[key]:
+				self._relays[key].append(rel)
 		else:
-			self._relays[relchan.lower()] = [rel]
+			self._relays[key] = [rel]
+			self._relaynames[key] = relchan
+		self._compileroutes(key)
 		log.debug('Added relay rule for channel ' + relchan + ' (type:' + type + ', name:' + name + ', channel:' + channel + ', prefix:' + prefix + ')', self)
 
+	def relay_del(self, relchan, type, name, channel, prefix):
+		key = self._casefold(relchan)
+		if not key in self._relays:
+			return
+		rels = self._relays[key]
+		for rel in rels:
+			if rel.type == type and rel.name == name and rel.channel == channel and rel.extra['prefix'] == prefix:
+				rels.remove(rel)
+				log.debug('Removed relay rule for channel ' + relchan + ' (type:' + type + ', name:' + name + ', channel:' + channel + ', prefix:' + prefix + ')', self)
+				break
+		if len(rels) < 1:
+			del self._relays[key]
+			del self._relaynames[key]
+		self._compileroutes(key)
+
+	def _compileroutes(self, chan):
+		# Per channel source and relay targets with their prefixes already
+		# formatted for normal messages and actions
+		if not chan in self._relays:
+			if chan in self._routes:
+				del self._routes[chan]
+			return
+		rels = []
+		for rel in self._relays[chan]:
+			if rel.extra['prefix'] != '':
+				rels.append((rel, rel.extra['prefix'] + ' ', rel.extra['prefix']))
+			else:
+				rels.append((rel, '', ''))
+		self._routes[chan] = (relay.RelaySource('irc', self.name, chan, {}), rels)
+
+	def stop(self, reason=''):
+		self.disconnect(reason, self._connected)
+		relay.unbind('irc', self.name, self._relaycallback)
+
 	def doread(self, sock):
-		if self._sock != sock:
+		if self._sock != sock or self._reader == None:
 			return
 
 		try:
-			buf = self._ircbuf + self._sock.recv(1024)
+			n = self._reader.fill()
 		except Exception as e:
 			log.error('Exception receving from socket: ' + str(e))
-			buf = ''
+			n = 0
 
-		if (buf == ''):
+		if n == None:
+			return
+		if n == 0:
 			log.info('Received no data from ' + self._server['server'] + ', attemoting to reconnect', self)
 			self.disconnect('', False)
 			self._schedconnect()
 			return
 
-		lines = buf.replace('\r', '\n').split('\n')
-		if ((len(lines) > 0) and (lines[-1] != '')):
-			self._ircbuf = lines[-1]
-			del lines[-1]
-		else:
-			self._ircbuf = ''
+		lines = self._reader.lines()
 
 		self._checkping()
 
-		for line in lines:
-			self._doline(line)
+		self._relaybatch = {}
+		try:
+			for line in lines:
+				self._doline(line)
+		finally:
+			self._flushrelays()
 
 		return
 
+	def dowrite(self, sock):
+		if self._sock != sock or self._sendq == None:
+			return
+
+		try:
+			self._sendq.flush()
+		except Exception as e:
+			log.info('Error sending to ' + self._server['server'] + ': ' + str(e) + ', attemoting to reconnect', self)
+			self.disconnect('', False)
+			self._schedconnect()
+		return
+
 	def doerr(self, sock):
 		log.info('Exceptional condition from ' + self._server['server'] + ', attemoting to reconnect', self)
 		self.disconnect('', False)
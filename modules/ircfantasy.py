@@ -23,12 +23,19 @@ import re
 
 from core.rblogging import *
 import core.relay as relay
+import core.filters as filters
+import core.shard as shard
 
 configs = {}
 clients = {}
 
 def loadconfig(doc):
-	global configs, clients
+	global configs
+
+	configs = parseconfig(doc)
+
+def parseconfig(doc):
+	configs = {}
 
 	cliconfs = doc.findall('./ircfantasy')
 
@@ -58,19 +65,53 @@ def loadconfig(doc):
 				log.info('Ignoring attempt to relay IRC to itself')
 				continue
 			relnew = rel.attrib
+			relnew['regex'] = filters.parseconfig(rel)
 			conf['relays'].append(relnew)
 
 		configs[name] = conf
 
+	return configs
+
 def runconfig(timers):
 	global configs, clients
 
 	for key in configs:
-		conf = configs[key]
-		cli = client(key)
-		for rel in conf['relays']:
-			cli.relay_add(rel['type'], rel['name'], rel['channel'])
-		clients[key] = cli
+		if not shard.islocal('ircfantasy', key):
+			continue
+		_startclient(key)
+
+def _startclient(key):
+	global configs, clients
+
+	conf = configs[key]
+	cli = client(key)
+	for rel in conf['relays']:
+		cli.relay_add(rel['type'], rel['name'], rel['channel'], filters.chain(rel['regex']))
+	clients[key] = cli
+
+def reloadconfig(newconfigs, timers):
+	global configs, clients
+
+	oldconfigs = configs
+	configs = newconfigs
+
+	for key in oldconfigs:
+		if not key in configs and key in clients:
+			clients.pop(key).stop()
+
+	for key in configs:
+		if not shard.islocal('ircfantasy', key):
+			continue
+		if not key in clients:
+			_startclient(key)
+			continue
+		cli = clients[key]
+		for rel in oldconfigs[key]['relays']:
+			if not rel in configs[key]['relays']:
+				cli.relay_del(rel['type'], rel['name'], rel['channel'])
+		for rel in configs[key]['relays']:
+			if not rel in oldconfigs[key]['relays']:
+				cli.relay_add(rel['type'], rel['name'], rel['channel'], filters.chain(rel['regex']))
 
 def sockets():
     return []
@@ -92,8 +133,8 @@ class client():
 		src = data.source
 
 		if src.type == 'irc':
-			if data.extra['msg']['params'][-1][0:8] == '?testing':
-				self._callrelay("I R A TEST", None)
+			if data.extra['msg'].params[-1][0:8] == '?testing':
+				self._callrelay("I R A TEST", None, extra=relay.nexthop(data))
 
 	def _callrelay(self, text, obj, type=None, name=None, channel=None, extra={}):
 		for rel in self._relays:
@@ -108,7 +149,17 @@ class client():
 				e[k] = extra[k]
 			relay.call(text, rel, relay.RelaySource('ircfantasy', self.name, None, {}), e)
 
-	def relay_add(self, type, name, channel):
-		rel = relay.RelayTarget(type, name, channel, {}, None)
+	def relay_add(self, type, name, channel, filters=None):
+		rel = relay.RelayTarget(type, name, channel, {}, filters)
 		self._relays.append(rel)
 		log.debug('Added relay rule (type:' + type + ', name:' + name + ', channel:' + channel + ')', self)
+
+	def relay_del(self, type, name, channel):
+		for rel in self._relays:
+			if rel.type == type and rel.name == name and rel.channel == channel:
+				self._relays.remove(rel)
+				log.debug('Removed relay rule (type:' + type + ', name:' + name + ', channel:' + channel + ')', self)
+				break
+
+	def stop(self):
+		relay.unbind('ircfantasy', self.name, self._relaycallback)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+# RelayBot - Simple Multi-protocol Relay Bot, modules/metrics.py
+#
+# Copyright (C) 2016 Matthew Beeching
+#
+# This file is part of RelayBot.
+#
+# RelayBot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RelayBot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
+
+# Serves core.stats over HTTP in the Prometheus text format. The listener
+# and its connections are non-blocking sockets on the run loop like any
+# other, a scrape only costs the loop the time to render the page.
+
+import socket, time
+
+from core.rblogging import *
+import core.rbsocket as rbsocket
+import core.shard as shard
+import core.stats as stats
+
+configs = None
+server = None
+
+# Requests larger than this or taking longer than REQUEST_TIMEOUT seconds
+# are dropped
+REQUEST_MAX = 8192
+REQUEST_TIMEOUT = 10
+
+def loadconfig(doc):
+	global configs
+
+	configs = parseconfig(doc)
+
+def parseconfig(doc):
+	confs = doc.findall('./metrics')
+	if len(confs) > 1:
+		log.error('Too many metrics elements')
+		raise Exception('Too many metrics elements')
+	if len(confs) < 1:
+		return None
+
+	conf = {'host': '127.0.0.1', 'port': None}
+	if 'host' in confs[0].attrib and confs[0].attrib['host'] != '':
+		conf['host'] = confs[0].attrib['host']
+	if not 'port' in confs[0].attrib:
+		log.error('Metrics config missing port attribute')
+		raise Exception('Metrics config missing port attribute')
+	try:
+		conf['port'] = int(confs[0].attrib['port'])
+	except ValueError:
+		conf['port'] = -1
+	if conf['port'] < 1 or conf['port'] > 65535:
+		log.error('Invalid metrics port: ' + confs[0].attrib['port'])
+		raise Exception('Invalid metrics port: ' + confs[0].attrib['port'])
+	return conf
+
+def _start(timers):
+	global server
+
+	if configs == None:
+		return
+	# Every worker serves its own stats, on consecutive ports
+	port = configs['port'] + shard.index
+	try:
+		server = listener(configs['host'], port, timers)
+	except socket.error as e:
+		log.error('Unable to listen for metrics on ' + configs['host'] + ' port ' + str(port) + ': ' + str(e))
+		server = None
+
+def _stop():
+	global server
+
+	if server != None:
+		server.close()
+		server = None
+
+def runconfig(timers):
+	_start(timers)
+
+def reloadconfig(newconfigs, timers):
+	global configs
+
+	if newconfigs == {}:
+		newconfigs = None
+	if newconfigs == configs:
+		return
+	_stop()
+	configs = newconfigs
+	_start(timers)
+
+def sockets():
+	return []
+
+def _escape(value):
+	if value == None:
+		return ''
+	if not isinstance(value, basestring):
+		value = str(value)
+	return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=''):
+	parts = [names[i] + '="' + _escape(values[i]) + '"' for i in range(min(len(names), len(values)))]
+	if extra != '':
+		parts.append(extra)
+	if len(parts) < 1:
+		return ''
+	return '{' + ','.join(parts) + '}'
+
+def _number(value):
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+def _histogram(lines, name, labelnames, values, h):
+	n = 0
+	for i in range(stats.BUCKETS - 1):
+		n += h.buckets[i]
+		lines.append(name + '_bucket' + _labels(labelnames, values, 'le="' + repr((1 << i) / 1000000.0) + '"') + ' ' + str(n))
+	lines.append(name + '_bucket' + _labels(labelnames, values, 'le="+Inf"') + ' ' + str(h.count))
+	lines.append(name + '_sum' + _labels(labelnames, values) + ' ' + repr(h.total))
+	lines.append(name + '_count' + _labels(labelnames, values) + ' ' + str(h.count))
+
+# The whole page, the labelled metrics followed by the plain counters and
+# latency histograms also shown by SIGUSR1
+def render():
+	stats.collect()
+	lines = []
+	for name in sorted(stats.metrics.keys()):
+		fam = stats.metrics[name]
+		if len(fam.series) < 1:
+			continue
+		lines.append('# HELP ' + name + ' ' + fam.help)
+		lines.append('# TYPE ' + name + ' ' + fam.kind)
+		for values in sorted(fam.series.keys()):
+			s = fam.series[values]
+			if fam.kind == 'histogram':
+				_histogram(lines, name, fam.labelnames, values, s)
+			else:
+				lines.append(name + _labels(fam.labelnames, values) + ' ' + _number(s.value))
+	if len(stats.counters) > 0:
+		lines.append('# HELP relaybot_events_total Internal event counters')
+		lines.append('# TYPE relaybot_events_total counter')
+		for name in sorted(stats.counters.keys()):
+			lines.append('relaybot_events_total' + _labels(('name',), (name,)) + ' ' + str(stats.counters[name]))
+	if len(stats.histograms) > 0:
+		lines.append('# HELP relaybot_timing_seconds Internal timings, "loop lateness" is the run loop\'s lag')
+		lines.append('# TYPE relaybot_timing_seconds histogram')
+		for name in sorted(stats.histograms.keys()):
+			_histogram(lines, 'relaybot_timing_seconds', ('name',), (name,), stats.histograms[name])
+	ret = '\n'.join(lines) + '\n'
+	if isinstance(ret, unicode):
+		ret = ret.encode('utf-8')
+	return ret
+
+class listener:
+	def __init__(self, host, port, schedobj):
+		self.host = host
+		self.port = port
+		self._sched = schedobj
+		self._sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+		try:
+			self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self._sock.setblocking(0)
+			self._sock.bind((host, port))
+			self._sock.listen(16)
+		except socket.error:
+			self._sock.close()
+			raise
+		self._conns = []
+		rbsocket.bindsockcallbacks(self._sock, None, None, self._doaccept, None)
+		log.info('Serving metrics on ' + host + ' port ' + str(port))
+
+	def _doaccept(self, sock):
+		while True:
+			try:
+				conn, addr = self._sock.accept()
+			except socket.error as e:
+				if not rbsocket.wouldblock(e):
+					log.error('Error accepting metrics connection: ' + str(e))
+				return
+			self._conns.append(connection(self, conn))
+
+	def close(self):
+		rbsocket.unbindsockcallbacks(self._sock)
+		self._sock.close()
+		for conn in list(self._conns):
+			conn.close()
+		log.info('Stopped serving metrics on ' + self.host + ' port ' + str(self.port))
+
+# One HTTP/1.0 style request: read the request head, answer and close
+class connection:
+	def __init__(self, server, sock):
+		self._server = server
+		self._sock = sock
+		self._sock.setblocking(0)
+		self._buf = ''
+		self._done = False
+		self._sendq = rbsocket.sendqueue(sock)
+		self._timer = server._sched.enter(REQUEST_TIMEOUT, 100, self.close, ())
+		rbsocket.bindsockcallbacks(sock, None, None, self._doread, self._dowrite)
+
+	def _doread(self, sock):
+		try:
+			buf = self._sock.recv(4096)
+		except socket.error as e:
+			if rbsocket.wouldblock(e):
+				return
+			buf = ''
+		if buf == '':
+			self.close()
+			return
+		if self._done:
+			return
+		self._buf = self._buf + buf
+		if '\r\n\r\n' in self._buf or '\n\n' in self._buf:
+			self._respond()
+		elif len(self._buf) > REQUEST_MAX:
+			self._reply('413 Request Entity Too Large', 'Request too large\n')
+
+	def _respond(self):
+		words = self._buf.split('\n', 1)[0].split()
+		if len(words) < 2 or words[0] != 'GET':
+			self._reply('405 Method Not Allowed', 'Only GET is supported\n')
+			return
+		if words[1].split('?', 1)[0] not in ('/', '/metrics'):
+			self._reply('404 Not Found', 'Metrics are at /metrics\n')
+			return
+		start = time.time()
+		body = render()
+		stats.record('metrics render', time.time() - start)
+		self._reply('200 OK', body, 'text/plain; version=0.0.4; charset=utf-8')
+
+	def _reply(self, status, body, ctype='text/plain'):
+		self._done = True
+		head = 'HTTP/1.0 ' + status + '\r\nContent-Type: ' + ctype + '\r\nContent-Length: ' + str(len(body)) + '\r\nConnection: close\r\n\r\n'
+		try:
+			self._sendq.write(head + body)
+		except socket.error as e:
+			self.close()
+			return
+		if self._sendq.pending() < 1:
+			self.close()
+
+	def _dowrite(self, sock):
+		try:
+			self._sendq.flush()
+		except socket.error as e:
+			self.close()
+			return
+		if self._done and self._sendq.pending() < 1:
+			self.close()
+
+	def close(self):
+		if self._sock == None:
+			return
+		if self._timer != None:
+			self._server._sched.cancel(self._timer)
+			self._timer = None
+		rbsocket.unbindsockcallbacks(self._sock)
+		try:
+			self._sock.close()
+		except:
+			pass
+		self._sock = None
+		if self in self._server._conns:
+			self._server._conns.remove(self)
@@ -19,13 +19,21 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-import socket, sched, time, sys, json, re, binascii
+import socket, time, sys, json, re, binascii
 from struct import pack, unpack
 from collections import namedtuple
 
 import core.rbsocket as rbsocket
+import core.scheduler as scheduler
+import core.connector as connector
+import core.resolver as resolver
 from core.rblogging import *
 import core.relay as relay
+import core.filters as filters
+import core.shard as shard
+import core.trace as trace
+import core.stats as stats
+import core.spool as spool
 
 MCRConPacket = namedtuple('MCRConPacket', ['id', 'type', 'payload'])
 MCUDPLogPacket = namedtuple('MCUDPLogPacket', ['timestamp', 'logger', 'message', 'thread', 'level'])
@@ -44,6 +52,11 @@ filterobjs = {
 def loadconfig(doc):
 	global configs
 
+	configs = parseconfig(doc)
+
+def parseconfig(doc):
+	configs = {}
+
 	cliconfs = doc.findall('./minecraft')
 
 	for cli in cliconfs:
@@ -74,6 +87,13 @@ def loadconfig(doc):
 			log.error('Minrcraft client udp config missing port attribute')
 			raise Exception('Minrcraft client udp config missing port attribute')
 		configs[name]['udp'] = udp.attrib
+		if not 'host' in configs[name]['udp']:
+			configs[name]['udp']['host'] = None
+		elif configs[name]['udp']['host'] == '':
+			configs[name]['udp']['host'] = None
+
+		configs[name]['queue'] = relay.parsequeueconfig(cli)
+		configs[name]['spool'] = spool.parseconfig(cli)
 
 		rels = rcon.findall('./relay')
 		for rel in rels:
@@ -92,10 +112,13 @@ def loadconfig(doc):
 			relnew = rel.attrib
 			relnew['filters'] = []
 
-			filters = rel.findall('./filter')
-			for filt in filters:
+			for filt in rel.findall('./filter'):
 				if 'type' in filt.attrib:
-					relnew['filters'].append(filt.attrib['type'])
+					# All regex rules run as one filter, where the first one was
+					if filt.attrib['type'].lower() == 'regex' and 'regex' in relnew['filters']:
+						continue
+					relnew['filters'].append(filt.attrib['type'].lower())
+			relnew['regex'] = filters.parseconfig(rel)
 
 			if not 'prefix' in relnew:
 				relnew['prefix'] = '[' + name + ']'
@@ -120,10 +143,13 @@ def loadconfig(doc):
 			relnew = rel.attrib
 			relnew['filters'] = []
 
-			filters = rel.findall('./filter')
-			for filt in filters:
+			for filt in rel.findall('./filter'):
 				if 'type' in filt.attrib:
-					relnew['filters'].append(filt.attrib['type'])
+					# All regex rules run as one filter, where the first one was
+					if filt.attrib['type'].lower() == 'regex' and 'regex' in relnew['filters']:
+						continue
+					relnew['filters'].append(filt.attrib['type'].lower())
+			relnew['regex'] = filters.parseconfig(rel)
 
 			if not 'prefix' in relnew:
 				relnew['prefix'] = '[' + name + ']'
@@ -148,10 +174,13 @@ def loadconfig(doc):
 			relnew = rel.attrib
 			relnew['filters'] = []
 
-			filters = rel.findall('./filter')
-			for filt in filters:
+			for filt in rel.findall('./filter'):
 				if 'type' in filt.attrib:
-					relnew['filters'].append(filt.attrib['type'])
+					# All regex rules run as one filter, where the first one was
+					if filt.attrib['type'].lower() == 'regex' and 'regex' in relnew['filters']:
+						continue
+					relnew['filters'].append(filt.attrib['type'].lower())
+			relnew['regex'] = filters.parseconfig(rel)
 
 			if not 'prefix' in relnew:
 				relnew['prefix'] = '[' + name + ']'
@@ -159,35 +188,107 @@ def loadconfig(doc):
 				configs[name]['relays'][''] = []
 			configs[name]['relays'][''].append(relnew)
 
+	return configs
+
 def runconfig(timers):
 	global configs
+
+	for key in configs:
+		if not shard.islocal('minecraft', key):
+			continue
+		_startclient(key, timers)
+
+def _relayfilters(rel):
+	ret = []
+	for fname in rel['filters']:
+		if fname == 'regex':
+			ret.extend(filters.chain(rel['regex']))
+			continue
+		filt = _getfilter(fname)
+		if filt != None:
+			ret.append(filt)
+	if len(ret) < 1:
+		ret = None
+	return ret
+
+def _startclient(key, timers):
+	global configs
+	global clients
+
+	conf = configs[key]
+
+	cli = client(name=key, rconhost=conf['rcon']['host'], rconport=conf['rcon']['port'],
+				rconpass=conf['rcon']['password'],
+				udphost=conf['udp']['host'], udpport=conf['udp']['port'], schedobj=timers,
+				queuesize=conf['queue']['size'], queuepolicy=conf['queue']['policy'], spoolconf=conf['spool'])
+
+	for rkey in conf['relays']:
+		for rel in conf['relays'][rkey]:
+			cli.relay_add(rel['type'], rel['name'], rel['channel'], rel['prefix'], rkey, _relayfilters(rel))
+
+	cli.connect()
+	clients[key] = cli
+
+def _stopclient(key, reason):
+	global clients
+
+	if not key in clients:
+		return
+	cli = clients.pop(key)
+	log.info('Stopping client: ' + reason, cli)
+	cli.stop()
+
+# Applies a config returned by parseconfig() to the running clients. Clients
+# whose rcon or udp settings changed are reconnected, relay changes are made
+# in place.
+def reloadconfig(newconfigs, timers):
+	global configs
 	global clients
-	global filterobjs
+
+	oldconfigs = configs
+	configs = newconfigs
+
+	for key in oldconfigs:
+		if not key in configs:
+			_stopclient(key, 'Removed from config')
+			relay.delqueue('minecraft', key)
+		elif configs[key]['rcon'] != oldconfigs[key]['rcon'] or configs[key]['udp'] != oldconfigs[key]['udp']:
+			_stopclient(key, 'Reconnecting for config change')
 
 	for key in configs:
-		conf = configs[key]
-		if not 'host' in conf['udp']:
-			conf['udp']['host'] = None
-		elif conf['udp']['host'] == '':
-			conf['udp']['host'] = None
-
-		cli = client(name=key, rconhost=conf['rcon']['host'], rconport=conf['rcon']['port'],
-					rconpass=conf['rcon']['password'],
-					udphost=conf['udp']['host'], udpport=conf['udp']['port'], schedobj=timers)
-
-		for rkey in conf['relays']:
-			for rel in conf['relays'][rkey]:
-				filters = []
-				for fname in rel['filters']:
-					filt = _getfilter(fname)
-					if filt != None:
-						filters.append(filt)
-				if len(filters) < 1:
-					filters = None
-				cli.relay_add(rel['type'], rel['name'], rel['channel'], rel['prefix'], rkey, filters)
-
-		cli.connect()
-		clients[key] = cli
+		if not shard.islocal('minecraft', key):
+			continue
+		if not key in clients:
+			_startclient(key, timers)
+			continue
+
+		cli = clients[key]
+		if configs[key]['queue'] != oldconfigs[key]['queue']:
+			relay.setqueue('minecraft', key, configs[key]['queue']['size'], configs[key]['queue']['policy'])
+		if configs[key]['spool'] != oldconfigs[key]['spool']:
+			relay.setspool('minecraft', key, configs[key]['spool'], timers)
+
+		old = oldconfigs[key]['relays']
+		new = configs[key]['relays']
+		for rkey in old:
+			for rel in old[rkey]:
+				if not rel in new.get(rkey, []):
+					cli.relay_del(rel['type'], rel['name'], rel['channel'], rel['prefix'], rkey)
+		for rkey in new:
+			for rel in new[rkey]:
+				if not rel in old.get(rkey, []):
+					cli.relay_add(rel['type'], rel['name'], rel['channel'], rel['prefix'], rkey, _relayfilters(rel))
+
+def _collect():
+	stats.collectclients('minecraft', clients)
+	pending = stats.metric('relaybot_rcon_pending_calls', 'gauge', 'RCON commands waiting for their response callback', ('client',))
+	for values in list(pending.series.keys()):
+		if not values[0] in clients:
+			pending.remove(*values)
+	for key in clients:
+		pending.labels(key).set(len(clients[key].rconcalls()))
+
+stats.addcollector(_collect)
 
 def sockets():
 	return client.sockets
@@ -200,6 +301,13 @@ def _getfilter(name):
 
 	return filterobjs[name.lower()]
 
+# Whether data is ?players from IRC. Not everything from IRC is a channel
+# message, replies like the one to ?irc have no 'msg'.
+def _isplayerscmd(data):
+	if data.source.type != 'irc' or not 'msg' in data.extra:
+		return False
+	return data.extra['msg'].params[-1][0:8] == '?players'
+
 def _cleanformatting(text):
 	s = text.replace(u'§0', '')
 	s = s.replace(u'§1', '')
@@ -255,27 +363,54 @@ class client:
 	_cmdoutputres = {}
 
 	def __init__(self, name, rconhost='127.0.0.1', rconport=25575, rconpass='',
-			udphost=None, udpport=25585, schedobj=None, schedpri=100):
+			udphost=None, udpport=25585, schedobj=None, schedpri=100,
+			sendqhigh=262144, sendqlow=65536, queuesize=relay.QUEUE_SIZE, queuepolicy=relay.QUEUE_POLICY,
+			spoolconf=None, readsize=16384):
 		self.name = name
 		self._rcon = {'host': rconhost, 'port': rconport, 'password': rconpass}
 		self._rconsock = None
+		self._rconsendq = None
+		self._sendqhigh = sendqhigh
+		self._sendqlow = sendqlow
 		self._rconconnected = False
 		self._rconid = 0
-		self._rconbuf = ''
+		self._rconreader = None
+		self._readsize = readsize
 		self._rconidbuf = {'id': -1, 'buf': ''}
 		self._udp = {'host': udphost, 'port': udpport}
 		self._udpsock = None
 		self._sched = schedobj
 		self._schedpri = schedpri
 		self._relays = {}
-		self._schedevs = {'conn': None, 'login': None, 'expirecalls': None}
+		self._routes = {}
+		self._sources = {}
+		self._schedevs = {'conn': None, 'expirecalls': None}
 		self._connfreq = 10
 		self._rcontimeout = 10
 		self._rconcalls = {}
+		# Send time of each RCON command still waiting for its response
+		self._rconsent = {}
+		self._rconlatency = stats.metric('relaybot_rcon_latency_seconds', 'histogram', 'Time from sending an RCON command to its response',
+				('client',)).labels(name)
+		udppackets = stats.metric('relaybot_udp_packets_total', 'counter', 'UDP log packets received and whether they could be parsed',
+				('client', 'result'))
+		self._udpparsed = udppackets.labels(name, 'parsed')
+		self._udpfailed = udppackets.labels(name, 'failed')
+		self._udpreceived = stats.metric('relaybot_udp_received_total', 'counter', 'UDP log packets received',
+				('client',)).labels(name)
 		self._rconexpiretimeout = 30
+		# Minecraft refuses RCON requests longer than 1446 bytes
+		self._rconmaxcommand = 1400
+		self._udpbatch = 64
+		self._stopped = False
 		if self._sched == None:
-			self._sched = sched.scheduler(time.time, time.sleep)
-		relay.bind('minecraft', self.name, self._relaycallback)
+			self._sched = scheduler.scheduler()
+		self._connector = connector.connector(self, rconhost, rconport, self._sched,
+			onconnect=self._onconnect, onfail=self._onconnectfail,
+			timeouts={connector.CONN_REGISTERING: self._rcontimeout}, schedpri=schedpri, logprefix='RCON ')
+		relay.setqueue('minecraft', self.name, queuesize, queuepolicy)
+		relay.setspool('minecraft', self.name, spoolconf, self._sched)
+		relay.bind('minecraft', self.name, self._relaycallback, self._relaybatchcallback)
 
 	def __del__(self):
 		try:
@@ -302,13 +437,12 @@ class client:
 
 	def _deltimer(self, event):
 		if self._sched:
-			if event in self._sched.queue:
-				self._sched.cancel(event)
+			self._sched.cancel(event)
 
 	def _addsock(self):
 		if self._rconsock != None:
 			if not self._rconsock in self.sockets:
-				rbsocket.bindsockcallbacks(self._rconsock, self._dodisconnect, self._doerr, self._doread)
+				rbsocket.bindsockcallbacks(self._rconsock, self._dodisconnect, self._doerr, self._doread, self._dowrite)
 				self.sockets.append(self._rconsock)
 		if self._udpsock != None:
 			if not self._udpsock in self.sockets:
@@ -323,105 +457,146 @@ class client:
 			rbsocket.unbindsockcallbacks(self._udpsock)
 			self.sockets.remove(self._udpsock)
 
+	def _parseudp(self, buf):
+		if buf[0] == ',':
+			buf = buf[1:]
+		try:
+			if self._jsonfixreg == None:
+				self._jsonfixreg = re.compile('^(.*?"message":")(.*)("})$')
+			m = self._jsonfixreg.match(buf)
+			jsonbuf = buf
+			if m != None:
+				s = m.group(2).replace('\\"', '"')
+				s = s.replace('\\', '\\\\')
+				jsonbuf = m.group(1) + s.replace('"', '\\"') + m.group(3)
+			jsonobj = json.loads(jsonbuf)
+		except Exception as e:
+			return None
+		try:
+			return MCUDPLogPacket(jsonobj['timeMillis'], jsonobj['loggerName'], jsonobj['message'], jsonobj['thread'], jsonobj['level'])
+		except Exception as e:
+			log.error('UDP Error handling UDP log packet: ' + str(e), self)
+		return None
+
 	def _doread(self, sock):
 		if sock == self._udpsock:
-			try:
-				buf, src = self._udpsock.recvfrom(4096)
-			except:
-				buf = ''
-				src = ('0.0.0.0', 0)
-			if buf != '':
-				log.protocol('UDP:[' + src[0] + ']:' + str(src[1]) + ' <-- ' + buf, self)
-				if buf[0] == ',':
-					buf = buf[1:]
+			# Read everything that has arrived so a burst of log lines (players
+			# joining etc) is relayed together
+			udpobjs = []
+			traces = []
+			while len(udpobjs) < self._udpbatch:
 				try:
-					if self._jsonfixreg == None:
-						self._jsonfixreg = re.compile('^(.*?"message":")(.*)("})$')
-					m = self._jsonfixreg.match(buf)
-					jsonbuf = buf
-					if m != None:
-						s = m.group(2).replace('\\"', '"')
-						s = s.replace('\\', '\\\\')
-						jsonbuf = m.group(1) + s.replace('"', '\\"') + m.group(3)
-					jsonobj = json.loads(jsonbuf)
-				except Exception as e:
-					return
+					buf, src = self._udpsock.recvfrom(4096)
+				except:
+					break
+				if buf == '':
+					break
+				tr = trace.begin('udp', self)
+				self._udpreceived.value += 1
+				log.protocol('UDP:[' + src[0] + ']:' + str(src[1]) + ' <-- ' + buf, self)
+				udpobj = self._parseudp(buf)
+				if udpobj != None:
+					self._udpparsed.value += 1
+					udpobjs.append(udpobj)
+					traces.append(tr)
+				else:
+					self._udpfailed.value += 1
+			trace.end()
+			if len(udpobjs) > 0:
 				try:
-					udpobj = MCUDPLogPacket(jsonobj['timeMillis'], jsonobj['loggerName'], jsonobj['message'], jsonobj['thread'], jsonobj['level'])
-					self._handleudp(udpobj)
+					self._handleudp(udpobjs, traces)
 				except Exception as e:
 					log.error('UDP Error handling UDP log packet: ' + str(e), self)
-		if sock == self._rconsock:
+		if sock == self._rconsock and self._rconreader != None:
 			try:
-				buf = self._rconsock.recv(4096)
-			except:
-				buf = ''
+				n = self._rconreader.fill()
+			except Exception as e:
+				log.error('RCON Error receiving from RCON: ' + str(e), self)
+				n = 0
 
-			if (buf == ''):
+			if n == None:
+				return
+			if n == 0:
 				log.info('RCON Received no data from ' + self._rcon['host'] + ', attemoting to reconnect', self)
 				self.disconnect('', False)
 				self._schedconnect()
 				return
 
-			if buf != '':
-				log.debug('RCON <-- ' + binascii.hexlify(buf), self)
-
-				self._rconbuf = self._rconbuf + buf
+			try:
+				packets = self._rconreader.frames('<i')
+			except ValueError as e:
+				log.error('RCON ' + str(e) + ' from ' + self._rcon['host'] + ', attempting to reconnect', self)
+				self.disconnect('', False)
+				self._schedconnect()
+				return
 
-				while True:
-					if len(self._rconbuf) < 4:
-						break
+			for packet in packets:
+				size = len(packet)
 
-					size = unpack('<i', self._rconbuf[0:4])
-					size = size[0]
+				log.debug('RCON Parsing packet: ' + binascii.hexlify(packet), self)
 
-					if len(self._rconbuf) < size + 4:
-						break
+				if size == 10:
+					payload = ''
+					(idin, type, padding) = unpack('<ii2s', packet)
+				elif size > 10:
+					(idin, type, payload, padding) = unpack('<ii' + str(size-10) + 's2s', packet)
+				else:
+					log.debug('RCON Packet with erroneous length (' + str(size) + '): ' + binascii.hexlify(packet), self)
+					continue
 
-					log.debug('RCON Parsing packet: ' + binascii.hexlify(self._rconbuf[:size + 4]), self)
-					packet = self._rconbuf[4:size + 4]
-					self._rconbuf = self._rconbuf[size + 4:]
-					if self._rconbuf != '':
-						log.debug('RCON Remaining packet: ' + binascii.hexlify(self._rconbuf), self)
+				log.protocol('RCON <-- id:' + str(idin) + ', type:' + str(type) + ', payload:' + payload, self)
 
-					if size == 10:
-						payload = ''
-						(idin, type, padding) = unpack('<ii2s', packet)
-					elif size > 10:
-						(idin, type, payload, padding) = unpack('<ii' + str(size-10) + 's2s', packet)
-					else:
-						log.debug('RCON Packet with erroneous length (' + str(size) + '): ' + binascii.hexlify(packet), self)
-						continue
+				if self._rconidbuf['id'] != idin:
+					if self._rconidbuf['id'] != -1:
+						log.debug('RCON Unparsed packet being dropped with id ' + self._rconidbuf['id'], self)
+					self._rconidbuf = {'id': idin, 'buf': ''}
+				self._rconidbuf['buf'] = self._rconidbuf['buf'] + payload
 
-					log.protocol('RCON <-- id:' + str(idin) + ', type:' + str(type) + ', payload:' + payload, self)
+				if size != 4106:
+					rcon = MCRConPacket(idin, type, self._rconidbuf['buf'])
+					log.debug('RCON Handling packet: ' + str(rcon), self)
+					self._rconidbuf = {'id': -1, 'buf': ''}
 
-					if self._rconidbuf['id'] != idin:
-						if self._rconidbuf['id'] != -1:
-							log.debug('RCON Unparsed packet being dropped with id ' + self._rconidbuf['id'], self)
-						self._rconidbuf = {'id': idin, 'buf': ''}
-					self._rconidbuf['buf'] = self._rconidbuf['buf'] + payload
+					trace.begin('rcon', self)
+					try:
+						self._rconhandle(rcon)
+					except Exception as e:
+						log.error('RCON Error handling RCON packet: ' + str(e), self)
+					trace.end()
 
-					if size != 4106:
-						rcon = MCRConPacket(idin, type, self._rconidbuf['buf'])
-						log.debug('RCON Handling packet: ' + str(rcon), self)
-						self._rconidbuf = {'id': -1, 'buf': ''}
+	def _dowrite(self, sock):
+		if sock != self._rconsock or self._rconsendq == None:
+			return
 
-						try:
-							self._rconhandle(rcon)
-						except Exception as e:
-							log.error('RCON Error handling RCON packet: ' + str(e), self)
+		try:
+			self._rconsendq.flush()
+		except Exception as e:
+			log.error('RCON Error sending to RCON: ' + str(e), self)
+			self.disconnect('', False)
+			self._schedconnect()
 
 	def _doerr(self, sock):
 		return
 
+	def _sendqfull(self, sendq):
+		log.warning('RCON Send queue above high watermark (' + str(sendq.pending()) + ' bytes queued)', self)
+		relay.setready('minecraft', self.name, False)
+
+	def _sendqdrained(self, sendq):
+		log.info('RCON Send queue drained below low watermark', self)
+		if self._rconconnected:
+			relay.setready('minecraft', self.name, True)
+
 	def _dodisconnect(self, sock, msg):
 		self.disconnect(msg, True, True)
 
-	def _handleudp(self, udpobj):
-		self._callrelay(None, udpobj, what='udp', schannel='udp')
+	def _handleudp(self, udpobjs, traces=None):
+		self._callrelaymany([(None, udpobj) for udpobj in udpobjs], what='udp', schannel='udp', traces=traces)
 
-	def _callrelay(self, text, obj, type=None, name=None, channel=None, what='', schannel=''):
-		found = False
+	def _compileroutes(self, what, type, name, channel):
+		# Targets matching a _callrelay() lookup with their text prefix already
+		# formatted, cached until the relays change
+		routes = []
 		for key in self._relays:
 			if key != what and what != 'all':
 				continue
@@ -432,17 +607,72 @@ class client:
 					continue
 				if channel != None and rel.channel != channel.lower():
 					continue
-				found = True
+				if rel.extra['prefix'] != '':
+					routes.append((rel, rel.extra['prefix'] + ' '))
+				else:
+					routes.append((rel, ''))
+		if len(routes) < 1 and type != None and name != None:
+			routes.append((relay.RelayTarget(type, name, channel, {}, None), '[' + self.name + '] '))
+		self._routes[(what, type, name, channel)] = routes
+		return routes
+
+	def _getroutes(self, what, type, name, channel, schannel):
+		routes = self._routes.get((what, type, name, channel))
+		if routes == None:
+			routes = self._compileroutes(what, type, name, channel)
+		source = self._sources.get(schannel)
+		if source == None:
+			source = self._sources[schannel] = relay.RelaySource('minecraft', self.name, schannel, {})
+		return routes, source
+
+	def _callrelay(self, text, obj, type=None, name=None, channel=None, what='', schannel='', extra={}, tr=None):
+		routes, source = self._getroutes(what, type, name, channel, schannel)
+		if tr == None:
+			tr = trace.current()
+		# The filters of every route share their work on obj
+		relay.startevent()
+		try:
+			for rel, prefix in routes:
 				rtext = text
-				if rel.extra['prefix'] != '' and text != None and text != '':
-					rtext = rel.extra['prefix'] + ' ' + text
-				relay.call(rtext, rel, relay.RelaySource('minecraft', self.name, schannel, {}), {'obj': obj})
-		if not found:
-			rel = relay.RelayTarget(type, name, channel, {}, None)
-			rtext = text
-			if text != None and text != '':
-				rtext = '[' + self.name + ']' + ' ' + text
-			relay.call(rtext, rel, relay.RelaySource('minecraft', self.name, schannel, {}), {'obj': obj})
+				if text != None and text != '':
+					rtext = prefix + text
+				e = {'obj': obj}
+				for k in extra:
+					e[k] = extra[k]
+				if tr != None:
+					e['trace'] = tr
+				relay.call(rtext, rel, source, e)
+		finally:
+			relay.endevent()
+
+	# Like _callrelay() for a list of (text, obj), each target gets them in
+	# one relay.call_many(). traces has the trace of each item, by default
+	# they all get the current one.
+	def _callrelaymany(self, items, type=None, name=None, channel=None, what='', schannel='', extra={}, traces=None):
+		if traces == None:
+			traces = [trace.current()] * len(items)
+		if len(items) == 1:
+			self._callrelay(items[0][0], items[0][1], type, name, channel, what, schannel, extra, traces[0])
+			return
+		routes, source = self._getroutes(what, type, name, channel, schannel)
+		relay.startevent()
+		try:
+			for rel, prefix in routes:
+				messages = []
+				for i in range(len(items)):
+					text, obj = items[i]
+					rtext = text
+					if text != None and text != '':
+						rtext = prefix + text
+					e = {'obj': obj}
+					for k in extra:
+						e[k] = extra[k]
+					if traces[i] != None:
+						e['trace'] = traces[i]
+					messages.append((rtext, e))
+				relay.call_many(messages, rel, source)
+		finally:
+			relay.endevent()
 
 	def _schedconnect(self, freq=None):
 		if freq == None:
@@ -453,7 +683,7 @@ class client:
 		log.info('RCON Attempting to reconnect in ' + str(freq) + ' seconds', self)
 
 	def _rconsend(self, id=0, type=0, payload=None):
-		if self._rconsock == None:
+		if self._rconsock == None or self._rconsendq == None:
 			return
 
 		packet = pack('<ii', id, type)
@@ -469,7 +699,7 @@ class client:
 		log.protocol('RCON --> id:' + str(id) + ', type:' + str(type) + ', payload:' + payload, self)
 
 		try:
-			self._rconsock.send(packet)
+			self._rconsendq.write(packet)
 		except Exception as e:
 			log.error('RCON Error sending to RCON: ' + str(e), self)
 			self.disconnect('', False)
@@ -481,23 +711,21 @@ class client:
 			log.error('RCON Unable to login to RCON, will not attempt to reconnect', self)
 		elif rcon.type == 2:
 			self._rconconnected = True
-			self._deltimer(self._schedevs['login'])
-			self._schedevs['login'] = None
+			self._connector.ready()
 			log.info('RCON Sucessfully logged in to RCON', self)
 			self._callrelay(None, rcon, what='rcon', schannel='rcon')
+			if self._rconconnected and not self._rconsendq.abovehigh():
+				relay.setready('minecraft', self.name, True)
 		elif rcon.type == 0:
+			sent = self._rconsent.pop(rcon.id, None)
+			if sent != None:
+				self._rconlatency.add(time.time() - sent)
 			if rcon.id in self._rconcalls:
 				log.debug('RCON Handling callback for RCON response', self)
 				if self._rconcalls[rcon.id].callback != None:
 					self._rconcalls[rcon.id].callback(rcon, self._rconcalls[rcon.id])
 				del self._rconcalls[rcon.id]
 
-	def _rcontimeout(self):
-		if self._rconconnected:
-			log.error('RCON Timed out logging in to RCON, attempting to reconnect', self)
-		self.disconnect()
-		self._schedconnect()
-
 	def _cmd_players(self, rcon, rconcall):
 		try:
 			if not 'players' in self._cmdoutputres:
@@ -507,19 +735,23 @@ class client:
 				first = m.group(1)
 				if m.group(2) == '':
 					first = first[0:-1]
-				self._callrelay(first, rcon, rconcall.args[0].type, rconcall.args[0].name, rconcall.args[0].channel, what='rcon', schannel='rcon')
+				items = [(first, rcon)]
 				if m.group(2) != '':
-					self._callrelay(m.group(2), rcon, rconcall.args[0].type, rconcall.args[0].name, rconcall.args[0].channel, what='rcon', schannel='rcon')
+					items.append((m.group(2), rcon))
+				self._callrelaymany(items, rconcall.args[0].type, rconcall.args[0].name, rconcall.args[0].channel, what='rcon', schannel='rcon', extra=rconcall.args[2])
 		except Exception as e:
 			log.error('RCON Error handling RCON players list response: ' + str(e), self)
 
 	def _relaycallback(self, data):
 		if self._rconconnected:
-			if data.source.type == 'irc':
-				if data.extra['msg']['params'][-1][0:8] == '?players':
-					self._rconcommand('list', self._cmd_players, [data.source, data.extra['msg']])
-					return
+			if _isplayerscmd(data):
+				self._rconcommand('list', self._cmd_players, [data.source, data.extra['msg'], relay.nexthop(data)])
+				trace.finish(data.extra.get('trace'))
+				return
 			if data.target.channel == 'rcon':
+				# Counts of relays dropped from the queue aren't commands
+				if data.source.type == 'relay':
+					return
 				callback = None
 				args = None
 				if 'callback' in data.extra:
@@ -528,14 +760,59 @@ class client:
 					args = data.extra['args']
 				self._rconcommand(data.text, callback, args)
 			else:
+				self._rconcommand('tellraw @a ' + json.dumps(self._tellrawparts(data.text)))
+			trace.finish(data.extra.get('trace'))
+
+	def _tellrawparts(self, text):
+		parts = []
+		for part in filter(None, re.split('(https?://[^\s]+)', text)):
+			if part[0:7] == 'http://' or part[0:8] == 'https://':
+				parts.append({'text':part, 'underlined':True, 'clickEvent':{'action':'open_url', 'value':part}})
+			else:
+				parts.append(part)
+		#parts = [text]
+		return parts
+
+	def _relaybatchcallback(self, datas):
+		if not self._rconconnected:
+			return
+		# Chat lines are joined into as few tellraw commands as the RCON
+		# request size allows, anything else goes through _relaycallback()
+		parts = []
+		traces = []
+		size = 0
+		for data in datas:
+			if data.target.channel == 'rcon' or _isplayerscmd(data):
+				if len(parts) > 0:
+					self._tellraw(parts, traces)
+					parts = []
+					traces = []
+					size = 0
+				self._relaycallback(data)
+				continue
+			if data.text == None:
+				continue
+			newparts = self._tellrawparts(data.text)
+			newsize = len(json.dumps(newparts))
+			if len(parts) > 0 and size + newsize + 16 > self._rconmaxcommand:
+				self._tellraw(parts, traces)
 				parts = []
-				for part in filter(None, re.split('(https?://[^\s]+)', data.text)):
-					if part[0:7] == 'http://' or part[0:8] == 'https://':
-						parts.append({'text':part, 'underlined':True, 'clickEvent':{'action':'open_url', 'value':part}})
-					else:
-						parts.append(part)
-				#parts = [data.text]
-				self._rconcommand('tellraw @a ' + json.dumps(parts))
+				traces = []
+				size = 0
+			if len(parts) > 0:
+				parts.append('\n')
+				size += 6
+			parts.extend(newparts)
+			size += newsize
+			if 'trace' in data.extra:
+				traces.append(data.extra['trace'])
+		if len(parts) > 0:
+			self._tellraw(parts, traces)
+
+	def _tellraw(self, parts, traces=[]):
+		self._rconcommand('tellraw @a ' + json.dumps(parts))
+		for tr in traces:
+			trace.finish(tr)
 
 	def _rconexpirecalls(self):
 		delids = []
@@ -545,6 +822,8 @@ class client:
 				delids.append(id)
 		for id in delids:
 			del self._rconcalls[id]
+		for id in [id for id in self._rconsent if self._rconsent[id] + self._rconexpiretimeout < time.time()]:
+			del self._rconsent[id]
 		self._schedevs['expirecalls'] = self._addtimer(delay=self._rconexpiretimeout, callback=self._rconexpirecalls)
 
 	def _rconcommand(self, command, callback=None, args=None):
@@ -555,6 +834,7 @@ class client:
 
 		if callback != None:
 			self._rconcalls[id] = MCRConCallback(callback=callback, time=time.time(), args=args, command=command)
+		self._rconsent[id] = time.time()
 
 		self._rconsend(id, 2, command)
 
@@ -569,103 +849,121 @@ class client:
 			log.info('UDP Attempting to bind to port ' + str(self._udp['port']) + ' on host ' + self._udp['host'], self)
 
 			if self._udpsock != None:
+				self._delsock(True)
 				self._udpsock.close()
 				self._udpsock = None
-			addrs = []
-			try:
-				addrs = socket.getaddrinfo(self._udp['host'], self._udp['port'], 0, 0, socket.IPPROTO_UDP)
-			except Exception as e:
-				log.error('UDP Error binding UDP socket: ' + str(e), self)
-
-			if len(addrs) < 1:
-				return
+			resolver.resolve(self._udp['host'], self._udp['port'], 0, 0, socket.IPPROTO_UDP, self._udpresolved)
 
-			af, socktype, proto, canonname, sa = addrs[0]
-			try:
-				s = rbsocket.rbsocket(af, socktype, proto)
-			except Exception as e:
-				log.error('UDP Error creating UDP socket: ' + str(e), self)
-				return
+		log.info('RCON Attempting to connect to ' + self._rcon['host'] + ' on port ' + str(self._rcon['port']), self)
 
-			try:
-				s.bind(sa)
-			except Exception as e:
-				log.error('UDP Error binding UDP socket: ' + str(e), self)
-				return
+		self._connector.start()
 
-			self._udpsock = s
+	def _udpresolved(self, addrs, err):
+		if self._udpsock != None or self._stopped:
+			return
 
-			log.info('UDP Bound to port ' + str(self._udp['port']) + ' on host ' + self._udp['host'], self)
+		if err != None:
+			log.error('UDP Error binding UDP socket: ' + err, self)
 
-		log.info('RCON Attempting to connect to ' + self._rcon['host'] + ' on port ' + str(self._rcon['port']), self)
+		if len(addrs) < 1:
+			return
 
-		addrs = []
+		af, socktype, proto, canonname, sa = addrs[0]
 		try:
-			addrs = socket.getaddrinfo(self._rcon['host'], self._rcon['port'], 0, 0, socket.IPPROTO_TCP)
+			s = rbsocket.rbsocket(af, socktype, proto)
 		except Exception as e:
-			log.error('RCON Error connecting rcon socket: ' + str(e), self)
-
-		if len(addrs) < 1:
+			log.error('UDP Error creating UDP socket: ' + str(e), self)
 			return
 
-		s = None
-		ex = []
-		for addr in addrs:
-			af, socktype, proto, canonname, sa = addr
-			try:
-				s = rbsocket.rbsocket(af, socktype, proto)
-			except Exception as e:
-				s = None
-				continue
+		try:
+			s.bind(sa)
+		except Exception as e:
+			log.error('UDP Error binding UDP socket: ' + str(e), self)
+			return
+		s.setblocking(0)
 
-			try:
-				s.connect(sa)
-			except Exception as e:
-				s.close()
-				s = None
-				ex.append(e)
-				continue
-			break
+		self._udpsock = s
+		self._addsock()
 
-		if s == None:
-			log.error('RCON Error connecting to rcon: ' + str(ex[-1]), self)
-			self._schedconnect()
-			return
+		log.info('UDP Bound to port ' + str(self._udp['port']) + ' on host ' + self._udp['host'], self)
 
+	def _onconnect(self, s):
 		self._rconsock = s
+		self._rconsendq = rbsocket.sendqueue(s, self._sendqhigh, self._sendqlow, self._sendqfull, self._sendqdrained)
+		self._rconreader = rbsocket.streamreader(s, self._readsize)
+		self._addsock()
 
 		self._rconsend(self._rconid, 3, self._rcon['password'])
 		self._rconid += 1
 
-		self._schedevs['login'] = self._addtimer(delay=self._rcontimeout, callback=self._rcontimeout)
+		self._deltimer(self._schedevs['expirecalls'])
 		self._schedevs['expirecalls'] = self._addtimer(delay=self._rconexpiretimeout, callback=self._rconexpirecalls)
 
-		self._addsock()
-
 		log.info('RCON Connected to rcon socket, waiting for logon confirmation', self)
 
+	def _onconnectfail(self, reason):
+		log.error('RCON Error connecting to rcon: ' + reason, self)
+		self.disconnect()
+		self._schedconnect()
+
 	def disconnect(self, reason = '', sendexit = True, closeudp = False):
+		self._connector.abort()
 		self._delsock(closeudp)
 
 		if self._rconsock != None:
 			self._rconsock.close()
 		self._rconsock = None
+		self._rconsendq = None
+		self._rconreader = None
 		self._rconid = 0
+		self._rconsent = {}
 		self._rconconnected = False
+		relay.setready('minecraft', self.name, False)
 
 		if closeudp:
 			if self._udpsock != None:
 				self._udpsock.close()
 			self._udpsock = None
 
+	def sendqueue(self):
+		return self._rconsendq
+
+	def connector(self):
+		return self._connector
+
+	def rconcalls(self):
+		return self._rconcalls
+
 	def relay_add(self, type, name, channel, prefix, what=None, filters=None):
 		rel = relay.RelayTarget(type, name, channel, {'prefix': prefix}, filters)
 		if not what in self._relays:
 			self._relays[what] = [rel]
 		else:
 			self._relays[what].append(rel)
+		self._routes = {}
 		log.debug('Added relay rule (type:' + type + ', name:' + name + ', channel:' + channel + ', prefix=' + prefix + ')', self)
 
+	def relay_del(self, type, name, channel, prefix, what=None):
+		if not what in self._relays:
+			return
+		rels = self._relays[what]
+		for rel in rels:
+			if rel.type == type and rel.name == name and rel.channel == channel and rel.extra['prefix'] == prefix:
+				rels.remove(rel)
+				log.debug('Removed relay rule (type:' + type + ', name:' + name + ', channel:' + channel + ', prefix=' + prefix + ')', self)
+				break
+		if len(rels) < 1:
+			del self._relays[what]
+		self._routes = {}
+
+	def stop(self):
+		self._stopped = True
+		self.disconnect(closeudp=True)
+		for ev in self._schedevs:
+			self._deltimer(self._schedevs[ev])
+			self._schedevs[ev] = None
+		relay.unbind('minecraft', self.name, self._relaycallback)
+
 class playerdeathfilter:
 	_deathreg = ['^.*? was doomed to fall$',
 				'^.*? withered away$',
@@ -732,6 +1030,19 @@ class playerdeathfilter:
 
 	_deathregc = []
 
+	# The IRC formatted message, or None if it isn't a death message
+	def _render(self, obj):
+		if len(self._deathregc) < 1:
+			for reg in self._deathreg:
+				self._deathregc.append(re.compile(reg, re.S))
+
+		for reg in self._deathregc:
+			m = reg.match(obj.message)
+			if m != None:
+				return _formatmctoirc(obj.message)
+
+		return None
+
 	def filter(self, data):
 		if data.source.type != 'minecraft' or \
 			data.source.channel != 'udp':
@@ -743,20 +1054,12 @@ class playerdeathfilter:
 		if data.extra['obj'].logger != 'net.minecraft.server.MinecraftServer':
 			return relay.FILTER_NOMATCH, None
 
-		if len(self._deathregc) < 1:
-			for reg in self._deathreg:
-				self._deathregc.append(re.compile(reg, re.S))
-
-		for reg in self._deathregc:
-			m = reg.match(data.extra['obj'].message)
-			if m != None:
-				text = _formatmctoirc(data.extra['obj'].message)
-				if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
-					text = data.target.extra['prefix'] + ' ' + text
-				ret = data._replace(text=text)
-				return relay.FILTER_MATCH, ret
-
-		return relay.FILTER_NOMATCH, None
+		text = relay.cached((data.extra['obj'], 'playerdeath', 'irc'), self._render, data.extra['obj'])
+		if text == None:
+			return relay.FILTER_NOMATCH, None
+		if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
+			text = data.target.extra['prefix'] + ' ' + text
+		return relay.FILTER_MATCH, data._replace(text=text)
 
 class playerjoinpartfilter:
 	_reg = {
@@ -783,28 +1086,30 @@ class playerjoinpartfilter:
 		if not data.extra['obj'].logger in self._reg:
 			return relay.FILTER_NOMATCH, None
 
-		for key in self._reg[data.extra['obj'].logger]:
-			if not key in self._regc[data.extra['obj'].logger]:
-				self._regc[data.extra['obj'].logger][key] = re.compile(self._reg[data.extra['obj'].logger][key])
+		text = relay.cached((data.extra['obj'], 'playerjoinpart', 'irc'), self._render, data.extra['obj'])
+		if text == None:
+			return relay.FILTER_NOMATCH, None
+		if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
+			text = data.target.extra['prefix'] + ' ' + text
+		return relay.FILTER_MATCH, data._replace(text=text)
 
-			m = self._regc[data.extra['obj'].logger][key].match(data.extra['obj'].message)
+	# The IRC formatted message, or None if it isn't a join, part or
+	# whitelist rejection
+	def _render(self, obj):
+		for key in self._reg[obj.logger]:
+			if not key in self._regc[obj.logger]:
+				self._regc[obj.logger][key] = re.compile(self._reg[obj.logger][key])
+
+			m = self._regc[obj.logger][key].match(obj.message)
 
 			if m != None:
-				ret = data
 				if key == 'joinpart':
-					text = _formatmctoirc(data.extra['obj'].message)
-					if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
-						text = data.target.extra['prefix'] + ' ' + text
-					ret = data._replace(text=text)
+					return _formatmctoirc(obj.message)
 				elif key == 'whitelist':
 					name = m.group(2)
 					ip = m.group(3)
-					text = '*** Connection from ' + ip + ' rejected (not whitelisted: ' + name + ')'
-					if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
-						text = data.target.extra['prefix'] + ' ' + text
-					ret = data._replace(text=text)
-				return relay.FILTER_MATCH, ret
-		return relay.FILTER_NOMATCH, None
+					return '*** Connection from ' + ip + ' rejected (not whitelisted: ' + name + ')'
+		return None
 
 class playerchatfilter:
 	_reg = {
@@ -833,15 +1138,23 @@ class playerchatfilter:
 		if not data.extra['obj'].logger in self._reg:
 			return relay.FILTER_NOMATCH, None
 
-		for key in self._reg[data.extra['obj'].logger]:
-			if not key in self._regc[data.extra['obj'].logger]:
-				self._regc[data.extra['obj'].logger][key] = re.compile(self._reg[data.extra['obj'].logger][key])
+		text = relay.cached((data.extra['obj'], 'playerchat', 'irc'), self._render, data.extra['obj'])
+		if text == None:
+			return relay.FILTER_NOMATCH, None
+		if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
+			text = data.target.extra['prefix'] + ' ' + text
+		return relay.FILTER_MATCH, data._replace(text=text)
+
+	# The IRC formatted message, or None if it isn't chat or an achievement
+	def _render(self, obj):
+		for key in self._reg[obj.logger]:
+			if not key in self._regc[obj.logger]:
+				self._regc[obj.logger][key] = re.compile(self._reg[obj.logger][key])
 
-			m = self._regc[data.extra['obj'].logger][key].match(data.extra['obj'].message)
+			m = self._regc[obj.logger][key].match(obj.message)
 
 			if m != None:
-				ret = data
-				text = _formatmctoirc(data.extra['obj'].message)
+				text = _formatmctoirc(obj.message)
 				if key == 'chatmsg' or key == 'chatact' or key == 'chatmsgsrv':
 					name = ''
 					npre = ''
@@ -858,11 +1171,8 @@ class playerchatfilter:
 						text = m.group(2)
 					name = _formatmctoirc(name)
 					text = npre + name + nsuf + ' ' + _formatmctoirc(text)
-				if 'prefix' in data.target.extra and data.target.extra['prefix'] != None and data.target.extra['prefix'] != '':
-					text = data.target.extra['prefix'] + ' ' + text
-				ret = data._replace(text=text)
-				return relay.FILTER_MATCH, ret
-		return relay.FILTER_NOMATCH, None
+				return text
+		return None
 
 class crashfilter:
 	_reg = {'uj': '^This crash report has been saved to'}
@@ -883,16 +1193,18 @@ class crashfilter:
 		if data.extra['obj'].thread != 'Server Watchdog':
 			return relay.FILTER_NOMATCH, None
 
-		if self._regc[data.extra['obj'].logger] is None:
-			self._regc[data.extra['obj'].logger] = re.compile(self._reg[data.extra['obj'].logger])
-
-		m = self._regc[data.extra['obj'].logger].match(data.extra['obj'].message)
-		if m != None:
+		if relay.cached((data.extra['obj'], 'crash'), self._match, data.extra['obj']):
 			ret = data._replace(text='ERROR: The server has crashed')
 			return relay.FILTER_MATCH, ret
 
 		return relay.FILTER_NOMATCH, None
 
+	def _match(self, obj):
+		if self._regc[obj.logger] is None:
+			self._regc[obj.logger] = re.compile(self._reg[obj.logger])
+
+		return self._regc[obj.logger].match(obj.message) != None
+
 
 class overviewerfilter:
 	def filter(self, data):
@@ -20,53 +20,82 @@
 # You should have received a copy of the GNU General Public License
 # along with RelayBot.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, socket, select, time, sched
+import sys, socket, time
+from optparse import OptionParser
 
 import core.modules as modules
 import core.rbsocket as rbsocket
+import core.scheduler as scheduler
+import core.shard as shard
+import core.relay as relay
+import core.stats as stats
 from core.config import *
 from core.rblogging import *
 
 timers = None
+options = None
 
 def doselect(timeout):
-	sockets = modules.getsockets()
 	try:
-		selread, selwrite, selerr = select.select(sockets, [], sockets, timeout)
+		start = time.time()
+		events = rbsocket.poll(timeout)
+		stats.record('loop select', time.time() - start)
 	except KeyboardInterrupt as e:
-		for sock in sockets:
+		for sock in modules.getsockets():
 			rbsocket.dodisconnect(sock, 'Shutting down (Ctrl+C)')
+		relay.closespools()
 		log.info('Received keyboard interrupt, shutting down.')
 		exit()
 	except Exception as e:
 		log.critical(str(e))
 		exit()
-	for sock in selerr:
-		rbsocket.doerr(sock)
-	for sock in selread:
-		rbsocket.doread(sock)
+	rbsocket.dispatch(events)
 
 def main():
 	global timers
-	timers = sched.scheduler(time.time, doselect)
+	timers = scheduler.scheduler(time.time)
+
+	loadconfig(timers, options.config)
 
-	loadconfig(timers)
+	stats.install()
+	installreload()
 
 	while (True):
-		if (timers.empty()):
-			doselect(None)
-		else:
-			timers.run()
+		deadline = timers.nexttime()
+		doselect(timers.timeout())
+		# How late the loop woke up for the timer it was waiting on
+		if deadline != None:
+			late = time.time() - deadline
+			if late >= 0:
+				stats.record('loop lateness', late)
+		timers.run()
+		stats.checkdump()
+		checkreload(timers)
+
+def run():
+	try:
+		main()
+	except KeyboardInterrupt as e:
+		sockets = modules.getsockets()
+		for sock in sockets:
+			rbsocket.dodisconnect(sock, 'Shutting down (Ctrl+C)')
+		relay.closespools()
+		log.info('Received keyboard interrupt, shutting down.')
+	except Exception as e:
+		sockets = modules.getsockets()
+		for sock in sockets:
+			rbsocket.dodisconnect(sock, 'Exception: ' + str(e))
+		relay.closespools()
+		log.critical(str(e))
+
+parser = OptionParser()
+parser.add_option('-c', '--config', dest='config', default='config/config.xml',
+		help='read config from FILE [default: %default]', metavar='FILE')
+parser.add_option('-w', '--workers', dest='workers', type='int', default=0,
+		help='spread <irc> and <minecraft> clients over N worker processes [default: run in this process]', metavar='N')
+(options, args) = parser.parse_args()
 
-try:
-	main()
-except KeyboardInterrupt as e:
-	sockets = modules.getsockets()
-	for sock in sockets:
-		rbsocket.dodisconnect(sock, 'Shutting down (Ctrl+C)')
-	log.info('Received keyboard interrupt, shutting down.')
-except Exception as e:
-	sockets = modules.getsockets()
-	for sock in sockets:
-		rbsocket.dodisconnect(sock, 'Exception: ' + str(e))
-	log.critical(str(e))
+if options.workers > 0:
+	sys.exit(shard.supervise(options.workers, options.config, run))
+else:
+	run()